@@ -1,11 +1,14 @@
+import os
 import warnings
 
 from datetime import datetime
 from numbers import Number as NumberBase
 from itertools import chain
+from collections import Mapping
 from functools import partial
 
 from . import controlled_vocabulary
+from .protein_grouping import EvidenceIndex
 
 
 from lxml import etree
@@ -214,6 +217,9 @@ class UserParam(CVParam):
 
 class CV(TagBase):
     tag_name = 'cv'
+    # The OBO tags kept when parsing the vocabulary. `id` and `name` are always
+    # kept, and `relationship` provides the `has_regexp` of each enzyme.
+    obo_tags = ("relationship",)
 
     def __init__(self, id, uri, **kwargs):
         super(CV, self).__init__(id=id, uri=uri, **kwargs)
@@ -222,19 +228,26 @@ class CV(TagBase):
     def load(self, handle=None):
         if handle is None:
             fp = controlled_vocabulary.obo_cache.resolve(self.uri)
-            cv = controlled_vocabulary.ControlledVocabulary.from_obo(fp)
+            if isinstance(fp, controlled_vocabulary.MappedVocabulary):
+                cv = fp
+            else:
+                cv = controlled_vocabulary.ControlledVocabulary.from_obo(fp, self.obo_tags)
         else:
-            cv = controlled_vocabulary.ControlledVocabulary.from_obo(handle)
+            cv = controlled_vocabulary.ControlledVocabulary.from_obo(handle, self.obo_tags)
         try:
             cv.id = self.id
         except:
             pass
         return cv
 
-    def __getitem__(self, key):
+    @property
+    def vocabulary(self):
         if self._vocabulary is None:
             self._vocabulary = self.load()
-        return self._vocabulary[key]
+        return self._vocabulary
+
+    def __getitem__(self, key):
+        return self.vocabulary[key]
 
 
 class ProvidedCV(CV):
@@ -252,10 +265,73 @@ class ProvidedCV(CV):
             pass
         return cv
 
-    def __getitem__(self, key):
+    @property
+    def vocabulary(self):
         if self._provider is None:
             self._provider = self.load()
-        return self._provider[key]
+        return self._provider
+
+    def __getitem__(self, key):
+        return self.vocabulary[key]
+
+
+def share_vocabularies(directory, vocabularies=None):
+    '''
+    Parse each OBO-backed vocabulary once and write it to a memory-mapped
+    store in `directory`, registering a resolver for it on
+    :data:`controlled_vocabulary.obo_cache` so that any :class:`CV` created
+    after this point attaches to the shared store instead of parsing its own
+    copy. :class:`ProvidedCV` instances are skipped, as their providers manage
+    their own storage.
+
+    Call this in the parent process, and pass the returned mapping to
+    :func:`attach_shared_vocabularies` in each worker's initializer when the
+    workers do not inherit the parent's state through `fork`.
+
+    Parameters
+    ----------
+    directory: str
+        The directory to write the mapped stores to
+    vocabularies: list of CV, optional
+        The vocabularies to share. Defaults to :data:`default_cv_list`
+
+    Returns
+    -------
+    dict:
+        A mapping from vocabulary URI to mapped store path
+    '''
+    if vocabularies is None:
+        vocabularies = default_cv_list
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    paths = {}
+    for cv in vocabularies:
+        if isinstance(cv, ProvidedCV):
+            continue
+        path = os.path.join(directory, "%s.cvmap" % cv.id)
+        vocabulary = cv.load()
+        if not isinstance(vocabulary, controlled_vocabulary.MappedVocabulary):
+            controlled_vocabulary.MappedVocabulary.build(vocabulary, path).close()
+            paths[cv.uri] = path
+        else:
+            paths[cv.uri] = vocabulary.path
+    attach_shared_vocabularies(paths)
+    return paths
+
+
+def attach_shared_vocabularies(paths):
+    '''
+    Register the memory-mapped stores produced by :func:`share_vocabularies`
+    with :data:`controlled_vocabulary.obo_cache`.
+
+    Parameters
+    ----------
+    paths: dict
+        A mapping from vocabulary URI to mapped store path
+    '''
+    for uri, path in paths.items():
+        controlled_vocabulary.obo_cache.set_resolver(
+            uri, controlled_vocabulary.MappedVocabularyResolver(path))
 
 
 def _make_tag_type(name, **attrs):
@@ -362,15 +438,197 @@ class VocabularyResolver(object):
             raise KeyError(name)
 
 
+class ResolvedModification(object):
+    '''
+    The parts of a Unimod modification needed to describe it in a document,
+    resolved once per document by :meth:`DocumentContext.modification`.
+
+    Attributes
+    ----------
+    accession: str
+        The Unimod accession, e.g. "UNIMOD:4"
+    name: str
+        The PSI-MS name of the modification, e.g. "Carbamidomethyl"
+    monoisotopic_mass: float
+    average_mass: float
+    specificities: tuple of :class:`~.SpecificityRecord`
+    param: CVParam
+        The cvParam naming the modification, shared by every component
+        which refers to it
+    '''
+    __slots__ = ("accession", "name", "monoisotopic_mass", "average_mass", "specificities", "param")
+
+    def __init__(self, accession, name, monoisotopic_mass, average_mass, specificities=()):
+        self.accession = accession
+        self.name = name
+        self.monoisotopic_mass = monoisotopic_mass
+        self.average_mass = average_mass
+        self.specificities = tuple(specificities)
+        self.param = CVParam(accession=accession, name=name, ref="UNIMOD")
+
+    def specificities_for(self, residue=None, position=None, include_hidden=False):
+        '''
+        Select the specificities at `residue` and `position`.
+
+        Parameters
+        ----------
+        residue: str, optional
+        position: str, optional
+            A Unimod position, e.g. "Anywhere" or "Protein N-term"
+        include_hidden: bool
+            Whether to include specificities Unimod hides by default
+
+        Returns
+        -------
+        list of :class:`~.SpecificityRecord`
+        '''
+        return [
+            spec for spec in self.specificities
+            if (residue is None or spec.residue == residue) and
+            (position is None or spec.position == position) and
+            (include_hidden or not spec.hidden)
+        ]
+
+    def __repr__(self):
+        return "ResolvedModification(%r, %r, %r)" % (self.accession, self.name, self.monoisotopic_mass)
+
+
 class DocumentContext(dict, VocabularyResolver):
     def __init__(self, vocabularies=None):
         dict.__init__(self)
         VocabularyResolver.__init__(self, vocabularies)
+        self._modifications = {}
+        self._interned = {}
+        self._intern_counts = {}
+        self._aliases = {}
+        self.evidence_index = None
 
     def __missing__(self, key):
         self[key] = SpecializedContextCache(key)
         return self[key]
 
+    def vocabulary(self, cv_id):
+        '''
+        Get the loaded vocabulary of the :class:`CV` whose id is `cv_id`.
+
+        Raises
+        ------
+        KeyError
+        '''
+        for cv in self.vocabularies:
+            if cv.id == cv_id:
+                return cv.vocabulary
+        raise KeyError(cv_id)
+
+    def modification(self, name):
+        '''
+        Resolve a modification name or Unimod id to a :class:`ResolvedModification`.
+
+        Each distinct `name` is looked up in the UNIMOD vocabulary only once per
+        document, after which it is answered from a dictionary.
+
+        Parameters
+        ----------
+        name: str or int
+
+        Returns
+        -------
+        ResolvedModification
+
+        Raises
+        ------
+        KeyError
+        '''
+        try:
+            return self._modifications[name]
+        except KeyError:
+            unimod = self.vocabulary("UNIMOD")
+            mod = unimod.get(name)
+            # The PSI-MS name of a Unimod modification is its extended code
+            # name, which only some older entries lack
+            resolved = ResolvedModification(
+                "UNIMOD:%d" % mod.id, mod.ex_code_name or mod.code_name,
+                mod.monoisotopic_mass, mod.average_mass,
+                unimod.specificity_index.get(mod.id, ()))
+            self._modifications[name] = resolved
+            return resolved
+
+    def intern(self, type_name, key, id):
+        '''
+        Deduplicate an entity of type `type_name` by its content.
+
+        The first entity seen with a given `key` is canonical. Later entities
+        with the same `key` are not written, and their `id` is made to refer
+        to the canonical entity's element instead, so references to either id
+        resolve to the same element.
+
+        Parameters
+        ----------
+        type_name: str
+        key: hashable
+            A description of the entity's content
+        id: int
+
+        Returns
+        -------
+        bool
+            Whether this is the first entity with `key`, which should be written
+        '''
+        table = self._interned.get(type_name)
+        if table is None:
+            table = self._interned[type_name] = {}
+            self._intern_counts[type_name] = 0
+        self._intern_counts[type_name] += 1
+        canonical = table.get(key)
+        if canonical is None:
+            table[key] = id
+            return True
+        if canonical != id:
+            self[type_name][id] = self[type_name][canonical]
+            self._aliases.setdefault(type_name, {})[id] = canonical
+        return False
+
+    def track_evidence(self):
+        '''
+        Record the PeptideEvidence and SpectrumIdentificationItems created from
+        now on in :attr:`evidence_index`, which protein inference and decoy
+        lookups need. Nothing is recorded unless this is called.
+
+        Returns
+        -------
+        :class:`~.protein_grouping.EvidenceIndex`
+        '''
+        if self is NullMap:
+            raise ValueError("Evidence cannot be tracked in the shared NullMap context")
+        if self.evidence_index is None:
+            self.evidence_index = EvidenceIndex()
+        return self.evidence_index
+
+    def canonical_id(self, type_name, id):
+        '''
+        The id of the entity written in place of `id` by :meth:`intern`,
+        or `id` itself if it was not a duplicate.
+        '''
+        return self._aliases.get(type_name, {}).get(id, id)
+
+    def deduplication_stats(self):
+        '''
+        Summarize the entities passed through :meth:`intern`.
+
+        Returns
+        -------
+        dict
+            For each type name, a dict with the number of entities `seen`, the
+            number of `unique` entities written and their `ratio`
+        '''
+        stats = {}
+        for type_name, table in self._interned.items():
+            seen = self._intern_counts[type_name]
+            stats[type_name] = {
+                "seen": seen, "unique": len(table),
+                "ratio": float(seen) / len(table) if table else 1.0}
+        return stats
+
 NullMap = DocumentContext()
 
 
@@ -566,26 +824,73 @@ class Inputs(GenericCollection):
 
 
 class DBSequence(ComponentBase):
-    def __init__(self, accession, sequence, id, search_database_id=1, context=NullMap):
+    """
+    A protein sequence from a search database.
+
+    The sequence may be given directly, or read from `source`, a
+    :class:`~.fasta.FastaFile`, in which case only its length is looked
+    up until the sequence is written.
+    """
+    def __init__(self, accession, sequence=None, id=None, search_database_id=1, source=None, context=NullMap):
+        if sequence is None:
+            if source is None:
+                raise ValueError("Either a sequence or a source is required for %r" % (accession,))
+            length = source.length(accession)
+        else:
+            length = len(sequence)
+        self.accession = accession
         self.sequence = sequence
+        self.source = source
         self.search_database_ref = context['SearchDatabase'][search_database_id]
         self.element = _element(
             "DBSequence", accession=accession, id=id,
-            length=len(sequence), searchDatabase_ref=self.search_database_ref)
+            length=length, searchDatabase_ref=self.search_database_ref)
 
         context["DBSequence"][id] = self.element.id
 
     def write(self, xml_file):
         protein = self.sequence
+        if protein is None:
+            protein = self.source.sequence(self.accession)
         with self.element.element(xml_file, with_id=True):
             with element(xml_file, "Seq"):
                 xml_file.write(protein)
 
 
+class Modification(ComponentBase):
+    def __init__(self, name, location, residues=None, mass_delta=None, average_mass_delta=None,
+                 context=NullMap):
+        try:
+            resolved = context.modification(name)
+            self.param = resolved.param
+            if mass_delta is None:
+                mass_delta = resolved.monoisotopic_mass
+            if average_mass_delta is None:
+                average_mass_delta = resolved.average_mass
+        except KeyError:
+            if mass_delta is None:
+                raise ValueError("A mass delta is required for %r, which is not in UNIMOD" % (name,))
+            self.param = context.param(name)
+        self.monoisotopic_mass_delta = mass_delta
+        self.average_mass_delta = average_mass_delta
+        attrs = {"location": location, "monoisotopicMassDelta": mass_delta}
+        if residues is not None:
+            attrs["residues"] = residues if isinstance(residues, basestring) else " ".join(residues)
+        if average_mass_delta is not None:
+            attrs["avgMassDelta"] = average_mass_delta
+        self.element = _element("Modification", **attrs)
+
+    def write(self, xml_file):
+        with self.element.element(xml_file):
+            self.param.write(xml_file)
+
+
 class Peptide(ComponentBase):
     def __init__(self, peptide_sequence, id, modifications=tuple(), context=NullMap):
         self.peptide_sequence = peptide_sequence
-        self.modifications = modifications
+        self.modifications = [
+            Modification(context=context, **mod) if isinstance(mod, Mapping) else mod
+            for mod in modifications]
         self.element = _element("Peptide", id=id)
         context["Peptide"][id] = self.element.id
 
@@ -608,6 +913,11 @@ class PeptideEvidence(ComponentBase):
             dBSequence_ref=context['DBSequence'][db_sequence_id],
             pre=pre, post=post, id=id)
         context["PeptideEvidence"][id] = self.element.id
+        if context.evidence_index is not None:
+            # Duplicate Peptides removed by DocumentContext.intern must count as
+            # the one peptide they were written as
+            context.evidence_index.add_evidence(
+                id, context.canonical_id("Peptide", peptide_id), db_sequence_id, is_decoy)
 
     def write(self, xml_file):
         xml_file.write(self.element(with_id=True))
@@ -636,10 +946,13 @@ class SpectrumIdentificationItem(ComponentBase):
 
         self.element = _element(
             "SpectrumIdentificationItem", calculatedMassToCharge=calculated_mass_to_charge, chargeState=charge_state,
-            experimentalMassToCharge=experimental_mass_to_charge, id=id, passThreshold=pass_threshold,
-            peptide_ref=context['Peptide'][peptide_id]
+            experimentalMassToCharge=experimental_mass_to_charge, id=id,
+            passThreshold="true" if pass_threshold else "false", peptide_ref=context['Peptide'][peptide_id]
             )
         context['SpectrumIdentificationItem'][id] = self.element.id
+        if context.evidence_index is not None:
+            context.evidence_index.add_identification(
+                context.canonical_id("PeptideEvidence", peptide_evidence_id), id)
         self.context = context
 
     def write(self, xml_file):
@@ -670,6 +983,68 @@ class AnalysisData(GenericCollection):
         super(AnalysisData, self).__init__("AnalysisData", items, context)
 
 
+class ProteinDetectionHypothesis(ComponentBase):
+    """
+    A protein inferred from the PeptideEvidence of its DBSequence.
+
+    Parameters
+    ----------
+    db_sequence_id: int
+    peptide_hypotheses: iterable of dict
+        Each with a `peptide_evidence_id` and the `spectrum_identification_item_ids`
+        supporting it
+    pass_threshold: bool
+    cv_params: iterable
+    """
+    def __init__(self, id, db_sequence_id, peptide_hypotheses=tuple(), pass_threshold=True,
+                 cv_params=tuple(), context=NullMap):
+        self.peptide_hypotheses = [
+            (context["PeptideEvidence"][hypothesis["peptide_evidence_id"]],
+             [context["SpectrumIdentificationItem"][item_id]
+              for item_id in hypothesis.get("spectrum_identification_item_ids", ())])
+            for hypothesis in peptide_hypotheses]
+        self.cv_params = cv_params
+        self.context = context
+        self.element = _element(
+            "ProteinDetectionHypothesis", id=id, dBSequence_ref=context["DBSequence"][db_sequence_id],
+            passThreshold="true" if pass_threshold else "false")
+        context["ProteinDetectionHypothesis"][id] = self.element.id
+
+    def write(self, xml_file):
+        with self.element.element(xml_file, with_id=True):
+            for evidence_ref, item_refs in self.peptide_hypotheses:
+                with element(xml_file, "PeptideHypothesis", peptideEvidence_ref=evidence_ref):
+                    for item_ref in item_refs:
+                        _element("SpectrumIdentificationItemRef",
+                                 spectrumIdentificationItem_ref=item_ref).write(xml_file)
+            for cvp in self.cv_params:
+                self.context.param(cvp)(xml_file)
+
+
+class ProteinAmbiguityGroup(ComponentBase):
+    def __init__(self, id, protein_detection_hypotheses=tuple(), cv_params=tuple(), context=NullMap):
+        self.protein_detection_hypotheses = [
+            ProteinDetectionHypothesis(context=context, **hypothesis) if isinstance(hypothesis, Mapping)
+            else hypothesis for hypothesis in protein_detection_hypotheses]
+        self.cv_params = cv_params
+        self.context = context
+        self.element = _element("ProteinAmbiguityGroup", id=id)
+        context["ProteinAmbiguityGroup"][id] = self.element.id
+
+    def write(self, xml_file):
+        with self.element.element(xml_file, with_id=True):
+            for hypothesis in self.protein_detection_hypotheses:
+                hypothesis.write(xml_file)
+            for cvp in self.cv_params:
+                self.context.param(cvp)(xml_file)
+
+
+class ProteinDetectionList(IDGenericCollection):
+    def __init__(self, protein_ambiguity_groups, id, context=NullMap):
+        super(ProteinDetectionList, self).__init__(
+            "ProteinDetectionList", protein_ambiguity_groups, id, context=context)
+
+
 # --------------------------------------------------
 # Meta-collections
 
@@ -768,6 +1143,55 @@ class Threshold(ComponentBase):
             self.context.param(self.name)(xml_file)
 
 
+_specificity_rules = {
+    "Any N-term": CVParam(
+        accession="MS:1001189", ref="PSI-MS", name="modification specificity peptide N-term"),
+    "Any C-term": CVParam(
+        accession="MS:1001190", ref="PSI-MS", name="modification specificity peptide C-term"),
+    "Protein N-term": CVParam(
+        accession="MS:1002057", ref="PSI-MS", name="modification specificity protein N-term"),
+    "Protein C-term": CVParam(
+        accession="MS:1002058", ref="PSI-MS", name="modification specificity protein C-term"),
+}
+
+_terminal_residues = ("N-term", "C-term")
+
+
+class SearchModification(ComponentBase):
+    def __init__(self, name, fixed=True, residues=None, position=None, mass_delta=None, context=NullMap):
+        try:
+            resolved = context.modification(name)
+            self.param = resolved.param
+        except KeyError:
+            resolved = None
+            self.param = context.param(name)
+        if mass_delta is None:
+            if resolved is None:
+                raise ValueError("A mass delta is required for %r, which is not in UNIMOD" % (name,))
+            mass_delta = resolved.monoisotopic_mass
+        if residues is None:
+            if resolved is not None:
+                residues = set()
+                for spec in resolved.specificities_for(position=position):
+                    residues.add("." if spec.residue in _terminal_residues else spec.residue)
+            if not residues:
+                residues = "."
+        if not isinstance(residues, basestring):
+            residues = " ".join(sorted(residues))
+        self.position = position
+        self.specificity_rule = _specificity_rules.get(position)
+        self.element = _element(
+            "SearchModification", fixedMod=str(bool(fixed)).lower(), massDelta=mass_delta,
+            residues=residues)
+
+    def write(self, xml_file):
+        with self.element.element(xml_file):
+            if self.specificity_rule is not None:
+                with element(xml_file, "SpecificityRules"):
+                    self.specificity_rule.write(xml_file)
+            self.param.write(xml_file)
+
+
 class SpectrumIdentificationProtocol(ComponentBase):
     def __init__(self, search_type, analysis_software_id=1, id=1, additional_search_params=tuple(),
                  modification_params=tuple(), enzymes=tuple(), fragment_tolerance=None, parent_tolerance=None,
@@ -795,7 +1219,7 @@ class SpectrumIdentificationProtocol(ComponentBase):
                 self.context.param(self.search_type)(xml_file)
             with element(xml_file, "AdditionalSearchParams"):
                 for search_param in self.additional_search_params:
-                    self.contex.param(search_param)(xml_file)
+                    self.context.param(search_param)(xml_file)
             with element(xml_file, "ModificationParams"):
                 for mod in self.modification_params:
                     mod.write(xml_file)
@@ -814,6 +1238,7 @@ class ProteinDetectionProtocol(ComponentBase):
         if threshold is None:
             threshold = Threshold(context=context)
         self.analysis_software_id = analysis_software_id
+        self.threshold = threshold
         self.element = _element(
             "ProteinDetectionProtocol", id=id,
             analysisSoftware_ref=context["AnalysisSoftware"][analysis_software_id])
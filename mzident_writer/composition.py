@@ -0,0 +1,346 @@
+'''
+An elemental composition type which stores its counts in fixed slots.
+
+Every element or isotope name is assigned a slot number the first time it is
+seen, shared by all :class:`Composition` instances, so each composition is
+a plain list of counts indexed by slot. Adding, scaling and calculating the
+mass of compositions then walks two short lists instead of hashing element
+names. Isotopes are named like `C[13]`, as produced by :func:`_make_isotope_string`.
+'''
+import threading
+
+from operator import add
+
+from .utils import _numpy
+
+
+_slot_index = {}
+_slot_names = []
+_monoisotopic_masses = []
+_average_masses = []
+# Guards adding slots, since Unimod, and so composition parsing, is shared
+# between threads. Existing slots are read without it
+_slot_lock = threading.Lock()
+
+
+def _make_isotope_string(element, isotope):
+    '''
+    Name the isotope of `element` with mass number `isotope`, e.g. `C[13]`.
+
+    Parameters
+    ----------
+    element: str
+    isotope: int
+
+    Returns
+    -------
+    str
+    '''
+    if isotope == 0:
+        return element
+    return "%s[%d]" % (element, isotope)
+
+
+def _add_slot(name):
+    # Must be called holding _slot_lock
+    slot = _slot_index.get(name)
+    if slot is None:
+        slot = len(_slot_names)
+        _slot_names.append(name)
+        _monoisotopic_masses.append(None)
+        _average_masses.append(None)
+        # Published last, so readers not holding the lock never find a slot
+        # whose name and masses are missing
+        _slot_index[name] = slot
+    return slot
+
+
+def _slot(name):
+    try:
+        return _slot_index[name]
+    except KeyError:
+        with _slot_lock:
+            return _add_slot(name)
+
+
+def register_element(name, monoisotopic_mass, average_mass=None, replace=False):
+    '''
+    Record the masses of the element or isotope `name` for :meth:`Composition.mass`.
+
+    Parameters
+    ----------
+    name: str
+    monoisotopic_mass: float
+    average_mass: float, optional
+        Defaults to `monoisotopic_mass`
+    replace: bool
+        Whether to overwrite masses already registered for `name`
+    '''
+    with _slot_lock:
+        slot = _add_slot(name)
+        if _monoisotopic_masses[slot] is None or replace:
+            _monoisotopic_masses[slot] = monoisotopic_mass
+            _average_masses[slot] = average_mass if average_mass is not None else monoisotopic_mass
+
+
+for _name, _mono, _avg in (
+        ("H", 1.00782503207, 1.00794),
+        ("C", 12.0, 12.0107),
+        ("N", 14.0030740048, 14.0067),
+        ("O", 15.99491461956, 15.9994),
+        ("S", 31.97207100, 32.065),
+        ("P", 30.97376163, 30.973762),
+        ("Na", 22.9897692809, 22.98976928),
+        ("K", 38.96370668, 39.0983),
+        ("Fe", 55.9349375, 55.845),
+        ("Se", 79.9165213, 78.96),
+        (_make_isotope_string("H", 2), 2.0141017778, 2.0141017778),
+        (_make_isotope_string("C", 13), 13.0033548378, 13.0033548378),
+        (_make_isotope_string("N", 15), 15.0001088982, 15.0001088982),
+        (_make_isotope_string("O", 18), 17.9991610, 17.9991610)):
+    register_element(_name, _mono, _avg)
+
+
+class Composition(object):
+    '''
+    A mapping from element name to count.
+
+    Missing elements count as zero. Compositions support `+`, `-`, `*` by an
+    integer and their in-place forms, compare equal to any mapping with the
+    same non-zero counts, and can calculate their :meth:`mass`.
+    '''
+    __slots__ = ("_counts",)
+
+    def __init__(self, *args, **kwargs):
+        self._counts = []
+        if args or kwargs:
+            for name, count in dict(*args, **kwargs).items():
+                self[name] = count
+
+    @classmethod
+    def _from_counts(cls, counts):
+        inst = cls.__new__(cls)
+        inst._counts = counts
+        return inst
+
+    def __getitem__(self, name):
+        slot = _slot_index.get(name)
+        if slot is None or slot >= len(self._counts):
+            return 0
+        return self._counts[slot]
+
+    def __setitem__(self, name, count):
+        slot = _slot(name)
+        counts = self._counts
+        if slot >= len(counts):
+            counts.extend([0] * (slot + 1 - len(counts)))
+        counts[slot] = count
+
+    def __delitem__(self, name):
+        self[name] = 0
+
+    def get(self, name, default=0):
+        count = self[name]
+        return count if count else default
+
+    def __contains__(self, name):
+        return self[name] != 0
+
+    def __iter__(self):
+        return (_slot_names[slot] for slot, count in enumerate(self._counts) if count)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [count for count in self._counts if count]
+
+    def items(self):
+        return [(_slot_names[slot], count) for slot, count in enumerate(self._counts) if count]
+
+    def __len__(self):
+        return sum(1 for count in self._counts if count)
+
+    def copy(self):
+        return self._from_counts(list(self._counts))
+
+    def add(self, other, scale=1):
+        '''
+        Add `other` multiplied by `scale` to this composition in place.
+
+        Parameters
+        ----------
+        other: Composition
+        scale: int
+
+        Returns
+        -------
+        Composition
+            This composition
+        '''
+        if not isinstance(other, Composition):
+            other = Composition(other)
+        counts = self._counts
+        other_counts = other._counts
+        if len(counts) < len(other_counts):
+            counts.extend([0] * (len(other_counts) - len(counts)))
+        for slot, count in enumerate(other_counts):
+            if count:
+                counts[slot] += count * scale
+        return self
+
+    def __iadd__(self, other):
+        return self.add(other)
+
+    def __isub__(self, other):
+        return self.add(other, -1)
+
+    def __add__(self, other):
+        return self.copy().add(other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self.copy().add(other, -1)
+
+    def __mul__(self, scale):
+        return self._from_counts([count * scale for count in self._counts])
+
+    __rmul__ = __mul__
+
+    def __imul__(self, scale):
+        self._counts = [count * scale for count in self._counts]
+        return self
+
+    def __neg__(self):
+        return self * -1
+
+    def mass(self, average=False):
+        '''
+        Calculate the mass of this composition.
+
+        Parameters
+        ----------
+        average: bool
+            Use average rather than monoisotopic element masses
+
+        Returns
+        -------
+        float
+
+        Raises
+        ------
+        KeyError
+            If no mass has been registered for one of the elements
+        '''
+        masses = _average_masses if average else _monoisotopic_masses
+        total = 0.0
+        for slot, count in enumerate(self._counts):
+            if count:
+                mass = masses[slot]
+                if mass is None:
+                    raise KeyError(_slot_names[slot])
+                total += mass * count
+        return total
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict((k, v) for k, v in other.items() if v)
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        # Slot numbers differ between processes, so pickle element names
+        return (dict(self.items()),)
+
+    def __setstate__(self, state):
+        self._counts = []
+        for name, count in state[0].items():
+            self[name] = count
+
+    def __repr__(self):
+        return "Composition(%r)" % (dict(self.items()),)
+
+
+def sum_compositions(compositions, scales=None):
+    '''
+    Sum many compositions at once, optionally multiplying each by a scale.
+
+    Parameters
+    ----------
+    compositions: iterable of Composition
+    scales: iterable of int, optional
+
+    Returns
+    -------
+    Composition
+    '''
+    totals = []
+    if scales is None:
+        for composition in compositions:
+            counts = composition._counts
+            if len(totals) < len(counts):
+                totals.extend([0] * (len(counts) - len(totals)))
+            totals[:len(counts)] = map(add, totals[:len(counts)], counts)
+    else:
+        for composition, scale in zip(compositions, scales):
+            counts = composition._counts
+            if len(totals) < len(counts):
+                totals.extend([0] * (len(counts) - len(totals)))
+            for slot, count in enumerate(counts):
+                if count:
+                    totals[slot] += count * scale
+    return Composition._from_counts(totals)
+
+
+def composition_matrix(compositions):
+    '''
+    Arrange the counts of many compositions as the rows of an array whose
+    columns are element slots. Requires NumPy.
+
+    Parameters
+    ----------
+    compositions: sequence of Composition
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    np = _numpy("composition_matrix")
+    matrix = np.zeros((len(compositions), len(_slot_names)), dtype=np.int64)
+    for row, composition in enumerate(compositions):
+        counts = composition._counts
+        matrix[row, :len(counts)] = counts
+    return matrix
+
+
+def masses(compositions, average=False):
+    '''
+    Calculate the mass of many compositions at once. Requires NumPy.
+
+    Parameters
+    ----------
+    compositions: sequence of Composition
+    average: bool
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    np = _numpy("masses")
+    matrix = composition_matrix(compositions)
+    element_masses = _average_masses if average else _monoisotopic_masses
+    used = matrix.any(axis=0)
+    for slot in np.flatnonzero(used):
+        if element_masses[slot] is None:
+            raise KeyError(_slot_names[slot])
+    mass_vector = np.array([mass or 0.0 for mass in element_masses], dtype=float)
+    return matrix.dot(mass_vector)
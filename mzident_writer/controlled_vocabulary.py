@@ -1,9 +1,15 @@
 import os
 import re
+import mmap
+import struct
+import hashlib
 
-from collections import defaultdict
-from urllib2 import urlopen
-from . import unimod
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import unimod_snapshot
 
 
 class Reference(object):
@@ -28,11 +34,14 @@ class Reference(object):
 
     @classmethod
     def fromstring(cls, string):
-        try:
-            accession, comment = map(lambda s: s.strip(), string.split("!"))
-            return cls(accession, comment)
-        except:
-            return cls(string)
+        accession, sep, comment = string.partition("!")
+        if sep:
+            return cls(accession.strip(), comment.strip())
+        return cls(string.strip())
+
+
+_relationship_pattern = re.compile(
+    r"(?P<predicate>\S+?):?\s+(?P<accession>\S+)(?:\s+!\s*(?P<comment>.*))?")
 
 
 class Relationship(object):
@@ -58,61 +67,116 @@ class Relationship(object):
 
     @classmethod
     def fromstring(cls, string):
-        groups = re.search(r"(?P<predicate>\S+):?\s(?P<accession>\S+)\s(?:!\s(?P<comment>.*))", string).groupdict()
-        return cls(**groups)
+        match = _relationship_pattern.match(string)
+        if match is None:
+            raise ValueError("Could not parse relationship %r" % (string,))
+        return cls(*match.groups())
+
+
+def _pack_term(term, references=None, relationships=None):
+    # `references` and `relationships` map each value string already seen to
+    # the object parsed from it. Most terms point at the same few parents and
+    # predicates, so sharing them skips re-parsing and duplicate objects.
+    if references is None:
+        references = {}
+    if relationships is None:
+        relationships = {}
+    is_as = term.get('is_a')
+    if is_as is not None:
+        if not isinstance(is_as, list):
+            is_as = [is_as]
+        refs = []
+        for is_a in is_as:
+            ref = references.get(is_a)
+            if ref is None:
+                ref = references[is_a] = Reference.fromstring(is_a)
+            refs.append(ref)
+        term['is_a'] = refs if len(refs) > 1 else refs[0]
+    rels = term.get('relationship')
+    if rels is not None:
+        if not isinstance(rels, list):
+            rels = [rels]
+        for string in rels:
+            rel = relationships.get(string)
+            if rel is None:
+                rel = relationships[string] = Relationship.fromstring(string)
+            term[rel.predicate] = rel
+    return term
+
+
+def iterparse_obo(handle, tags=None):
+    '''
+    Incrementally parse the `[Term]` stanzas of an OBO file, yielding each
+    term as soon as it is complete. All other stanza types are skipped.
+
+    Tags which occur once in a term map to their value string, and tags which
+    occur more than once map to a list of value strings. `is_a` values are
+    converted into :class:`Reference` instances, and each `relationship` value
+    is also stored under its predicate as a :class:`Relationship`. Terms with
+    the same `is_a` or `relationship` value share one parsed object.
+
+    Parameters
+    ----------
+    handle: file
+        An iterable over the lines of an OBO file
+    tags: set, optional
+        If provided, only these tags are kept. `id` and `name` are always kept.
+
+    Yields
+    ------
+    dict
+    '''
+    if tags is not None:
+        tags = frozenset(tags) | frozenset(("id", "name"))
+    references = {}
+    relationships = {}
+    term = None
+    for line in handle:
+        if line[:1] == "[":
+            if term is not None:
+                yield _pack_term(term, references, relationships)
+            term = {} if line.startswith("[Term]") else None
+            continue
+        elif term is None:
+            continue
+        key, sep, val = line.partition(":")
+        if not sep or (tags is not None and key not in tags):
+            continue
+        val = val.strip()
+        existing = term.get(key)
+        if existing is None:
+            term[key] = val
+        elif existing.__class__ is list:
+            existing.append(val)
+        else:
+            term[key] = [existing, val]
+    if term is not None:
+        yield _pack_term(term, references, relationships)
 
 
 class OBOParser(object):
-    def __init__(self, handle):
+    def __init__(self, handle, tags=None):
         self.handle = handle
+        self.tags = tags
         self.terms = {}
         self.current_term = None
         self.parse()
 
     def pack(self):
+        '''
+        Add :attr:`current_term`, a mapping from each tag to the list of its
+        values, to :attr:`terms` as :func:`iterparse_obo` would have produced it.
+        '''
         if self.current_term is None:
             return
-        entity = {k: v[0] if len(v) == 1 else v for k, v in self.current_term.items()}
-        try:
-            is_as = entity['is_a']
-            if isinstance(is_as, basestring):
-                is_as = Reference.fromstring(is_as)
-            else:
-                is_as = map(Reference.fromstring, is_as)
-            entity['is_a'] = is_as
-        except KeyError:
-            pass
-        try:
-            relationships = entity['relationship']
-            if not isinstance(relationships, list):
-                relationships = [relationships]
-            relationships = [Relationship.fromstring(r) for r in relationships]
-            for rel in relationships:
-                entity[rel.predicate] = rel
-        except KeyError:
-            pass
-        self.terms[entity['id']] = entity
+        term = _pack_term({k: v[0] if len(v) == 1 else list(v) for k, v in self.current_term.items()})
+        self.terms[term['id']] = term
         self.current_term = None
 
     def parse(self):
-        for line in self.handle:
-            line = line.strip()
-            if not line:
-                continue
-            elif line == "[Typedef]":
-                if self.current_term is not None:
-                    self.pack()
-                self.current_term = None
-            elif line == "[Term]":
-                if self.current_term is not None:
-                    self.pack()
-                self.current_term = defaultdict(list)
-            else:
-                if self.current_term is None:
-                    continue
-                key, sep, val = line.partition(":")
-                self.current_term[key].append(val.strip())
-        self.pack()
+        terms = self.terms
+        for term in iterparse_obo(self.handle, self.tags):
+            terms[term['id']] = term
 
     def __getitem__(self, key):
         return self.terms[key]
@@ -123,8 +187,8 @@ class OBOParser(object):
 
 class ControlledVocabulary(object):
     @classmethod
-    def from_obo(cls, handle):
-        parser = OBOParser(handle)
+    def from_obo(cls, handle, tags=None):
+        parser = OBOParser(handle, tags)
         return cls(parser.terms)
 
     def __init__(self, terms, id=None):
@@ -166,6 +230,172 @@ class ControlledVocabulary(object):
         return self._normalized[name.lower()]
 
 
+def _key_hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode("utf8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+class MappedVocabulary(object):
+    '''
+    A read-only, memory-mapped view of a :class:`ControlledVocabulary`.
+
+    The backing file holds a header with the number of terms, then every term
+    as a pickled record followed by a table of `(key hash, record offset)`
+    pairs sorted by hash, covering each term's id, name and lower-cased name.
+    Lookups binary search the mapped table and unpickle only the matched
+    record, so any number of processes can attach to the same file and share
+    its pages through the OS page cache instead of each holding their own copy
+    of the vocabulary.
+
+    Use :meth:`build` once in the parent process, then construct instances
+    from the resulting path in each worker.
+
+    Attributes
+    ----------
+    path : str
+        The path to the backing file
+    id : str
+        The identifier of the controlled vocabulary, set by its :class:`CV`
+    '''
+    magic = b"MZCV"
+    version = 2
+
+    _header = struct.Struct("<4sIQQQ")
+    _entry = struct.Struct("<QQ")
+    _length = struct.Struct("<I")
+
+    def __init__(self, path, id=None):
+        self.path = path
+        self.id = id
+        with open(path, 'rb') as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, table_offset, term_count = self._header.unpack_from(self._map, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError("%s is not a version %d mapped vocabulary" % (path, self.version))
+        self._count = count
+        self._table_offset = table_offset
+        self._term_count = term_count
+
+    @classmethod
+    def build(cls, vocabulary, path):
+        '''
+        Write `vocabulary` to `path` in the mapped format and attach to it.
+
+        Parameters
+        ----------
+        vocabulary : ControlledVocabulary
+        path : str
+
+        Returns
+        -------
+        MappedVocabulary
+        '''
+        entries = []
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as handle:
+            handle.write(cls._header.pack(cls.magic, cls.version, 0, 0, 0))
+            for term in vocabulary.terms.values():
+                offset = handle.tell()
+                payload = pickle.dumps(term, 2)
+                handle.write(cls._length.pack(len(payload)))
+                handle.write(payload)
+                keys = set((term['id'], term['name'], term['name'].lower()))
+                entries.extend((_key_hash(key), offset) for key in keys)
+            entries.sort()
+            table_offset = handle.tell()
+            for entry in entries:
+                handle.write(cls._entry.pack(*entry))
+            handle.seek(0)
+            handle.write(cls._header.pack(
+                cls.magic, cls.version, len(entries), table_offset, len(vocabulary.terms)))
+        os.rename(tmp_path, path)
+        return cls(path, vocabulary.id)
+
+    def _record(self, offset):
+        length, = self._length.unpack_from(self._map, offset)
+        start = offset + self._length.size
+        return pickle.loads(self._map[start:start + length])
+
+    def _candidates(self, key):
+        key_hash = _key_hash(key)
+        lo = 0
+        hi = self._count
+        entry = self._entry
+        base = self._table_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry.unpack_from(self._map, base + mid * entry.size)[0] < key_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self._count:
+            found_hash, offset = entry.unpack_from(self._map, base + lo * entry.size)
+            if found_hash != key_hash:
+                break
+            yield self._record(offset)
+            lo += 1
+
+    def __getitem__(self, key):
+        for term in self._candidates(key):
+            if term['id'] == key or term['name'] == key:
+                return term
+        normalized = key.lower()
+        for term in self._candidates(normalized):
+            if term['name'].lower() == normalized:
+                return term
+        raise KeyError(key)
+
+    def __len__(self):
+        return self._term_count
+
+    def _terms(self):
+        offset = self._header.size
+        while offset < self._table_offset:
+            length, = self._length.unpack_from(self._map, offset)
+            yield self._record(offset)
+            offset += self._length.size + length
+
+    def __iter__(self):
+        return (term['id'] for term in self._terms())
+
+    def keys(self):
+        return list(self)
+
+    def names(self):
+        return [term['name'] for term in self._terms()]
+
+    def items(self):
+        return [(term['id'], term) for term in self._terms()]
+
+    def close(self):
+        self._map.close()
+
+    def __getstate__(self):
+        return {"path": self.path, "id": self.id}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['id'])
+
+    def __repr__(self):
+        return "MappedVocabulary(%r, id=%r)" % (self.path, self.id)
+
+
+class MappedVocabularyResolver(object):
+    '''
+    An :class:`OBOCache` resolver which attaches to a :class:`MappedVocabulary`
+    at `path` instead of fetching and parsing an OBO file.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, cache):
+        return MappedVocabulary(self.path)
+
+    def __repr__(self):
+        return "MappedVocabularyResolver(%r)" % (self.path,)
+
+
 class OBOCache(object):
     def __init__(self, cache_path='.obo_cache', enabled=True, resolvers=None):
         self.cache_path = cache_path
@@ -175,7 +405,12 @@ class OBOCache(object):
 
     def path_for(self, name, setext=True):
         if not self.cache_exists:
-            os.makedirs(self.cache_path)
+            try:
+                os.makedirs(self.cache_path)
+            except OSError:
+                # Another thread may have created the cache directory first
+                if not os.path.isdir(self.cache_path):
+                    raise
             self.cache_exists = True
         name = os.path.basename(name)
         if not name.endswith(".obo") and setext:
@@ -185,6 +420,9 @@ class OBOCache(object):
     def resolve(self, uri):
         if uri in self.resolvers:
             return self.resolvers[uri](self)
+        # urllib2 pulls in the socket and SSL stacks, so only import it
+        # when a vocabulary actually has to be fetched
+        from urllib2 import urlopen
         if self.enabled:
             name = self.path_for(uri)
             if os.path.exists(name):
@@ -212,13 +450,38 @@ def _make_relative_sqlite_sqlalchemy_uri(path):
     return "sqlite:///%s" % path
 
 
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
 def resolve_unimod(cache):
+    # The snapshot is loaded without importing SQLAlchemy. It is exported
+    # from the full database the first time Unimod is resolved, and again
+    # whenever that database has changed since. Without a cache, the
+    # downloaded database is copied into a snapshot held in memory, so
+    # both branches return a UnimodSnapshot.
     if cache.enabled:
-        path = _make_relative_sqlite_sqlalchemy_uri(
-            cache.path_for("unimod.db", False))
-        return unimod.Unimod(path)
+        snapshot_path = cache.path_for("unimod.snapshot", False)
+        db_path = cache.path_for("unimod.db", False)
+        source = _file_stamp(db_path)
+        if source is not None and os.path.exists(snapshot_path):
+            try:
+                snapshot = unimod_snapshot.UnimodSnapshot(snapshot_path)
+            except ValueError:
+                snapshot = None
+            if snapshot is not None and snapshot.source == source:
+                return snapshot
+        from . import unimod
+        db = unimod.Unimod(_make_relative_sqlite_sqlalchemy_uri(db_path))
+        db.export_snapshot(snapshot_path, _file_stamp(db_path))
+        return unimod_snapshot.UnimodSnapshot(snapshot_path)
     else:
-        return unimod.Unimod()
+        from . import unimod
+        return unimod_snapshot.UnimodSnapshot.from_records(unimod.Unimod().records())
 
 
 obo_cache = OBOCache()
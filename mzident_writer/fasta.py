@@ -0,0 +1,449 @@
+'''
+Random access to the sequences of a FASTA file without loading it.
+
+The file is memory-mapped, and each record's position is kept in an index
+stored next to the FASTA file in the `.fai` format used by `samtools faidx`,
+with one line per record holding its accession, sequence length, byte offset
+of the sequence, residues per line and bytes per line. The index is built the
+first time a file is opened and reused afterwards while it is newer than the
+FASTA file. It is memory-mapped in turn, so no Python object is kept per
+record. Beside it, a `.lines` table holds the byte offset of each line of the
+index as a fixed-width little-endian integer, so that any record's line is
+found without scanning the index.
+
+Accessions are the first whitespace-delimited word of each header line. When
+DBSequences are drawn from a :class:`FastaFile`, the DBSequence id of a record
+is its position in the file counting from one, as used by :meth:`FastaFile.select`.
+'''
+import os
+import mmap
+import struct
+
+from array import array
+
+from .utils import _numpy
+
+try:
+    array('q')
+    _offset_code = 'q'
+except ValueError:
+    # Python 2 has no 64-bit typecode, but its long is 64-bit on most platforms
+    _offset_code = 'l'
+
+_line_offset = struct.Struct("<q")
+
+
+class Bitset(object):
+    '''
+    A compact set of the integers in `range(size)`, using one bit each.
+
+    Iterating over a bitset yields its members in ascending order. The members
+    are also kept in the order they were added, so that iterating sorts only
+    them rather than scanning every bit.
+
+    Parameters
+    ----------
+    size: int
+    '''
+    __slots__ = ("size", "_bits", "_members")
+
+    def __init__(self, size):
+        self.size = size
+        self._bits = bytearray((size + 7) >> 3)
+        self._members = array(_offset_code)
+
+    def add(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError("%d is out of range for a bitset of size %d" % (i, self.size))
+        mask = 1 << (i & 7)
+        if not self._bits[i >> 3] & mask:
+            self._bits[i >> 3] |= mask
+            self._members.append(i)
+
+    def update(self, values):
+        for i in values:
+            self.add(i)
+
+    def __contains__(self, i):
+        return 0 <= i < self.size and bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def __iter__(self):
+        return iter(sorted(self._members))
+
+    def __len__(self):
+        return len(self._members)
+
+
+def _native(text):
+    # Accessions are kept as the native str type. Python 3 decodes them as
+    # latin-1, which maps every byte to a character and back unchanged
+    return text if isinstance(text, str) else text.decode("latin-1")
+
+
+def _index_line(accession, length, offset, line_bases, line_width):
+    return b"%s\t%d\t%d\t%d\t%d\n" % (accession, length, offset, line_bases, line_width)
+
+
+def _map_file(path):
+    handle = open(path, 'rb')
+    if os.path.getsize(path) > 0:
+        return handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    return handle, b""
+
+
+def _write_line_table(index_path, lines_path):
+    # Record where each line of an index written by another tool starts
+    tmp_path = lines_path + ".tmp"
+    with open(index_path, 'rb') as handle, open(tmp_path, 'wb') as out:
+        position = 0
+        for line in handle:
+            out.write(_line_offset.pack(position))
+            position += len(line)
+    if os.path.exists(lines_path):
+        os.remove(lines_path)
+    os.rename(tmp_path, lines_path)
+
+
+class FastaIndex(object):
+    '''
+    The position of every record in a FASTA file, in file order, read from
+    an index file in the `.fai` format.
+
+    The index file and the table of the byte offset of each of its lines,
+    kept at `path` + ".lines", are memory-mapped, so opening an index and
+    reading any one record take constant time. A record is parsed from its
+    line when it is accessed. The line table is written if it is missing or
+    older than the index. Looking records up by accession builds a table of
+    accession hashes, 16 bytes per record, the first time it is done, which
+    requires NumPy.
+
+    Parameters
+    ----------
+    path: str
+        The path of the index file
+
+    Attributes
+    ----------
+    accessions: sequence of str
+        The accession of each record, read on demand
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._handle, self._map = _map_file(path)
+        lines_path = path + ".lines"
+        if not (os.path.exists(lines_path) and os.path.getmtime(lines_path) >= os.path.getmtime(path)):
+            _write_line_table(path, lines_path)
+        self._lines_handle, self._lines = _map_file(lines_path)
+        self._hashes = None
+        self._hash_order = None
+        self.accessions = _Accessions(self)
+
+    def _start(self, i):
+        count = len(self)
+        if i < 0:
+            i += count
+        if not 0 <= i < count:
+            raise IndexError("record index out of range")
+        return _line_offset.unpack_from(self._lines, i * _line_offset.size)[0]
+
+    def __len__(self):
+        return len(self._lines) // _line_offset.size
+
+    def record(self, i):
+        '''
+        The accession, sequence length, byte offset of the sequence, residues
+        per line and bytes per line of record `i`.
+
+        Returns
+        -------
+        tuple
+        '''
+        start = self._start(i)
+        end = self._map.find(b"\n", start)
+        if end < 0:
+            end = len(self._map)
+        accession, length, offset, line_bases, line_width = self._map[start:end].split(b"\t")
+        return _native(accession), int(length), int(offset), int(line_bases), int(line_width)
+
+    def accession(self, i):
+        start = self._start(i)
+        return _native(self._map[start:self._map.find(b"\t", start)])
+
+    def length(self, i):
+        return self.record(i)[1]
+
+    def ordinal(self, accession):
+        '''
+        The position of `accession` in file order, counting from zero.
+
+        Raises
+        ------
+        KeyError
+        '''
+        if self._hashes is None:
+            self._build_hashes()
+        accession = _native(accession)
+        key = hash(accession)
+        hashes = self._hashes
+        position = int(hashes.searchsorted(key))
+        while position < len(hashes) and hashes[position] == key:
+            i = int(self._hash_order[position])
+            if self.accession(i) == accession:
+                return i
+            position += 1
+        raise KeyError(accession)
+
+    def _build_hashes(self):
+        np = _numpy("Looking up FASTA records by accession")
+        hashes = np.fromiter(
+            (hash(accession) for accession in self.accessions), dtype=np.int64, count=len(self))
+        order = hashes.argsort()
+        self._hashes = hashes[order]
+        self._hash_order = order
+
+    def span(self, i):
+        '''
+        The number of bytes, newlines included, occupied by the sequence
+        of record `i`.
+        '''
+        _, length, _, line_bases, line_width = self.record(i)
+        if line_bases == 0:
+            return 0
+        full_lines, remainder = divmod(length, line_bases)
+        return full_lines * line_width + remainder
+
+    @classmethod
+    def build(cls, path, index_path=None):
+        '''
+        Scan the FASTA file at `path` and write an index of its records to
+        `index_path`, defaulting to `path` + ".fai".
+
+        Returns
+        -------
+        FastaIndex
+
+        Raises
+        ------
+        ValueError
+            If the sequence lines of a record are not all the same width,
+            apart from its last line
+        '''
+        index_path = index_path or path + ".fai"
+        lines_path = index_path + ".lines"
+        tmp_path = index_path + ".tmp"
+        tmp_lines_path = lines_path + ".tmp"
+        accession = None
+        offset = length = line_bases = line_width = 0
+        short_line = False
+        position = index_position = 0
+        pack = _line_offset.pack
+        with open(path, 'rb') as handle, open(tmp_path, 'wb') as out, open(tmp_lines_path, 'wb') as lines:
+            for line in handle:
+                width = len(line)
+                if line.startswith(b">"):
+                    if accession is not None:
+                        entry = _index_line(accession, length, offset, line_bases, line_width)
+                        lines.write(pack(index_position))
+                        out.write(entry)
+                        index_position += len(entry)
+                    header = line[1:].split(None, 1)
+                    accession = header[0] if header else b""
+                    offset = position + width
+                    length = line_bases = line_width = 0
+                    short_line = False
+                elif accession is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    # Only the last line of the file may lack a line terminator,
+                    # so its width says nothing about the record's line width
+                    terminated = width != bases
+                    if not line_bases:
+                        line_bases = bases
+                        line_width = width
+                    elif bases:
+                        if short_line or bases > line_bases or (
+                                bases == line_bases and terminated and width != line_width):
+                            raise ValueError(
+                                "Record %s in %s has sequence lines of differing width" % (
+                                    _native(accession), path))
+                    if bases < line_bases:
+                        short_line = True
+                    length += bases
+                position += width
+            if accession is not None:
+                lines.write(pack(index_position))
+                out.write(_index_line(accession, length, offset, line_bases, line_width))
+        for tmp, final in ((tmp_path, index_path), (tmp_lines_path, lines_path)):
+            if os.path.exists(final):
+                os.remove(final)
+            os.rename(tmp, final)
+        # Both files were written together, so the line table is current
+        os.utime(lines_path, None)
+        return cls(index_path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    def close(self):
+        for mapped, handle in ((self._map, self._handle), (self._lines, self._lines_handle)):
+            if not isinstance(mapped, bytes):
+                mapped.close()
+            handle.close()
+
+
+class _Accessions(object):
+    # The accessions of a FastaIndex as a read-only sequence
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.index.accession(i)
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self.index.accession(i)
+
+
+class FastaFile(object):
+    '''
+    A memory-mapped FASTA file whose sequences are read on demand.
+
+    Parameters
+    ----------
+    path: str
+    index_path: str, optional
+        Where to keep the index. Defaults to `path` + ".fai"
+
+    Attributes
+    ----------
+    path: str
+    index: FastaIndex
+    '''
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + ".fai"
+        self.index = self._load_index()
+        # The ordinals of the records given out by select, so looking them up
+        # again by accession needs no accession table
+        self._selected = {}
+        self._handle, self._map = _map_file(path)
+
+    def _load_index(self):
+        if (os.path.exists(self.index_path) and
+                os.path.getmtime(self.index_path) >= os.path.getmtime(self.path)):
+            return FastaIndex.load(self.index_path)
+        return FastaIndex.build(self.path, self.index_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.accessions)
+
+    def __contains__(self, accession):
+        try:
+            self.ordinal(accession)
+            return True
+        except KeyError:
+            return False
+
+    def ordinal(self, accession):
+        i = self._selected.get(accession)
+        if i is None:
+            i = self.index.ordinal(accession)
+        return i
+
+    def length(self, accession):
+        return self.index.length(self.ordinal(accession))
+
+    def sequence_at(self, i):
+        '''
+        Read the sequence of the record at position `i` in file order.
+
+        Returns
+        -------
+        str
+        '''
+        _, length, start, line_bases, line_width = self.index.record(i)
+        if line_bases == 0:
+            return ""
+        full_lines, remainder = divmod(length, line_bases)
+        chunk = self._map[start:start + full_lines * line_width + remainder]
+        if line_width != line_bases:
+            chunk = chunk.replace(b"\n", b"").replace(b"\r", b"")
+        return chunk.decode("ascii")
+
+    def sequence(self, accession):
+        '''
+        Read the sequence of `accession`.
+
+        Returns
+        -------
+        str
+
+        Raises
+        ------
+        KeyError
+        '''
+        return self.sequence_at(self.ordinal(accession))
+
+    __getitem__ = sequence
+
+    def select(self, db_sequence_ids):
+        '''
+        Describe the DBSequences with the given ids, in file order and
+        without duplicates, where the id of a record is its position in
+        the file counting from one.
+
+        Only the records selected are read from the index, and looking them
+        up by accession afterwards, as :class:`~.components.DBSequence` does,
+        needs no table of every accession.
+
+        Parameters
+        ----------
+        db_sequence_ids: iterable of int
+
+        Yields
+        ------
+        dict
+            With `accession`, `id` and `source` keys, suitable for
+            :class:`~.components.DBSequence`
+
+        Raises
+        ------
+        IndexError
+            If an id does not refer to a record in this file
+        '''
+        members = Bitset(len(self))
+        for db_sequence_id in db_sequence_ids:
+            members.add(db_sequence_id - 1)
+        for i in members:
+            accession = self.index.accession(i)
+            self._selected[accession] = i
+            yield {"accession": accession, "id": i + 1, "source": self}
+
+    def close(self):
+        if not isinstance(self._map, bytes):
+            self._map.close()
+        self._handle.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        return {"path": self.path, "index_path": self.index_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index_path'])
+
+    def __repr__(self):
+        return "FastaFile(%r)" % (self.path,)
@@ -0,0 +1,78 @@
+'''
+Estimate false discovery rates by target-decoy competition for whole
+score arrays at once.
+
+At each score threshold the FDR is estimated as the number of decoy matches
+scoring at least as well divided by the number of target matches, capped at
+one, and the q-value of a match is the smallest FDR at which it would still be
+accepted. Matches with tied scores are accepted or rejected together, so they
+share a q-value.
+'''
+import numpy as np
+
+
+PSM_LEVEL_Q_VALUE = ("MS:1002354", "PSM-level q-value")
+PEPTIDE_LEVEL_Q_VALUE = ("MS:1001868", "distinct peptide-level q-value")
+
+
+def q_values(scores, is_decoy, higher_score_better=True):
+    '''
+    Calculate the q-value of each match.
+
+    Parameters
+    ----------
+    scores: array-like of float
+    is_decoy: array-like of bool
+    higher_score_better: bool
+
+    Returns
+    -------
+    numpy.ndarray
+    '''
+    scores = np.asarray(scores, dtype=float)
+    is_decoy = np.asarray(is_decoy, dtype=bool)
+    n = len(scores)
+    if n == 0:
+        return np.zeros(0)
+    order = np.argsort(-scores if higher_score_better else scores, kind="mergesort")
+    ranked = scores[order]
+    decoys = np.cumsum(is_decoy[order])
+    targets = np.arange(1, n + 1) - decoys
+
+    # Only the last match of each run of tied scores is a possible threshold
+    run_ends = np.flatnonzero(np.r_[ranked[1:] != ranked[:-1], True])
+    fdr = np.minimum(decoys[run_ends] / np.maximum(targets[run_ends], 1).astype(float), 1.0)
+    q = np.minimum.accumulate(fdr[::-1])[::-1]
+    run_lengths = np.diff(np.r_[-1, run_ends])
+    result = np.empty(n)
+    result[order] = np.repeat(q, run_lengths)
+    return result
+
+
+def peptide_q_values(scores, is_decoy, peptides, higher_score_better=True):
+    '''
+    Calculate the q-value of the peptide of each match, where each distinct
+    peptide is represented by its best scoring match.
+
+    Parameters
+    ----------
+    scores: array-like of float
+    is_decoy: array-like of bool
+    peptides: array-like
+        A key identifying the peptide of each match
+    higher_score_better: bool
+
+    Returns
+    -------
+    numpy.ndarray
+        The q-value of each match's peptide, in the order of `scores`
+    '''
+    scores = np.asarray(scores, dtype=float)
+    is_decoy = np.asarray(is_decoy, dtype=bool)
+    if len(scores) == 0:
+        return np.zeros(0)
+    _, peptide_numbers = np.unique(np.asarray(peptides), return_inverse=True)
+    order = np.lexsort((-scores if higher_score_better else scores, peptide_numbers))
+    ordered_peptides = peptide_numbers[order]
+    best = order[np.r_[True, ordered_peptides[1:] != ordered_peptides[:-1]]]
+    return q_values(scores[best], is_decoy[best], higher_score_better)[peptide_numbers]
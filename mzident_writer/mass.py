@@ -0,0 +1,227 @@
+'''
+Compute peptide masses and mass-to-charge ratios for whole batches of
+sequences at once.
+
+Residue masses are held in a lookup array indexed by the byte value of
+each one-letter residue code, so a batch of sequences is converted into
+residue masses with a single array indexing operation and summed per
+peptide with :func:`numpy.add.reduceat`.
+'''
+from collections import Mapping
+from numbers import Number
+
+import numpy as np
+
+
+PROTON = 1.00727646677
+WATER = 18.0105646837
+
+residue_masses = {
+    "G": 57.021464,
+    "A": 71.037114,
+    "S": 87.032028,
+    "P": 97.052764,
+    "V": 99.068414,
+    "T": 101.047679,
+    "C": 103.009185,
+    "L": 113.084064,
+    "I": 113.084064,
+    "N": 114.042927,
+    "D": 115.026943,
+    "Q": 128.058578,
+    "K": 128.094963,
+    "E": 129.042593,
+    "M": 131.040485,
+    "H": 137.058912,
+    "F": 147.068414,
+    "U": 150.953636,
+    "R": 156.101111,
+    "Y": 163.063329,
+    "W": 186.079313,
+    "O": 237.147727,
+}
+
+
+class MassEngine(object):
+    '''
+    Calculate neutral masses and m/z values of modified peptides.
+
+    Modifications may be given for each peptide as a sequence whose items
+    are mass deltas, modification names, mappings with either a `mass_delta`
+    or a `name` key, such as the dictionaries accepted by
+    :class:`~.components.Modification`, or objects with a
+    `monoisotopic_mass_delta`, such as :class:`~.components.Modification`
+    instances themselves. Names are converted into mass deltas
+    by `modification_mass`, and each distinct name is only converted once.
+
+    Attributes
+    ----------
+    residue_masses: dict
+        The monoisotopic mass of each residue, keyed by one-letter code
+    modification_mass: callable
+        Maps a modification name to its monoisotopic mass delta
+    '''
+    def __init__(self, residue_masses=None, modification_mass=None):
+        if residue_masses is None:
+            residue_masses = globals()['residue_masses']
+        self.residue_masses = dict(residue_masses)
+        self.modification_mass = modification_mass
+        self._modification_masses = {}
+        self._table = np.full(256, np.nan)
+        for residue, mass in self.residue_masses.items():
+            self._table[ord(residue)] = mass
+
+    @classmethod
+    def from_unimod(cls, unimod, modification_mass=None):
+        '''
+        Build an engine whose residue masses are calculated from the amino
+        acid and element tables of a :class:`~.unimod.Unimod` database.
+
+        Unimod does not record the selenium in selenocysteine, so `U` keeps
+        its default mass. If `modification_mass` is not given, names are
+        looked up in `unimod`.
+
+        Parameters
+        ----------
+        unimod: Unimod
+        modification_mass: callable, optional
+
+        Returns
+        -------
+        MassEngine
+        '''
+        from .unimod import AminoAcid, Element
+        session = unimod.session
+        elements = dict(session.query(Element.element, Element.monoisotopic_mass).filter(
+            Element.element.in_([u"H", u"C", u"N", u"O", u"S"])))
+        masses = dict(residue_masses)
+        for aa in session.query(AminoAcid):
+            if len(aa.one_letter) != 1 or not aa.one_letter.isalpha() or aa.one_letter == "U":
+                continue
+            mass = (aa.num_H * elements["H"] + aa.num_C * elements["C"] + aa.num_N * elements["N"] +
+                    aa.num_O * elements["O"] + aa.num_S * elements["S"])
+            if mass > 0:
+                masses[str(aa.one_letter)] = mass
+        if modification_mass is None:
+            def modification_mass(name):
+                return unimod.get(name).monoisotopic_mass
+        return cls(masses, modification_mass)
+
+    def _modification_delta(self, modification):
+        if isinstance(modification, Number):
+            return modification
+        mass = getattr(modification, "monoisotopic_mass_delta", None)
+        if mass is not None:
+            return mass
+        if isinstance(modification, Mapping):
+            mass = modification.get("mass_delta")
+            if mass is not None:
+                return mass
+            modification = modification["name"]
+        try:
+            return self._modification_masses[modification]
+        except KeyError:
+            if self.modification_mass is None:
+                raise KeyError("Cannot resolve the mass of %r without a modification_mass" % (modification,))
+            mass = self._modification_masses[modification] = self.modification_mass(modification)
+            return mass
+
+    def residue_sums(self, sequences):
+        '''
+        Sum the residue masses of each sequence.
+
+        Parameters
+        ----------
+        sequences: iterable of str
+
+        Returns
+        -------
+        numpy.ndarray
+
+        Raises
+        ------
+        KeyError
+            If a sequence contains an unknown residue
+        '''
+        sequences = list(sequences)
+        lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.intp, count=len(sequences))
+        joined = "".join(sequences)
+        if not isinstance(joined, bytes):
+            joined = joined.encode("ascii")
+        codes = np.frombuffer(joined, dtype=np.uint8)
+        masses = self._table[codes]
+        unknown = np.isnan(masses)
+        if unknown.any():
+            raise KeyError("Unknown residue %r" % (chr(codes[np.argmax(unknown)]),))
+        sums = np.zeros(len(sequences))
+        nonempty = lengths > 0
+        if nonempty.any():
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            sums[nonempty] = np.add.reduceat(masses, starts[nonempty])
+        return sums
+
+    def modification_deltas(self, modifications, count):
+        '''
+        Sum the mass deltas of each peptide's modifications.
+
+        Parameters
+        ----------
+        modifications: iterable of sequences, optional
+        count: int
+            The number of peptides
+
+        Returns
+        -------
+        numpy.ndarray
+        '''
+        deltas = np.zeros(count)
+        if modifications is not None:
+            for i, mods in enumerate(modifications):
+                if mods:
+                    deltas[i] = sum(self._modification_delta(mod) for mod in mods)
+        return deltas
+
+    def neutral_masses(self, sequences, modifications=None):
+        '''
+        Calculate the neutral monoisotopic mass of each peptide.
+
+        Parameters
+        ----------
+        sequences: iterable of str
+        modifications: iterable of sequences, optional
+            The modifications of each peptide, in the same order as `sequences`
+
+        Returns
+        -------
+        numpy.ndarray
+        '''
+        sums = self.residue_sums(sequences)
+        return sums + WATER + self.modification_deltas(modifications, len(sums))
+
+    def mass_to_charge(self, sequences, charges, modifications=None):
+        '''
+        Calculate the m/z of each peptide at its charge state.
+
+        Parameters
+        ----------
+        sequences: iterable of str
+        charges: int or array-like of int
+        modifications: iterable of sequences, optional
+
+        Returns
+        -------
+        numpy.ndarray
+        '''
+        masses = self.neutral_masses(sequences, modifications)
+        charges = np.asarray(charges, dtype=float)
+        return (masses + charges * PROTON) / charges
+
+    def peptide_mass(self, sequence, modifications=()):
+        '''
+        Calculate the neutral monoisotopic mass of a single peptide.
+
+        Returns
+        -------
+        float
+        '''
+        return float(self.neutral_masses([sequence], [modifications])[0])
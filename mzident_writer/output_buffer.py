@@ -0,0 +1,152 @@
+'''
+Combine the many small writes made while serializing a document into a few
+large ones.
+
+lxml's incremental writer hands its output to the file it writes to in pieces
+of a few kilobytes, and every flush of the writer passes on whatever it holds,
+however small. Each of those becomes a write call, and usually a system call,
+on the underlying file, which is slow on network filesystems. A
+:class:`WriteCombiningBuffer` sits between the two, collecting writes in one
+large preallocated buffer and writing it out whole when it fills. It can also
+be flushed on a timer or at the end of each document section, so a partially
+written document becomes visible sooner.
+'''
+import time
+
+
+FLUSH_REASONS = ("size", "time", "section", "explicit")
+
+
+class WriteCombiningBuffer(object):
+    '''
+    A write-only file object which buffers writes to another file in chunks
+    of `buffer_size` bytes.
+
+    Parameters
+    ----------
+    raw: file
+        The writable binary file to write to
+    buffer_size: int
+        The size of the buffer. Writes are passed on to `raw` in chunks of
+        this size, except when flushed early. A write of at least this many
+        bytes when the buffer is empty is passed on without copying
+    flush_interval: float, optional
+        Flush whenever a write finds this many seconds have passed since the
+        last flush
+    flush_on_section: bool
+        Flush at the end of each document section, see :meth:`section_boundary`
+
+    Attributes
+    ----------
+    writes: int
+        The number of writes made to this buffer
+    raw_writes: int
+        The number of writes made to `raw`, each of which is one system call
+        if `raw` is unbuffered
+    bytes_written: int
+        The number of bytes written to `raw`
+    raw_write_time: float
+        The time in seconds spent writing to `raw`
+    flushes: dict
+        The number of times the buffer was written out, by reason, one of
+        :data:`FLUSH_REASONS`
+    '''
+    def __init__(self, raw, buffer_size=2 ** 20, flush_interval=None, flush_on_section=False):
+        if buffer_size <= 0:
+            raise ValueError("buffer_size must be positive")
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_on_section = flush_on_section
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._position = 0
+        self._last_flush = time.time()
+        self.closed = False
+        self.writes = 0
+        self.raw_writes = 0
+        self.bytes_written = 0
+        self.raw_write_time = 0.0
+        self.flushes = dict.fromkeys(FLUSH_REASONS, 0)
+
+    def _write_raw(self, data):
+        start = time.time()
+        size = len(data)
+        written = 0
+        while written < size:
+            self.raw_writes += 1
+            count = self.raw.write(data[written:] if written else data)
+            # Buffered and Python 2 files write everything or raise, and
+            # the latter return None
+            written = size if count is None else written + count
+        self.bytes_written += size
+        self.raw_write_time += time.time() - start
+
+    def _drain(self, reason):
+        if self._position:
+            # Copy out of the buffer, since not every file object accepts a
+            # memoryview, which costs little beside the write itself
+            self._write_raw(self._view[:self._position].tobytes())
+            self._position = 0
+            self.flushes[reason] += 1
+        self._last_flush = time.time()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        size = len(data)
+        self.writes += 1
+        if self._position == 0 and size >= self.buffer_size:
+            self._write_raw(data)
+        else:
+            view = memoryview(data)
+            offset = 0
+            while offset < size:
+                count = min(size - offset, self.buffer_size - self._position)
+                self._view[self._position:self._position + count] = view[offset:offset + count]
+                self._position += count
+                offset += count
+                if self._position == self.buffer_size:
+                    self._drain("size")
+        if self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval:
+            self._drain("time")
+        return size
+
+    def section_boundary(self):
+        '''
+        Mark the end of a document section, flushing if :attr:`flush_on_section`
+        is set.
+        '''
+        if self.flush_on_section:
+            self._drain("section")
+
+    def flush(self):
+        self._drain("explicit")
+        if hasattr(self.raw, "flush"):
+            self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.raw.close()
+
+    def stats(self):
+        '''
+        Returns
+        -------
+        dict
+            The write counts, flush counts by reason, bytes and time spent
+            writing to the underlying file, and the resulting throughput in
+            bytes per second
+        '''
+        return {
+            "writes": self.writes,
+            "raw_writes": self.raw_writes,
+            "bytes_written": self.bytes_written,
+            "buffered_bytes": self._position,
+            "flushes": dict(self.flushes),
+            "raw_write_time": self.raw_write_time,
+            "throughput": self.bytes_written / self.raw_write_time if self.raw_write_time else None,
+        }
@@ -0,0 +1,272 @@
+'''
+Locate every occurrence of a set of peptides in a protein database with a
+single pass over the proteins, producing :class:`~.components.PeptideEvidence`
+descriptions.
+
+The peptides are compiled into an Aho-Corasick automaton, so each protein is
+scanned once, character by character, no matter how many peptides are being
+searched for. Leucine and isoleucine can be treated as the same residue, since
+they cannot be told apart by mass, and proteins whose accessions begin with a
+decoy prefix are marked as decoys.
+'''
+from itertools import chain
+
+
+def _translation(leucine_isoleucine_equivalent):
+    table = bytearray(range(256))
+    if leucine_isoleucine_equivalent:
+        table[ord("I")] = ord("L")
+    return bytes(table)
+
+
+def _encode(sequence, table):
+    if not isinstance(sequence, bytes):
+        sequence = sequence.encode("ascii")
+    return bytearray(sequence.translate(table))
+
+
+def _peptide_items(peptides):
+    if hasattr(peptides, "items"):
+        return peptides.items()
+    return ((peptide["id"], peptide["peptide_sequence"]) for peptide in peptides)
+
+
+class PeptideMapper(object):
+    '''
+    Find where each of a set of peptides occurs in a collection of proteins.
+
+    Parameters
+    ----------
+    peptides: dict or iterable of dict
+        Either a mapping from peptide id to sequence, or dictionaries with
+        `id` and `peptide_sequence` keys, as given to :class:`~.components.Peptide`.
+        Several peptides, such as differently modified forms, may share a sequence
+    leucine_isoleucine_equivalent: bool
+        Whether `I` and `L` match one another
+    decoy_prefix: str or tuple of str
+        Proteins whose accessions start with this prefix are decoys
+
+    Attributes
+    ----------
+    patterns: list of bytes
+        The distinct peptide sequences searched for, after I/L folding
+    peptide_ids: list of list
+        The ids of the peptides sharing each pattern
+    '''
+    def __init__(self, peptides, leucine_isoleucine_equivalent=True, decoy_prefix="DECOY_"):
+        self.leucine_isoleucine_equivalent = leucine_isoleucine_equivalent
+        self.decoy_prefix = decoy_prefix
+        self._table = _translation(leucine_isoleucine_equivalent)
+        self.patterns = []
+        self.peptide_ids = []
+        self._lengths = []
+        self._build(peptides)
+
+    def _build(self, peptides):
+        pattern_index = {}
+        for peptide_id, sequence in _peptide_items(peptides):
+            pattern = bytes(_encode(sequence, self._table))
+            if not pattern:
+                raise ValueError("Peptide %r has an empty sequence" % (peptide_id,))
+            i = pattern_index.get(pattern)
+            if i is None:
+                i = pattern_index[pattern] = len(self.patterns)
+                self.patterns.append(pattern)
+                self._lengths.append(len(pattern))
+                self.peptide_ids.append([])
+            self.peptide_ids[i].append(peptide_id)
+
+        # Transitions are kept in a single dictionary keyed by state and
+        # character code rather than a dictionary per state, which is much
+        # smaller for the hundreds of thousands of states of a large peptide set
+        delta = {}
+        outputs = [[]]
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for code in bytearray(pattern):
+                key = (state << 8) | code
+                next_state = delta.get(key)
+                if next_state is None:
+                    next_state = delta[key] = len(outputs)
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(i)
+
+        children = [[] for _ in outputs]
+        for key, state in delta.items():
+            children[key >> 8].append((key & 0xff, state))
+
+        fail = [0] * len(outputs)
+        queue = [state for code, state in children[0]]
+        for code in range(256):
+            delta.setdefault(code, 0)
+        head = 0
+        while head < len(queue):
+            parent = queue[head]
+            head += 1
+            for code, state in children[parent]:
+                queue.append(state)
+                fallback = fail[parent]
+                target = delta.get((fallback << 8) | code)
+                while target is None:
+                    fallback = fail[fallback]
+                    target = delta.get((fallback << 8) | code)
+                fail[state] = target
+                # Breadth-first order means the failure state's outputs are already merged
+                outputs[state].extend(outputs[target])
+
+        self._delta = delta
+        self._fail = fail
+        self._outputs = [tuple(output) for output in outputs]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def scan(self, sequence):
+        '''
+        Find every occurrence of any pattern in `sequence`.
+
+        Parameters
+        ----------
+        sequence: str
+
+        Yields
+        ------
+        pattern: int
+            The index of the pattern in :attr:`patterns`
+        start: int
+            The zero-based offset at which it begins
+        '''
+        delta = self._delta
+        fail = self._fail
+        outputs = self._outputs
+        lengths = self._lengths
+        state = 0
+        for position, code in enumerate(_encode(sequence, self._table)):
+            next_state = delta.get((state << 8) | code)
+            while next_state is None:
+                state = fail[state]
+                next_state = delta.get((state << 8) | code)
+            state = next_state
+            if outputs[state]:
+                for pattern in outputs[state]:
+                    yield pattern, position - lengths[pattern] + 1
+
+    def is_decoy(self, accession):
+        return bool(self.decoy_prefix) and accession.startswith(self.decoy_prefix)
+
+    def protein_evidence(self, db_sequence_id, accession, sequence):
+        '''
+        Describe each occurrence of a peptide in one protein, without an id.
+
+        Residues before the N-terminus and after the C-terminus of the protein
+        are given as "-".
+
+        Yields
+        ------
+        dict
+        '''
+        is_decoy = self.is_decoy(accession)
+        lengths = self._lengths
+        peptide_ids = self.peptide_ids
+        size = len(sequence)
+        for pattern, start in self.scan(sequence):
+            end = start + lengths[pattern]
+            pre = sequence[start - 1] if start > 0 else "-"
+            post = sequence[end] if end < size else "-"
+            for peptide_id in peptide_ids[pattern]:
+                yield {
+                    "peptide_id": peptide_id,
+                    "db_sequence_id": db_sequence_id,
+                    "start_position": start + 1,
+                    "end_position": end,
+                    "is_decoy": is_decoy,
+                    "pre": pre,
+                    "post": post,
+                }
+
+    def map(self, proteins, start_id=1):
+        '''
+        Describe every occurrence of a peptide in `proteins` as a
+        :class:`~.components.PeptideEvidence`.
+
+        Parameters
+        ----------
+        proteins: iterable of dict
+            With `id`, `accession` and `sequence` keys, as given to
+            :class:`~.components.DBSequence`
+        start_id: int
+            The id of the first PeptideEvidence
+
+        Yields
+        ------
+        dict
+        '''
+        evidence = chain.from_iterable(
+            self.protein_evidence(protein["id"], protein["accession"], protein["sequence"])
+            for protein in proteins)
+        return self._number(evidence, start_id)
+
+    def _number(self, evidence, start_id):
+        for i, item in enumerate(evidence, start_id):
+            item["id"] = i
+            yield item
+
+    def map_fasta(self, source, processes=1, chunk_size=2000, start_id=1):
+        '''
+        As :meth:`map`, for every protein of a :class:`~.fasta.FastaFile`,
+        whose DBSequence ids are their positions in the file counting from one.
+
+        Parameters
+        ----------
+        source: FastaFile
+        processes: int
+            The number of worker processes to scan the file with. Each is
+            given contiguous chunks of proteins, and evidence is produced in
+            file order regardless
+        chunk_size: int
+            The number of proteins in each chunk
+        start_id: int
+
+        Yields
+        ------
+        dict
+        '''
+        if processes <= 1:
+            accessions = source.index.accessions
+            evidence = chain.from_iterable(
+                self.protein_evidence(i + 1, accessions[i], source.sequence_at(i))
+                for i in range(len(source)))
+            return self._number(evidence, start_id)
+        return self._number(self._map_fasta_parallel(source, processes, chunk_size), start_id)
+
+    def _map_fasta_parallel(self, source, processes, chunk_size):
+        from multiprocessing import Pool
+        chunks = [(start, min(start + chunk_size, len(source)))
+                  for start in range(0, len(source), chunk_size)]
+        pool = Pool(processes, initializer=_initialize_worker, initargs=(self, source))
+        try:
+            for evidence in pool.imap(_map_chunk, chunks):
+                for item in evidence:
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+_worker_state = {}
+
+
+def _initialize_worker(mapper, source):
+    _worker_state['mapper'] = mapper
+    _worker_state['source'] = source
+
+
+def _map_chunk(bounds):
+    mapper = _worker_state['mapper']
+    source = _worker_state['source']
+    accessions = source.index.accessions
+    evidence = []
+    for i in range(*bounds):
+        evidence.extend(mapper.protein_evidence(i + 1, accessions[i], source.sequence_at(i)))
+    return evidence
@@ -0,0 +1,394 @@
+'''
+Group proteins by the peptides identified in them, for writing a
+ProteinDetectionList.
+
+Once :meth:`~.components.DocumentContext.track_evidence` is called, every
+:class:`~.components.PeptideEvidence` written to a document is recorded in its
+context's :class:`EvidenceIndex`, which holds the sparse peptide by
+protein incidence matrix as two parallel arrays of row and column numbers.
+:func:`group_proteins` then works on whole arrays at a time, requiring NumPy:
+
+- Proteins matched by an identical set of peptides are sequence same-set
+  proteins, found by sorting proteins on two independent 64-bit hashes of
+  their peptide sets and checking the members of each run exactly.
+- A protein whose peptides are all matched by another protein with more
+  peptides is a sequence sub-set protein. Only larger proteins which contain
+  the candidate's least shared peptide need to be checked. Candidates are
+  checked largest first, leaving out the proteins already found to be
+  sub-sets, and a 64-bit signature of each protein's peptides rules out most
+  other pairs before their peptides are compared. No pair of proteins is
+  compared in a Python loop.
+- Proteins sharing any peptide, directly or through other proteins, form one
+  ambiguity group, found by propagating the smallest protein number across
+  the incidence matrix until it no longer changes.
+'''
+from array import array
+
+from .utils import _numpy
+
+
+ANCHOR = 0
+SAME_SET = 1
+SUB_SET = 2
+
+# The number of candidate pairs of proteins compared at once when looking
+# for sub-set proteins
+_pair_budget = 2 ** 20
+
+
+class EvidenceIndex(object):
+    '''
+    The peptide-protein incidence of the PeptideEvidence in a document,
+    and the SpectrumIdentificationItems which refer to each of them.
+
+    Peptides and proteins are numbered densely in the order they are first
+    seen, and the pair of each PeptideEvidence is stored in :attr:`peptides`
+    and :attr:`proteins`.
+
+    Attributes
+    ----------
+    peptide_ids: list
+        The Peptide id of each peptide number
+    protein_ids: list
+        The DBSequence id of each protein number
+    peptides: array
+    proteins: array
+    evidence_ids: list
+        The PeptideEvidence id of each pair
+    decoy_evidence_ids: set
+        The ids of the PeptideEvidence from decoy proteins
+    '''
+    def __init__(self):
+        self.peptide_ids = []
+        self.protein_ids = []
+        self._peptide_numbers = {}
+        self._protein_numbers = {}
+        self.peptides = array('l')
+        self.proteins = array('l')
+        self.evidence_ids = []
+        self.decoy_evidence_ids = set()
+        self._identifications = {}
+
+    def __len__(self):
+        return len(self.evidence_ids)
+
+    def _number(self, numbers, ids, key):
+        number = numbers.get(key)
+        if number is None:
+            number = numbers[key] = len(ids)
+            ids.append(key)
+        return number
+
+    def add_evidence(self, evidence_id, peptide_id, db_sequence_id, is_decoy=False):
+        self.peptides.append(self._number(self._peptide_numbers, self.peptide_ids, peptide_id))
+        self.proteins.append(self._number(self._protein_numbers, self.protein_ids, db_sequence_id))
+        self.evidence_ids.append(evidence_id)
+        if is_decoy:
+            self.decoy_evidence_ids.add(evidence_id)
+
+    def add_identification(self, evidence_id, item_id):
+        self._identifications.setdefault(evidence_id, []).append(item_id)
+
+    def identifications(self, evidence_id):
+        '''
+        The ids of the SpectrumIdentificationItems referring to `evidence_id`.
+
+        Returns
+        -------
+        list
+        '''
+        return self._identifications.get(evidence_id, [])
+
+    def group(self, identified_only=False):
+        '''
+        Group the proteins of this index with :func:`group_proteins`.
+
+        Parameters
+        ----------
+        identified_only: bool
+            Only consider PeptideEvidence referred to by a SpectrumIdentificationItem
+
+        Returns
+        -------
+        ProteinGroups
+        '''
+        np = _numpy("EvidenceIndex.group")
+        peptides = np.frombuffer(self.peptides, dtype=np.dtype('l')).astype(np.int64)
+        proteins = np.frombuffer(self.proteins, dtype=np.dtype('l')).astype(np.int64)
+        if identified_only:
+            identified = np.fromiter(
+                (evidence_id in self._identifications for evidence_id in self.evidence_ids),
+                dtype=bool, count=len(self.evidence_ids))
+            peptides = peptides[identified]
+            proteins = proteins[identified]
+        return group_proteins(peptides, proteins, len(self.peptide_ids), len(self.protein_ids))
+
+    def evidence_by_protein(self):
+        '''
+        Arrange the pairs of this index by protein.
+
+        Returns
+        -------
+        order: numpy.ndarray
+            The pair numbers sorted by protein, in the order they were added
+        starts: numpy.ndarray
+            The position in `order` at which each protein's pairs begin,
+            with a final entry for the end of the last protein
+        '''
+        np = _numpy("EvidenceIndex.evidence_by_protein")
+        proteins = np.frombuffer(self.proteins, dtype=np.dtype('l'))
+        order = np.argsort(proteins, kind="mergesort")
+        starts = np.zeros(len(self.protein_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(proteins, minlength=len(self.protein_ids)), out=starts[1:])
+        return order, starts
+
+
+class ProteinGroups(object):
+    '''
+    The result of :func:`group_proteins`.
+
+    Attributes
+    ----------
+    group: numpy.ndarray
+        The ambiguity group of each protein, numbered from zero in the order
+        of each group's first protein
+    role: numpy.ndarray
+        :data:`ANCHOR`, :data:`SAME_SET` or :data:`SUB_SET` for each protein
+    same_set: numpy.ndarray
+        The lowest numbered protein with the same peptides as each protein
+    '''
+    def __init__(self, group, role, same_set):
+        self.group = group
+        self.role = role
+        self.same_set = same_set
+
+    def __len__(self):
+        return int(self.group.max()) + 1 if len(self.group) else 0
+
+    def members(self):
+        '''
+        List the proteins of each group, leading proteins first, with each
+        anchor followed by its same-set proteins, then sub-set proteins.
+
+        Yields
+        ------
+        numpy.ndarray
+        '''
+        np = _numpy("ProteinGroups.members")
+        order = np.lexsort((np.arange(len(self.group)), self.role, self.same_set,
+                            self.role == SUB_SET, self.group))
+        bounds = np.flatnonzero(np.diff(self.group[order])) + 1
+        for members in np.split(order, bounds):
+            if len(members):
+                yield members
+
+
+def _segment_starts(np, keys, size):
+    starts = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=starts[1:])
+    return starts
+
+
+def _ramp(np, counts):
+    # For segments of the given lengths, the offset of each item within its segment
+    total = int(counts.sum())
+    ends = np.cumsum(counts)
+    return np.arange(total, dtype=np.int64) - np.repeat(ends - counts, counts)
+
+
+def _same_sets(np, peptides, starts, counts, n_peptides):
+    n_proteins = len(counts)
+    random = np.random.RandomState(1)
+    first = random.randint(0, 2 ** 62, size=n_peptides).astype(np.uint64)
+    second = random.randint(0, 2 ** 62, size=n_peptides).astype(np.uint64)
+    nonempty = counts > 0
+    first_hash = np.zeros(n_proteins, dtype=np.uint64)
+    second_hash = np.zeros(n_proteins, dtype=np.uint64)
+    first_hash[nonempty] = np.add.reduceat(first[peptides], starts[:-1][nonempty])
+    second_hash[nonempty] = np.add.reduceat(second[peptides], starts[:-1][nonempty])
+
+    order = np.lexsort((np.arange(n_proteins), second_hash, first_hash, counts))
+    boundary = np.ones(n_proteins, dtype=bool)
+    boundary[1:] = ((counts[order][1:] != counts[order][:-1]) |
+                    (first_hash[order][1:] != first_hash[order][:-1]) |
+                    (second_hash[order][1:] != second_hash[order][:-1]))
+    leaders = order[np.maximum.accumulate(np.where(boundary, np.arange(n_proteins), 0))]
+    same_set = np.empty(n_proteins, dtype=np.int64)
+    same_set[order] = leaders
+    # Proteins without any peptides are not the same as one another
+    same_set[~nonempty] = np.flatnonzero(~nonempty)
+
+    # Check every member of a run against its leader, peptide by peptide,
+    # and give any hash collision a class of its own
+    members = np.flatnonzero(same_set != np.arange(n_proteins))
+    if len(members):
+        member_counts = counts[members]
+        offsets = _ramp(np, member_counts)
+        pair = np.repeat(np.arange(len(members)), member_counts)
+        mismatch = (peptides[starts[members][pair] + offsets] !=
+                    peptides[starts[same_set[members]][pair] + offsets])
+        same_set[members[np.unique(pair[mismatch])]] = members[np.unique(pair[mismatch])]
+    return same_set
+
+
+def _signatures(np, peptides, starts, counts, n_peptides):
+    # One of 64 bits for each peptide, OR-ed over the peptides of each protein.
+    # A protein can only contain another if its signature covers the other's
+    bits = np.random.RandomState(2).randint(0, 64, size=n_peptides).astype(np.uint64)
+    peptide_bits = np.left_shift(np.uint64(1), bits)
+    nonempty = counts > 0
+    signature = np.zeros(len(counts), dtype=np.uint64)
+    if nonempty.any():
+        signature[nonempty] = np.bitwise_or.reduceat(peptide_bits[peptides], starts[:-1][nonempty])
+    return signature
+
+
+def _sub_sets(np, peptides, proteins, counts, n_peptides, candidates):
+    # `peptides` and `proteins` hold the incidence of the same-set leaders
+    # only, sorted by protein then peptide
+    n_proteins = len(counts)
+    subset = np.zeros(n_proteins, dtype=bool)
+    if not len(peptides):
+        return subset
+    keys = proteins * n_peptides + peptides
+    degree = np.bincount(peptides, minlength=n_peptides)
+    protein_starts = _segment_starts(np, proteins, n_proteins)
+    signature = _signatures(np, peptides, protein_starts, counts, n_peptides)
+
+    # The least shared peptide of each candidate protein
+    order = np.lexsort((degree[peptides], proteins))
+    first_of_protein = np.ones(len(order), dtype=bool)
+    first_of_protein[1:] = proteins[order][1:] != proteins[order][:-1]
+    rarest = np.full(n_proteins, -1, dtype=np.int64)
+    rarest[proteins[order][first_of_protein]] = peptides[order][first_of_protein]
+
+    # The proteins containing each peptide, largest first, so those larger
+    # than a candidate are a prefix of the list of its rarest peptide
+    largest = int(counts.max()) + 1
+    rank = peptides * largest + (largest - 1 - counts[proteins])
+    order = np.argsort(rank, kind="mergesort")
+    listed = proteins[order]
+    rank = rank[order]
+    starts = _segment_starts(np, peptides, n_peptides)
+
+    def larger(chunk):
+        r = rarest[chunk]
+        return r, np.searchsorted(rank, r * largest + (largest - 1 - counts[chunk])) - starts[r]
+
+    # Candidates are taken largest first, in chunks of about `_pair_budget`
+    # pairs. A protein found to be a sub-set is dropped from the comparisons
+    # of every later candidate, since whatever contains a candidate and it
+    # also contains the larger protein which it is a sub-set of
+    candidates = candidates[rarest[candidates] >= 0]
+    candidates = candidates[np.argsort(-counts[candidates], kind="mergesort")]
+    _, bound = larger(candidates)
+    cumulative = np.cumsum(bound)
+    dropped = 0
+    begin = 0
+    while begin < len(candidates):
+        end = int(np.searchsorted(cumulative, cumulative[begin] - bound[begin] + _pair_budget, side="right"))
+        chunk = candidates[begin:max(end, begin + 1)]
+        begin += len(chunk)
+        r, fan_out = larger(chunk)
+        pair_protein = np.repeat(chunk, fan_out)
+        pair_other = listed[np.repeat(starts[r], fan_out) + _ramp(np, fan_out)]
+        keep = ~subset[pair_other] & ((signature[pair_protein] & ~signature[pair_other]) == 0)
+        pair_protein = pair_protein[keep]
+        pair_other = pair_other[keep]
+        if not len(pair_protein):
+            continue
+
+        # Test every peptide of each remaining candidate against the other protein
+        sizes = counts[pair_protein]
+        pair = np.repeat(np.arange(len(pair_protein)), sizes)
+        members = peptides[protein_starts[pair_protein][pair] + _ramp(np, sizes)]
+        probes = pair_other[pair] * n_peptides + members
+        found = keys[np.minimum(np.searchsorted(keys, probes), len(keys) - 1)] == probes
+        contained = np.bincount(pair, weights=found, minlength=len(pair_protein)) == sizes
+        new = np.unique(pair_protein[contained])
+        subset[new] = True
+
+        # Compact the lists once a quarter of their entries are sub-sets
+        dropped += int(counts[new].sum())
+        if dropped * 4 > len(listed):
+            kept = ~subset[listed]
+            listed = listed[kept]
+            rank = rank[kept]
+            starts = _segment_starts(np, rank // largest, n_peptides)
+            dropped = 0
+    return subset
+
+
+def _components(np, peptides, proteins, n_peptides, n_proteins):
+    label = np.arange(n_proteins, dtype=np.int64)
+    if not len(peptides):
+        return label
+    by_peptide = np.argsort(peptides, kind="mergesort")
+    sorted_peptides = peptides[by_peptide]
+    peptide_heads = np.flatnonzero(np.r_[True, sorted_peptides[1:] != sorted_peptides[:-1]])
+    by_protein = np.lexsort((peptides, proteins))
+    sorted_proteins = proteins[by_protein]
+    protein_heads = np.flatnonzero(np.r_[True, sorted_proteins[1:] != sorted_proteins[:-1]])
+    peptide_label = np.zeros(n_peptides, dtype=np.int64)
+    while True:
+        peptide_label[sorted_peptides[peptide_heads]] = np.minimum.reduceat(
+            label[proteins[by_peptide]], peptide_heads)
+        updated = label.copy()
+        updated[sorted_proteins[protein_heads]] = np.minimum.reduceat(
+            peptide_label[peptides[by_protein]], protein_heads)
+        # Jump to the label of the label to shorten long chains
+        updated = np.minimum(updated, updated[updated])
+        if np.array_equal(updated, label):
+            break
+        label = updated
+    _, group = np.unique(label, return_inverse=True)
+    return group.astype(np.int64)
+
+
+def group_proteins(peptides, proteins, n_peptides=None, n_proteins=None):
+    '''
+    Find the sequence same-set and sub-set proteins and the ambiguity
+    groups of a peptide by protein incidence matrix. Requires NumPy.
+
+    Parameters
+    ----------
+    peptides: numpy.ndarray
+        The peptide number of each incidence
+    proteins: numpy.ndarray
+        The protein number of each incidence
+    n_peptides: int, optional
+    n_proteins: int, optional
+
+    Returns
+    -------
+    ProteinGroups
+    '''
+    np = _numpy("group_proteins")
+    peptides = np.asarray(peptides, dtype=np.int64)
+    proteins = np.asarray(proteins, dtype=np.int64)
+    if n_peptides is None:
+        n_peptides = int(peptides.max()) + 1 if len(peptides) else 0
+    if n_proteins is None:
+        n_proteins = int(proteins.max()) + 1 if len(proteins) else 0
+    if not n_proteins:
+        empty = np.zeros(0, dtype=np.int64)
+        return ProteinGroups(empty, empty, empty)
+
+    keys = np.unique(proteins * n_peptides + peptides)
+    proteins, peptides = np.divmod(keys, n_peptides)
+    counts = np.bincount(proteins, minlength=n_proteins)
+    starts = _segment_starts(np, proteins, n_proteins)
+
+    same_set = _same_sets(np, peptides, starts, counts, n_peptides)
+    leaders = np.flatnonzero(same_set == np.arange(n_proteins))
+    is_leader = np.zeros(n_proteins, dtype=bool)
+    is_leader[leaders] = True
+    leading_pairs = is_leader[proteins]
+    subset = _sub_sets(np, peptides[leading_pairs], proteins[leading_pairs], np.where(is_leader, counts, 0),
+                       n_peptides, leaders)
+    subset = subset[same_set]
+
+    role = np.where(same_set == np.arange(n_proteins), ANCHOR, SAME_SET)
+    role[subset] = SUB_SET
+    group = _components(np, peptides, proteins, n_peptides, n_proteins)
+    return ProteinGroups(group, role.astype(np.int64), same_set)
@@ -0,0 +1,197 @@
+'''
+Group peptide-spectrum matches by spectrum and rank them, for streams too
+large to sort in memory.
+
+PSMs are read in whatever order they arrive and collected into runs of a
+bounded size. Each full run is sorted by spectrum and spilled to a file in a
+temporary directory. The runs are then merged with :func:`heapq.merge`, at
+most `fan_in` at a time: while there are more runs than that, groups of them
+are merged into longer runs on disk, so no more than `fan_in` files are read,
+and `fan_in + 1` open, at once however many PSMs there are. Runs are written and read in chunks of
+`run_size // fan_in` records, so a merge holds about as many records in
+memory as one run. The merged stream is cut into one
+:class:`~.components.SpectrumIdentificationResult` description per spectrum,
+whose identifications are ranked by score.
+'''
+import heapq
+import os
+import shutil
+import tempfile
+
+from itertools import groupby
+from operator import itemgetter
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def _score(psm):
+    score = psm["score"]
+    return float(getattr(score, "value", score))
+
+
+class _RunStore(object):
+    # The spilled runs of one call to group_psms, as files in a private directory
+
+    def __init__(self, chunk_size, fan_in, tmp_dir=None):
+        self.chunk_size = chunk_size
+        self.fan_in = fan_in
+        self.directory = tempfile.mkdtemp(prefix="psm_runs", dir=tmp_dir)
+        self.runs = []
+        self._count = 0
+
+    def spill(self, records):
+        self._count += 1
+        path = os.path.join(self.directory, "run%d" % self._count)
+        chunk = []
+        with open(path, 'wb') as handle:
+            for record in records:
+                chunk.append(record)
+                if len(chunk) == self.chunk_size:
+                    pickle.dump(chunk, handle, 2)
+                    chunk = []
+            if chunk:
+                pickle.dump(chunk, handle, 2)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as handle:
+            while True:
+                try:
+                    chunk = pickle.load(handle)
+                except EOFError:
+                    break
+                for record in chunk:
+                    yield record
+        os.remove(path)
+
+    def merged(self):
+        # Merge runs into longer ones until few enough remain to be merged
+        # at once, merging the oldest, and so shortest, runs first
+        runs = self.runs
+        while len(runs) > self.fan_in:
+            merging = runs[:self.fan_in]
+            runs = runs[self.fan_in:]
+            runs.append(self.spill(heapq.merge(*[self.read(path) for path in merging])))
+        self.runs = []
+        return heapq.merge(*[self.read(path) for path in runs])
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _best(psms, top_n, higher_score_better):
+    direction = -1 if higher_score_better else 1
+    if top_n is None:
+        return sorted(psms, key=lambda psm: direction * _score(psm))
+    return heapq.nsmallest(top_n, psms, key=lambda psm: direction * _score(psm))
+
+
+def _prune(records, top_n, higher_score_better):
+    # The best N of a spectrum overall are among the best N of each run
+    pruned = []
+    for key, group in groupby(records, key=itemgetter(0)):
+        group = list(group)
+        if len(group) > top_n:
+            kept = _best([record[2] for record in group], top_n, higher_score_better)
+            kept = set(id(psm) for psm in kept)
+            group = [record for record in group if id(record[2]) in kept]
+        pruned.extend(group)
+    return pruned
+
+
+def rank(psms):
+    '''
+    Set the `rank` of each PSM of one spectrum, already ordered best first.
+    Tied scores share a rank, and the next rank counts every PSM before it.
+
+    Parameters
+    ----------
+    psms: list of dict
+
+    Returns
+    -------
+    list of dict
+    '''
+    current = previous = None
+    for i, psm in enumerate(psms, 1):
+        score = _score(psm)
+        if score != previous:
+            current = i
+            previous = score
+        psm["rank"] = current
+    return psms
+
+
+def group_psms(psms, run_size=100000, top_n=None, higher_score_better=True, start_id=1, tmp_dir=None,
+               fan_in=64):
+    '''
+    Group PSMs by spectrum into SpectrumIdentificationResult descriptions,
+    using memory bounded by `run_size`.
+
+    Parameters
+    ----------
+    psms: iterable of dict
+        Each specifying a :class:`~.components.SpectrumIdentificationItem`
+        as accepted by :meth:`~.MzIdentMLWriter.spectrum_identification_list`,
+        together with its `spectrum_id` and, if not 1, its `spectra_data_id`
+    run_size: int
+        The number of PSMs to sort in memory before spilling them to disk
+    top_n: int, optional
+        Keep only the best `top_n` PSMs of each spectrum
+    higher_score_better: bool
+    start_id: int
+        The id of the first SpectrumIdentificationResult
+    tmp_dir: str, optional
+        Where to write spilled runs
+    fan_in: int
+        The greatest number of runs merged at once. Merging them into a
+        longer run on disk keeps `fan_in + 1` files open
+
+    Yields
+    ------
+    dict
+        With `spectra_data_id`, `spectrum_id`, `id` and `identifications`
+        keys, ordered by spectra data then spectrum id, with identifications
+        ordered by `rank`. PSMs with tied scores keep their input order
+    '''
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2")
+    store = None
+    buffer = []
+    try:
+        for sequence, psm in enumerate(psms):
+            psm = dict(psm)
+            key = (psm.pop("spectra_data_id", 1), psm.pop("spectrum_id"))
+            # The sequence number keeps the sort stable and stops the PSMs
+            # themselves from ever being compared
+            buffer.append((key, sequence, psm))
+            if len(buffer) >= run_size:
+                buffer.sort(key=itemgetter(0, 1))
+                if top_n is not None:
+                    buffer = _prune(buffer, top_n, higher_score_better)
+                if store is None:
+                    store = _RunStore(max(run_size // fan_in, 1), fan_in, tmp_dir)
+                store.runs.append(store.spill(buffer))
+                buffer = []
+        buffer.sort(key=itemgetter(0, 1))
+        if store is not None:
+            if buffer:
+                store.runs.append(store.spill(buffer))
+                buffer = []
+            merged = store.merged()
+        else:
+            merged = iter(buffer)
+        for result_id, (key, records) in enumerate(groupby(merged, key=itemgetter(0)), start_id):
+            identifications = _best([record[2] for record in records], top_n, higher_score_better)
+            yield {
+                "spectra_data_id": key[0],
+                "spectrum_id": key[1],
+                "id": result_id,
+                "identifications": rank(identifications),
+            }
+    finally:
+        if store is not None:
+            store.close()
@@ -0,0 +1,306 @@
+'''
+A :class:`~.components.DocumentContext` for documents with more registered
+references than fit in memory.
+
+References are kept in memory up to a byte budget, in least recently used
+order, and the coldest are spilled to a SQLite database when the budget is
+exceeded. Spilled references are read back, and kept in memory again, the
+next time they are looked up. Each `context[entity_type]` is a
+:class:`SpillingContextCache` which behaves like the
+:class:`~.components.SpecializedContextCache` of an ordinary context.
+
+The keys and aliases recorded by :meth:`SpillingDocumentContext.intern` to
+deduplicate entities are kept in the same database. Only the vocabularies and
+the modification memo, which grow with the number of distinct terms rather
+than the size of the document, stay in memory. An
+:class:`~.protein_grouping.EvidenceIndex` cannot be kept, since it holds every
+PeptideEvidence in memory.
+'''
+import os
+import sys
+import sqlite3
+import tempfile
+import warnings
+
+from collections import OrderedDict
+
+from .components import DocumentContext, id_maker
+
+
+# An estimate of the bytes taken by an OrderedDict entry and its
+# (type name, key) tuple beyond the sizes of the key and value themselves,
+# measured on Python 2.7 whose OrderedDict keeps a linked list node per entry
+_entry_overhead = 300
+
+
+class ReferenceStore(object):
+    '''
+    A SQLite table of references keyed by entity type and id.
+
+    Parameters
+    ----------
+    path: str, optional
+        Where to keep the database. Defaults to a temporary file which is
+        removed by :meth:`close`
+    '''
+    def __init__(self, path=None):
+        self._temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(suffix=".sqlite")
+            os.close(handle)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # Read text back as the native str type, so values read from disk
+        # and from memory compare, and repr, the same on Python 2
+        self.connection.text_factory = str
+        # The store only lives as long as the document being written, so
+        # durability is not worth paying for
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS refs (type_name TEXT NOT NULL, key NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (type_name, key)) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS interned (type_name TEXT NOT NULL, key TEXT NOT NULL, id NOT NULL,"
+            " PRIMARY KEY (type_name, key)) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS aliases (type_name TEXT NOT NULL, id NOT NULL, canonical NOT NULL,"
+            " PRIMARY KEY (type_name, id)) WITHOUT ROWID")
+
+    def put_many(self, rows):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", rows)
+
+    def get(self, type_name, key):
+        row = self.connection.execute(
+            "SELECT value FROM refs WHERE type_name = ? AND key = ?", (type_name, key)).fetchone()
+        return None if row is None else row[0]
+
+    def intern(self, type_name, key, id):
+        '''
+        Store `id` under `key` unless an id is already stored there.
+
+        Returns
+        -------
+        object
+            The id already stored under `key`, or None if `id` was stored
+        '''
+        row = self.connection.execute(
+            "SELECT id FROM interned WHERE type_name = ? AND key = ?", (type_name, key)).fetchone()
+        if row is not None:
+            return row[0]
+        self.connection.execute("INSERT INTO interned VALUES (?, ?, ?)", (type_name, key, id))
+        return None
+
+    def count_interned(self, type_name):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM interned WHERE type_name = ?", (type_name,)).fetchone()[0]
+
+    def put_alias(self, type_name, id, canonical):
+        self.connection.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)", (type_name, id, canonical))
+
+    def get_alias(self, type_name, id):
+        row = self.connection.execute(
+            "SELECT canonical FROM aliases WHERE type_name = ? AND id = ?", (type_name, id)).fetchone()
+        return None if row is None else row[0]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+    @property
+    def closed(self):
+        return self.connection is None
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+        if self._temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __del__(self):
+        # A temporary database must not outlive the context which forgot to close it
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class SpillingContextCache(object):
+    '''
+    The references registered for one entity type of a :class:`SpillingDocumentContext`.
+    '''
+    def __init__(self, type_name, context):
+        self.type_name = type_name
+        self.context = context
+
+    def __getitem__(self, key):
+        value = self.context._lookup(self.type_name, key)
+        if value is None:
+            warnings.warn("No reference was found for %s in %s" % (key, self.type_name), stacklevel=3)
+            value = id_maker(self.type_name, key)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.context._register(self.type_name, key, value)
+
+    def get(self, key, default=None):
+        value = self.context._lookup(self.type_name, key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.context._lookup(self.type_name, key) is not None
+
+    def __repr__(self):
+        return "SpillingContextCache(%r)" % (self.type_name,)
+
+
+class SpillingDocumentContext(DocumentContext):
+    '''
+    A :class:`~.components.DocumentContext` which spills its least recently
+    used references to disk to stay within `memory_budget` bytes.
+
+    Parameters
+    ----------
+    vocabularies: list, optional
+    memory_budget: int
+        The approximate number of bytes of references to keep in memory
+    path: str, optional
+        Where to keep spilled references, see :class:`ReferenceStore`
+    batch_size: int
+        The number of evicted references to collect before writing them to
+        disk in one transaction. They are held in memory until then, beyond
+        `memory_budget`
+
+    Attributes
+    ----------
+    store: ReferenceStore
+    disk_reads: int
+        The number of lookups answered from disk
+
+    :class:`~.writer.MzIdentMLWriter` closes a context it was given when it
+    finishes writing, removing a temporary database.
+    '''
+    def __init__(self, vocabularies=None, memory_budget=256 * 2 ** 20, path=None, batch_size=10000):
+        DocumentContext.__init__(self, vocabularies)
+        self.memory_budget = memory_budget
+        self.batch_size = batch_size
+        self.store = ReferenceStore(path)
+        self.disk_reads = 0
+        self._hot = OrderedDict()
+        self._hot_bytes = 0
+        self._pending = {}
+        self._closed_stats = None
+
+    def __missing__(self, key):
+        self[key] = SpillingContextCache(key, self)
+        return self[key]
+
+    @staticmethod
+    def _size(entry, value):
+        return sys.getsizeof(entry[1]) + sys.getsizeof(value) + _entry_overhead
+
+    def _lookup(self, type_name, key):
+        entry = (type_name, key)
+        try:
+            value = self._hot.pop(entry)
+        except KeyError:
+            value = self._pending.pop(entry, None)
+            if value is None:
+                value = self.store.get(type_name, key)
+                if value is None:
+                    return None
+                self.disk_reads += 1
+            self._admit(entry, value)
+            return value
+        self._hot[entry] = value
+        return value
+
+    def _register(self, type_name, key, value):
+        entry = (type_name, key)
+        previous = self._hot.pop(entry, None)
+        if previous is not None:
+            self._hot_bytes -= self._size(entry, previous)
+        self._pending.pop(entry, None)
+        self._admit(entry, value)
+
+    def _admit(self, entry, value):
+        self._hot[entry] = value
+        self._hot_bytes += self._size(entry, value)
+        while self._hot_bytes > self.memory_budget and len(self._hot) > 1:
+            cold_entry, cold_value = self._hot.popitem(last=False)
+            self._hot_bytes -= self._size(cold_entry, cold_value)
+            self._pending[cold_entry] = cold_value
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def track_evidence(self):
+        raise ValueError(
+            "A SpillingDocumentContext cannot track evidence, since an EvidenceIndex is held in memory."
+            " Give protein groups explicitly, and is_decoy for each identification")
+
+    def intern(self, type_name, key, id):
+        '''
+        As :meth:`.DocumentContext.intern`, keeping the keys seen and the ids
+        of duplicates in :attr:`store`. Keys are compared by their `repr`.
+        '''
+        self._intern_counts[type_name] = self._intern_counts.get(type_name, 0) + 1
+        canonical = self.store.intern(type_name, repr(key), id)
+        if canonical is None:
+            return True
+        if canonical != id:
+            self[type_name][id] = self[type_name][canonical]
+            self.store.put_alias(type_name, id, canonical)
+        return False
+
+    def canonical_id(self, type_name, id):
+        canonical = self.store.get_alias(type_name, id)
+        return id if canonical is None else canonical
+
+    def deduplication_stats(self):
+        stats = {}
+        for type_name, seen in self._intern_counts.items():
+            unique = self.store.count_interned(type_name)
+            stats[type_name] = {
+                "seen": seen, "unique": unique,
+                "ratio": float(seen) / unique if unique else 1.0}
+        return stats
+
+    def flush(self):
+        '''
+        Write the references evicted from memory but not yet spilled to disk.
+        '''
+        if self._pending:
+            self.store.put_many((type_name, key, value) for (type_name, key), value in self._pending.items())
+            self._pending.clear()
+
+    def spill_stats(self):
+        '''
+        Returns
+        -------
+        dict
+            The number of references and bytes held in memory, the number
+            of references spilled to disk and the number of lookups answered
+            from disk
+        '''
+        if self.store.closed:
+            return dict(self._closed_stats)
+        self.flush()
+        return {
+            "memory_entries": len(self._hot),
+            "memory_bytes": self._hot_bytes,
+            "spilled_entries": len(self.store),
+            "disk_reads": self.disk_reads,
+        }
+
+    def close(self):
+        if self.store.closed:
+            return
+        self._closed_stats = self.spill_stats()
+        self._pending.clear()
+        self._hot.clear()
+        self._hot_bytes = 0
+        self.store.close()
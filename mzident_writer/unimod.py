@@ -1,5 +1,8 @@
 import warnings
 import re
+import sys
+import sqlite3
+import threading
 
 from lxml import etree
 from sqlalchemy.ext.declarative import declarative_base
@@ -10,11 +13,38 @@ from sqlalchemy import (Numeric, Unicode,
                         UnicodeText, Boolean, event)
 from sqlalchemy import exc as sa_exc
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.schema import CreateTable
 
-from glycresoft_sqlalchemy.structure.composition import Composition, _make_isotope_string
+from .composition import Composition, _make_isotope_string, register_element, sum_compositions
 
-Base = declarative_base()
+from .unimod_index import NameIndex, MassIndex, SpecificityRecord, LRUCache
+from .unimod_snapshot import ModificationRecord, write_snapshot
+
+
+class _UnimodBase(object):
+    '''
+    Construct models from the `<tag>_row` elements of the Unimod tables XML.
+    Subclasses corresponding to a row type define a :attr:`_tag_name` and a
+    :meth:`row_from_tag` classmethod returning the row's column values.
+    '''
+    @classmethod
+    def from_tag(cls, tag):
+        return cls(**cls.row_from_tag(tag))
+
+    @classmethod
+    def rows_from_tag(cls, tag):
+        '''
+        Yield `(table, row)` pairs for the row described by `tag` and any
+        rows nested within it, for use with bulk inserts.
+        '''
+        yield cls.__table__, cls.row_from_tag(tag)
+
+
+Base = declarative_base(cls=_UnimodBase)
 
 _unimod_xml_download_url = "http://www.unimod.org/xml/unimod_tables.xml"
 
@@ -23,6 +53,11 @@ try:
 except:
     basestring = (str, bytes)
 
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
 
 CompositionType = Composition
 
@@ -84,13 +119,69 @@ def preprocess_xml(doc_path):
     return tree
 
 
+_formula_token_pattern = re.compile(r"(?P<isotope>\d+)?(?P<element>[^\(]+)(?:\((?P<count>-?\d+)\))?")
+_element_symbol_pattern = re.compile(r"(?P<isotope>\d*)?(?P<element>\S+)")
+
+
+def _element_name(symbol):
+    '''
+    Convert a Unimod element symbol like `13C` into the name used
+    for it in a :data:`CompositionType`.
+    '''
+    isotope, element = _element_symbol_pattern.match(symbol).groups()
+    if isotope:
+        return str(_make_isotope_string(element, int(isotope)))
+    return str(element)
+
+
+def _copy_composition(composition):
+    return composition.copy()
+
+
+def _brick_compositions(session):
+    '''
+    Get the mapping from Brick name to composition for the database bound to
+    `session`, building it with a single query the first time it is requested.
+
+    The mapping is stored in :attr:`Session.info`, so it lives as long as the
+    session does. The Unimod tables are treated as read-only once built.
+
+    Parameters
+    ----------
+    session: Session
+
+    Returns
+    -------
+    dict
+    '''
+    try:
+        return session.info['brick_compositions']
+    except KeyError:
+        for symbol, monoisotopic_mass, average_mass in session.query(
+                Element.element, Element.monoisotopic_mass, Element.average_mass):
+            register_element(_element_name(symbol), monoisotopic_mass, average_mass)
+        bricks = {}
+        rows = session.query(Brick.brick, BrickToElement.element, BrickToElement.count).outerjoin(
+            BrickToElement, BrickToElement.brick_id == Brick.id)
+        for brick, element, count in rows:
+            composition = bricks.get(brick)
+            if composition is None:
+                composition = bricks[brick] = CompositionType()
+            if element is not None:
+                composition[_element_name(element)] = count
+        session.info['brick_compositions'] = bricks
+        return bricks
+
+
 def _formula_parser(formula, session):
     '''
     Parse a unimod formula composed of elements,
     isotopes, and other bricks.
 
     In order to look up a Brick's composition, this
-    function must have access to a session.
+    function must have access to a session. Brick compositions
+    are loaded once per session by :func:`_brick_compositions`, and
+    each distinct formula is only parsed once per session.
 
     Parameters
     ----------
@@ -106,9 +197,16 @@ def _formula_parser(formula, session):
     -------
     CompositionType
     '''
-    composition = CompositionType()
+    formula_cache = session.info.setdefault('formula_compositions', {})
+    try:
+        return _copy_composition(formula_cache[formula])
+    except KeyError:
+        pass
+    bricks = _brick_compositions(session)
+    parts = []
+    counts = []
     for token in formula.split(" "):
-        match = re.search(r"(?P<isotope>\d+)?(?P<elemet>[^\(]+)(?:\((?P<count>-?\d+)\))?", token)
+        match = _formula_token_pattern.search(token)
         if match:
             isotope, element, count = match.groups()
             if count is not None:
@@ -119,47 +217,81 @@ def _formula_parser(formula, session):
                 name = _make_isotope_string(element, int(isotope))
             else:
                 name = element
-            is_brick = session.query(Brick).filter(Brick.brick == name).first()
+            is_brick = bricks.get(name)
             if is_brick is None:
-                composition[str(name)] += count
-            else:
-                composition += is_brick.composition * count
-    return composition
+                is_brick = CompositionType({str(name): 1})
+            parts.append(is_brick)
+            counts.append(count)
+    composition = sum_compositions(parts, counts)
+    formula_cache[formula] = composition
+    return _copy_composition(composition)
 
 
-def _composition_listener(attr):
+class memoized_composition(object):
     '''
-    Attach event listeners to an InstrumentedAttribute
-    to trigger formula parsing on load and on change.
+    A descriptor which computes a composition on first access and stores
+    it on the instance, so later accesses do not recompute it.
+
+    The value is not stored if the instance's session has
+    `info['memoize_compositions']` set to :const:`False`, which keeps bulk
+    iteration over many rows from holding a composition for each of them.
     '''
-    @event.listens_for(attr, "set")
-    def _update_composition_from_formula(target, value, oldvalue, initiator):
-        session = object_session(target)
-        if value == "" or value is None:
-            return
-        # If the object hasn't been associated with a session,
-        # we can't look up bricks.
-        if session is None:
-            return
-        target.composition = _formula_parser(value, session)
+    def __init__(self, compute):
+        self.compute = compute
+        self.key = "_memoized_" + compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__[self.key]
+        except KeyError:
+            pass
+        value = self.compute(instance)
+        session = object_session(instance)
+        if session is None or session.info.get('memoize_compositions', True):
+            instance.__dict__[self.key] = value
+        return value
 
-    @event.listens_for(attr.class_, "load")
-    def _update_composition_on_load(target, context):
-        value = getattr(target, attr.prop.key)
-        if value == "" or value is None:
-            return
-        session = object_session(target)
-        target.composition = _formula_parser(value, session)
+    def __set__(self, instance, value):
+        instance.__dict__[self.key] = value
+
+    def invalidate(self, instance):
+        instance.__dict__.pop(self.key, None)
 
 
 def has_composition(attr_name):
     '''
     A decorator to simplify flagging a Model with a column
-    to be treated as a formula for parsing. Calls :func:`_composition_listener`
-    internally.
+    to be treated as a formula for parsing.
+
+    The model gains a :attr:`composition` attribute which parses the formula
+    on first access with :func:`_formula_parser`, and is reset whenever the
+    column is assigned to. It is :const:`None` if the formula is empty or the
+    instance has no session to look up bricks with.
     '''
     def decorator(model):
-        _composition_listener(getattr(model, attr_name))
+        attr = getattr(model, attr_name)
+
+        def composition(self):
+            value = getattr(self, attr_name)
+            if value == "" or value is None:
+                return None
+            session = object_session(self)
+            # If the object hasn't been associated with a session,
+            # we can't look up bricks.
+            if session is None:
+                return None
+            return _formula_parser(value, session)
+
+        descriptor = memoized_composition(composition)
+        model.composition = descriptor
+
+        @event.listens_for(attr, "set")
+        def _invalidate_composition(target, value, oldvalue, initiator):
+            descriptor.invalidate(target)
+
         return model
     return decorator
 
@@ -188,14 +320,13 @@ class AlternativeName(Base):
     _tag_name = "alt_names_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib["record_id"]),
             alt_name=attrib['alt_name'],
             modification_id=int(attrib['mod_key'])
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     alt_name = Column(Unicode(256), index=True)
@@ -208,9 +339,9 @@ class AminoAcid(Base, HasFullNameMixin):
     _tag_name = "amino_acids_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             full_name=attrib['full_name'],
             one_letter=attrib['one_letter'],
@@ -221,7 +352,6 @@ class AminoAcid(Base, HasFullNameMixin):
             num_N=int(attrib["num_N"]),
             num_S=int(attrib["num_S"]),
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     num_H = Column(Integer)
@@ -241,13 +371,12 @@ class Classification(Base):
     _tag_name = "classifications_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             classification=attrib["classification"]
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     classification = Column(Unicode(30), index=True)
@@ -260,13 +389,12 @@ class Position(Base):
     _tag_name = "positions_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             position=attrib['position']
             )
-        return inst
 
     def __eq__(self, other):
         try:
@@ -290,14 +418,13 @@ class Brick(Base, HasFullNameMixin):
     _tag_name = "bricks_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             brick=attrib['brick'],
             full_name=attrib['full_name']
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     brick = Column(Unicode(64), index=True)
@@ -305,19 +432,14 @@ class Brick(Base, HasFullNameMixin):
 
     elements = relationship("BrickToElement")
 
-    @property
+    @memoized_composition
     def composition(self):
+        session = object_session(self)
+        if session is not None:
+            return _copy_composition(_brick_compositions(session)[self.brick])
         composition = CompositionType()
         for element_relation in self.elements:
-            symbol = element_relation.element
-            isotope, element = re.search(r"(?P<isotope>\d*)?(?P<element>\S+)", symbol).groups()
-            if isotope != "":
-                isotope = int(isotope)
-                iso_str = _make_isotope_string(element, isotope)
-            else:
-                iso_str = element
-            count = element_relation.count
-            composition[str(iso_str)] = count
+            composition[_element_name(element_relation.element)] = element_relation.count
         return composition
 
 
@@ -327,40 +449,34 @@ class Fragment(Base):
     _tag_name = "fragments_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             modification_id=int(attrib["mod_key"])
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     modification_id = Column(Integer, ForeignKey("Modification.id"), index=True)
 
     _fragment_composition = relationship("FragmentComposition")
 
-    @property
+    @memoized_composition
     def composition(self):
         composition = CompositionType()
-        session = object_session(self)
+        bricks = _brick_compositions(object_session(self))
         for fragment_composition_relation in self._fragment_composition:
             symbol = fragment_composition_relation.brick_string
-            isotope, element = re.search(r"(?P<isotope>\d*)?(?P<element>\S+)", symbol).groups()
             count = fragment_composition_relation.count
             if count is not None:
                 count = int(count)
             else:
                 count = 1
-            if isotope != "":
-                name = _make_isotope_string(element, isotope)
-            else:
-                name = element
-            is_brick = session.query(Brick).filter(Brick.brick == name).first()
+            is_brick = bricks.get(symbol)
             if is_brick is None:
-                composition[str(name)] += count
+                composition[_element_name(symbol)] += count
             else:
-                composition += is_brick.composition * count
+                composition.add(is_brick, count)
         return composition
 
 
@@ -370,15 +486,14 @@ class FragmentComposition(Base):
     _tag_name = "fragment_comp_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             brick_string=attrib["brick"],
             fragment_id=int(attrib["fragments_key"]),
             count=int(attrib["num_brick"])
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     brick_string = Column(Unicode(64), ForeignKey(Brick.brick), index=True)
@@ -392,15 +507,14 @@ class ModificationToBrick(Base):
     _tag_name = "mod2brick_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             brick_string=(attrib['brick']),
             modification_id=int(attrib["mod_key"]),
             count=int(attrib["num_brick"])
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     brick_string = Column(Unicode(64), ForeignKey(Brick.brick), index=True)
@@ -414,15 +528,14 @@ class BrickToElement(Base):
     _tag_name = "brick2element_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             brick_id=int(attrib['brick_key']),
             count=int(attrib["num_element"]),
             element=attrib['element']
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     brick_id = Column(Integer, ForeignKey(Brick.id), index=True)
@@ -437,17 +550,15 @@ class Element(Base, HasFullNameMixin):
     _tag_name = "elements_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             average_mass=float(attrib["avge_mass"]),
             monoisotopic_mass=float(attrib["mono_mass"]),
             full_name=attrib["full_name"],
             element=attrib["element"]
-
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     average_mass = Column(Numeric(12, 6, asdecimal=False))
@@ -485,9 +596,9 @@ class Modification(Base, HasFullNameMixin):
     fragments = association_proxy("_fragments", "composition")
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib["record_id"]),
             username_of_poster=attrib["username_of_poster"],
             average_mass=float(attrib["avge_mass"]),
@@ -498,6 +609,10 @@ class Modification(Base, HasFullNameMixin):
             approved=bool(int(attrib['approved'])),
             _composition=attrib["composition"]
             )
+
+    @classmethod
+    def from_tag(cls, tag):
+        inst = cls(**cls.row_from_tag(tag))
         for note in tag:
             if note.tag == MiscNotesModifications._tag_name:
                 model_note = MiscNotesModifications._from_tag(note, inst.id)
@@ -505,6 +620,14 @@ class Modification(Base, HasFullNameMixin):
                     inst.notes.append(model_note)
         return inst
 
+    @classmethod
+    def rows_from_tag(cls, tag):
+        row = cls.row_from_tag(tag)
+        yield cls.__table__, row
+        for note in tag:
+            if note.tag == MiscNotesModifications._tag_name and note.text is not None:
+                yield MiscNotesModifications.__table__, dict(text=note.text, modification_id=row['id'])
+
 
 class MiscNotesModifications(Base):
     __tablename__ = "MiscNotesModifications"
@@ -540,9 +663,9 @@ class Specificity(Base):
     position = relationship(Position)
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             position_id=int(attrib['position_key']),
             classification_id=int(attrib["classifications_key"]),
@@ -550,7 +673,6 @@ class Specificity(Base):
             amino_acid=attrib["one_letter"],
             modification_id=int(attrib["mod_key"]),
             )
-        return inst
 
 
 class NeutralLoss(Base):
@@ -559,15 +681,14 @@ class NeutralLoss(Base):
     _tag_name = "neutral_losses_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             brick_string=(attrib['brick']),
             count=int(attrib["num_brick"]),
             specificity_id=int(attrib["spec_key"])
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     brick_string = Column(Unicode(64), index=True)
@@ -582,9 +703,9 @@ class SpecificityToNeutralLoss(Base):
     _tag_name = "spec2nl_row"
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls(
+        return dict(
             id=int(attrib['record_id']),
             specificity_id=int(attrib["spec_key"]),
             monoisotopic_mass=float(attrib["nl_mono_mass"]),
@@ -594,7 +715,6 @@ class SpecificityToNeutralLoss(Base):
             is_slave=bool(int(attrib["is_slave_nl"])),
             _composition=attrib['nl_composition']
             )
-        return inst
 
     id = Column(Integer, primary_key=True)
     specificity_id = Column(Integer, ForeignKey(Specificity.id), index=True)
@@ -615,12 +735,12 @@ class CrossreferenceSource(Base):
     source = Column(Unicode(64), index=True)
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls()
-        inst.id = int(attrib['record_id'])
-        inst.source = attrib['xref_source']
-        return inst
+        return dict(
+            id=int(attrib['record_id']),
+            source=attrib['xref_source']
+            )
 
 
 class Crossreference(Base):
@@ -636,41 +756,180 @@ class Crossreference(Base):
     text = Column(UnicodeText)
 
     @classmethod
-    def from_tag(cls, tag):
+    def row_from_tag(cls, tag):
         attrib = tag.attrib
-        inst = cls()
-        inst.id = int(attrib['record_id'])
-        inst.url = attrib['xref_url']
-        inst.source_id = int(attrib['xref_source_key'])
-        inst.modification_id = int(attrib["mod_key"])
         text = []
         for node in tag.getchildren():
             if node.tag == "xref_text":
                 if node.text is not None:
                     text.append(node.text)
-        inst.text = "\n".join(text)
-        return inst
+        return dict(
+            id=int(attrib['record_id']),
+            url=attrib['xref_url'],
+            source_id=int(attrib['xref_source_key']),
+            modification_id=int(attrib["mod_key"]),
+            text="\n".join(text)
+            )
 
 
-def create(doc_path, output_path="sqlite://"):
+def _strip_namespace(element):
+    for node in element.iter():
+        tag = node.tag
+        if isinstance(tag, basestring) and tag.startswith("{"):
+            node.tag = tag.split("}", 1)[1]
+
+
+def _iterrows(doc_path):
+    '''
+    Stream the `<tag>_row` elements of a Unimod tables XML document,
+    yielding the rows they describe as soon as each has been read and
+    discarding the element afterwards.
+
+    Parameters
+    ----------
+    doc_path: str or file
+        A path or URL to the XML document, or an open file
+
+    Yields
+    ------
+    tuple:
+        A :class:`Table` and a :class:`dict` of column values
+    '''
+    models = {
+        model._tag_name: model for model in Base._decl_class_registry.values()
+        if hasattr(model, "_tag_name") and hasattr(model, "row_from_tag")
+    }
+    if isinstance(doc_path, basestring) and doc_path.startswith(("http://", "https://", "ftp://")):
+        doc_path = urlopen(doc_path)
+    for _, element in etree.iterparse(doc_path, events=("end",)):
+        tag = element.tag
+        if not isinstance(tag, basestring):
+            continue
+        model = models.get(tag.rsplit("}", 1)[-1])
+        if model is None:
+            continue
+        _strip_namespace(element)
+        for table, row in model.rows_from_tag(element):
+            yield table, row
+        element.clear()
+        # Drop the already-processed siblings still referenced by the parent
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def create(doc_path, output_path="sqlite://", batch_size=5000):
     '''
     Parse the relational table-like XML file provided by http://www.unimod.org/downloads.html
     and convert each <tag>_row into an equivalent database entry.
 
+    The document is streamed rather than loaded whole, and rows are written with
+    bulk inserts inside a single transaction. Secondary indices are created once
+    all rows have been loaded. Any existing Unimod tables at `output_path` are
+    replaced.
+
     By default the table will be held in memory.
+
+    Parameters
+    ----------
+    doc_path: str or file
+        A local path or URL to the XML document, or an open file
+    output_path: str
+        The SQLAlchemy URI of the database to write
+    batch_size: int
+        The number of rows of each table to accumulate before inserting them
+
+    Returns
+    -------
+    Session
     '''
-    tree = preprocess_xml(doc_path)
-    engine = create_engine(output_path)
-    Base.metadata.create_all(engine)
-    session = sessionmaker(bind=engine, autoflush=False)()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=sa_exc.SAWarning)
-        for model in Base._decl_class_registry.values():
-            if hasattr(model, "_tag_name") and hasattr(model, "from_tag"):
-                for tag in tree.iterfind(".//" + model._tag_name):
-                    session.add(model.from_tag(tag))
-            session.commit()
-    return session
+    engine = _create_engine(output_path)
+    tables = Base.metadata.sorted_tables
+    with engine.begin() as connection:
+        Base.metadata.drop_all(connection)
+        for table in tables:
+            connection.execute(CreateTable(table))
+        batches = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=sa_exc.SAWarning)
+            for table, row in _iterrows(doc_path):
+                batch = batches.setdefault(table, [])
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    connection.execute(table.insert(), batch)
+                    batches[table] = []
+            for table, batch in batches.items():
+                if batch:
+                    connection.execute(table.insert(), batch)
+        for table in tables:
+            for index in table.indexes:
+                index.create(connection)
+    return sessionmaker(bind=engine, autoflush=False)()
+
+
+def _create_engine(path):
+    url = make_url(path)
+    if url.drivername.startswith("sqlite") and url.database in (None, "", ":memory:"):
+        # Every connection to an in-memory database sees a different, empty
+        # database, so there is only the one connection. It may be handed
+        # from one thread to another, but not used by several at once.
+        return create_engine(
+            path, poolclass=StaticPool, connect_args={"check_same_thread": False})
+    return create_engine(path)
+
+
+_sqlite_read_pragmas = (
+    ("query_only", "ON"),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -16 * 1024),
+)
+
+
+def _configure_read_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in _sqlite_read_pragmas:
+        cursor.execute("PRAGMA %s = %s" % (pragma, value))
+    cursor.close()
+
+
+def read_only_engine(path, pool_size=8):
+    '''
+    Create an engine over the SQLite database at `path` for concurrent
+    reads.
+
+    Connections are pooled and may be used from any thread. Each connection
+    is opened in read-only mode where the :mod:`sqlite3` module supports URI
+    filenames, and is configured to memory-map the database file and keep a
+    larger page cache. Non-SQLite databases are opened as usual, and in-memory
+    ones through a single connection which threads must not use concurrently.
+
+    Parameters
+    ----------
+    path: str
+        A SQLAlchemy URI
+    pool_size: int
+        The number of connections to keep open
+
+    Returns
+    -------
+    Engine
+    '''
+    url = make_url(path)
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        return _create_engine(path)
+    filename = url.database
+
+    def connect():
+        if sys.version_info >= (3, 4):
+            from urllib.request import pathname2url
+            return sqlite3.connect(
+                "file:%s?mode=ro" % pathname2url(filename), uri=True, check_same_thread=False)
+        return sqlite3.connect(filename, check_same_thread=False)
+
+    engine = create_engine(
+        "sqlite://", creator=connect, poolclass=QueuePool,
+        pool_size=pool_size, max_overflow=pool_size)
+    event.listen(engine, "connect", _configure_read_only)
+    return engine
 
 
 def session(path="sqlite:///unimod.db"):
@@ -680,59 +939,332 @@ def session(path="sqlite:///unimod.db"):
     return session
 
 
+_eager_strategies = ("selectin", "subquery", "joined")
+
+
 class Unimod(object):
-    def __init__(self, path=None):
+    '''
+    Look up Unimod modifications by id or name.
+
+    Names are resolved through a :class:`~.NameIndex` over each
+    modification's full name, code name, extended code name and
+    alternative names, built with two queries on first use. Resolved
+    modifications are kept in a bounded :class:`~.LRUCache`. Mass
+    searches use a :class:`~.MassIndex`, also built on first use.
+
+    Instances over a database file may be shared between threads. Each thread
+    queries through its own :attr:`session` and keeps its own cache of resolved
+    modifications, drawing connections from a pool opened with
+    :func:`read_only_engine`. The name, mass and specificity indices are shared.
+    An instance held in memory, with no `path`, has a single connection and
+    must only be used by one thread at a time. Pass a `path` to share one
+    between threads.
+
+    Compositions are parsed when first accessed and kept on each model
+    instance. Pass `memoize_compositions=False` to skip keeping them when
+    iterating over many modifications once.
+
+    If the database at `path` is missing or empty, it is built from `source`,
+    which defaults to the Unimod download URL but may be a local copy of
+    `unimod_tables.xml`.
+
+    Attributes
+    ----------
+    path: str
+        The SQLAlchemy URI of the database, or :const:`None` if held in memory
+    session: Session
+        The session for the calling thread
+    '''
+    def __init__(self, path=None, source=_unimod_xml_download_url, cache_size=1024, pool_size=8,
+                 memoize_compositions=True):
         if path is None:
             self.path = None
-            self.session = create(_unimod_xml_download_url)
+            engine = create(source).bind
         else:
             self.path = path
             try:
-                self.session = session(path)
-                if self.session.query(Modification).first() is None:
+                builder = session(path)
+                if builder.query(Modification).first() is None:
                     raise Exception()
             except:
                 # Database may not yet exist at that location
-                self.session = create(_unimod_xml_download_url, path)
-                self.session.query(Modification).first()
+                builder = create(source, path)
+                builder.query(Modification).first()
+            builder.close()
+            builder.bind.dispose()
+            engine = read_only_engine(path, pool_size)
+        self._sessions = scoped_session(sessionmaker(
+            bind=engine, autoflush=False, info={'memoize_compositions': memoize_compositions}))
+        self._index_lock = threading.RLock()
+        self._name_index = None
+        self._mass_index = None
+        self._specificity_index = None
+        self._cache_size = cache_size
+        self._local = threading.local()
 
-    def get(self, identifier, strict=True):
+    @property
+    def session(self):
+        return self._sessions()
+
+    @property
+    def _cache(self):
+        try:
+            return self._local.cache
+        except AttributeError:
+            cache = self._local.cache = LRUCache(self._cache_size)
+            return cache
+
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            with self._index_lock:
+                if self._name_index is None:
+                    self._name_index = self._build_name_index()
+        return self._name_index
+
+    def _build_name_index(self):
+        index = NameIndex()
+        names = self.session.query(
+            Modification.id, Modification.full_name, Modification.code_name, Modification.ex_code_name)
+        for mod_id, full_name, code_name, ex_code_name in names:
+            for name in (full_name, code_name, ex_code_name):
+                if name:
+                    index.add(name, mod_id)
+        for mod_id, alt_name in self.session.query(AlternativeName.modification_id, AlternativeName.alt_name):
+            if alt_name:
+                index.add(alt_name, mod_id, primary=False)
+        return index
+
+    @property
+    def specificity_index(self):
+        '''
+        A mapping from modification id to a list of :class:`~.SpecificityRecord`,
+        loaded with a single query on first use.
+        '''
+        if self._specificity_index is None:
+            with self._index_lock:
+                if self._specificity_index is None:
+                    self._specificity_index = self._build_specificity_index()
+        return self._specificity_index
+
+    def _build_specificity_index(self):
+        index = {}
+        rows = self.session.query(
+            Specificity.modification_id, Specificity.amino_acid, Position.position,
+            Classification.classification, Specificity.hidden).join(
+            Position, Specificity.position_id == Position.id).join(
+            Classification, Specificity.classification_id == Classification.id)
+        for mod_id, residue, position, classification, hidden in rows:
+            index.setdefault(mod_id, []).append(
+                SpecificityRecord(residue, position, classification, hidden))
+        return index
+
+    @property
+    def mass_index(self):
+        if self._mass_index is None:
+            with self._index_lock:
+                if self._mass_index is None:
+                    self._mass_index = MassIndex(
+                        self.session.query(Modification.id, Modification.monoisotopic_mass),
+                        self.specificity_index)
+        return self._mass_index
+
+    def search_mass(self, mass, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        Find all modifications whose monoisotopic mass is within `tolerance`
+        of `mass`.
+
+        Parameters
+        ----------
+        mass: float
+            The observed mass delta
+        tolerance: float
+        unit: str
+            Either "Da" or "ppm", where ppm is relative to `mass`
+        residue: str, optional
+            Only include modifications with a specificity for this residue
+        position: str, optional
+            Only include modifications with a specificity at this position,
+            such as "Anywhere" or "Protein N-term"
+
+        Returns
+        -------
+        list of Modification
+            In ascending order of mass
+        '''
+        return self.get_many(self.mass_index.search(mass, tolerance, unit, residue, position))
+
+    def search_masses(self, masses, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        As :meth:`search_mass`, for an array of masses at once. Requires NumPy.
+
+        Returns
+        -------
+        list of list of Modification
+        '''
+        hits = self.mass_index.search_many(masses, tolerance, unit, residue, position)
+        unique = sorted(set(mod_id for ids in hits for mod_id in ids))
+        mods = dict(zip(unique, self.get_many(unique)))
+        return [[mods[mod_id] for mod_id in ids] for ids in hits]
+
+    def _resolve(self, identifier, strict=True):
         if isinstance(identifier, int):
-            mod = self.session.query(Modification).get(identifier)
+            return identifier
+        elif strict:
+            return self.name_index.find(identifier)
+        else:
+            return self.name_index.search(identifier)
+
+    def get(self, identifier, strict=True):
+        '''
+        Find a :class:`Modification` by id or by name.
+
+        Parameters
+        ----------
+        identifier: int or str
+            A Unimod record id, or one of the modification's names
+        strict: bool
+            If :const:`True`, names must match fully, ignoring case. Otherwise
+            the first modification with a name containing `identifier` is returned
+
+        Returns
+        -------
+        Modification
+
+        Raises
+        ------
+        KeyError
+        '''
+        key = (identifier, strict)
+        mod = self._cache.get(key)
+        if mod is None:
+            mod = self.session.query(Modification).get(self._resolve(identifier, strict))
             if mod is None:
                 raise KeyError(identifier)
-            return mod
-        elif isinstance(identifier, basestring):
-            if strict:
-                mod = self.session.query(Modification).filter(
-                    (Modification.full_name == identifier) |
-                    (Modification.code_name == identifier) |
-                    (Modification.ex_code_name == identifier)).first()
-                if mod is None:
-                    alt_name = self.session.query(AlternativeName).filter(
-                        AlternativeName.alt_name == identifier).first()
-                    if alt_name is None:
-                        raise KeyError(identifier)
-                    mod = alt_name.modification
-                return mod
-            else:
-                qname = "%%%s%%" % identifier
-                mod = self.session.query(Modification).filter(
-                    (Modification.full_name.like(qname)) |
-                    (Modification.code_name.like(qname)) |
-                    (Modification.ex_code_name.like(qname))).first()
-                if mod is None:
-                    alt_name = self.session.query(AlternativeName).filter(
-                        AlternativeName.alt_name.like(qname)).first()
-                    if alt_name is None:
-                        raise KeyError(identifier)
-                    mod = alt_name.modification
-                return mod
+            self._cache[key] = mod
+        return mod
 
     by_title = by_name = get
 
     __getitem__ = get
 
+    def get_many(self, identifiers, strict=True):
+        '''
+        Find many :class:`Modification` instances at once, loading any
+        not already cached with a single query.
+
+        Parameters
+        ----------
+        identifiers: iterable
+            Unimod record ids or modification names
+        strict: bool
+            As in :meth:`get`
+
+        Returns
+        -------
+        list
+
+        Raises
+        ------
+        KeyError
+        '''
+        identifiers = list(identifiers)
+        found = {}
+        missing = {}
+        for identifier in identifiers:
+            key = (identifier, strict)
+            mod = self._cache.get(key)
+            if mod is None:
+                missing[key] = self._resolve(identifier, strict)
+            else:
+                found[key] = mod
+        if missing:
+            loaded = {
+                mod.id: mod for mod in self.session.query(Modification).filter(
+                    Modification.id.in_(set(missing.values())))
+            }
+            for key, mod_id in missing.items():
+                try:
+                    mod = found[key] = loaded[mod_id]
+                except KeyError:
+                    raise KeyError(key[0])
+                self._cache[key] = mod
+        return [found[identifier, strict] for identifier in identifiers]
+
+    def load_all(self, relationships=("specificities", "_alt_names", "notes"), strategy="selectin"):
+        '''
+        Load every :class:`Modification` along with the named relationships,
+        so that touching those relationships on each modification afterwards
+        issues no further queries.
+
+        Parameters
+        ----------
+        relationships: iterable of str
+            Relationship attribute names of :class:`Modification`. Nested
+            relationships are given as dotted paths, e.g. "specificities.position"
+        strategy: str
+            One of "selectin", "subquery" or "joined". "selectin" and "subquery"
+            issue one query per relationship, while "joined" fetches everything
+            in a single, wider query.
+
+        Returns
+        -------
+        list of Modification
+        '''
+        if strategy not in _eager_strategies:
+            raise ValueError("Unknown loading strategy %r" % (strategy,))
+        loader = strategy + "load"
+        options = []
+        for path in relationships:
+            option = None
+            model = Modification
+            for name in path.split("."):
+                attr = getattr(model, name)
+                if option is None:
+                    option = getattr(orm, loader)(attr)
+                else:
+                    option = getattr(option, loader)(attr)
+                model = attr.property.mapper.class_
+            options.append(option)
+        return self.session.query(Modification).options(*options).order_by(Modification.id).all()
+
+    def records(self):
+        '''
+        Iterate over every modification as a plain :class:`~.ModificationRecord`,
+        using three queries in total.
+
+        Yields
+        ------
+        ModificationRecord
+        '''
+        alt_names = {}
+        for mod_id, alt_name in self.session.query(
+                AlternativeName.modification_id, AlternativeName.alt_name).order_by(AlternativeName.id):
+            alt_names.setdefault(mod_id, []).append(alt_name)
+        specificities = self.specificity_index
+        rows = self.session.query(
+            Modification.id, Modification.full_name, Modification.code_name,
+            Modification.ex_code_name, Modification.monoisotopic_mass,
+            Modification.average_mass, Modification._composition,
+            Modification.approved).order_by(Modification.id)
+        for row in rows:
+            yield ModificationRecord(
+                *row, alternative_names=alt_names.get(row[0], ()),
+                specificities=specificities.get(row[0], ()))
+
+    def export_snapshot(self, path, source=None):
+        '''
+        Write every modification to a read-only snapshot at `path`, which
+        :class:`~.UnimodSnapshot` can load without SQLAlchemy.
+
+        Parameters
+        ----------
+        path: str
+        source: object, optional
+            Describes this database, see :func:`~.unimod_snapshot.write_snapshot`
+        '''
+        write_snapshot(self.records(), path, source)
+
     @property
     def mods(self):
         return self.session.query(Modification).all()
@@ -741,5 +1273,5 @@ class Unimod(object):
         return iter(self.session.query(Modification).yield_per(1000))
 
 
-def load(path=None):
-    return Unimod(path)
+def load(path=None, source=_unimod_xml_download_url):
+    return Unimod(path, source)
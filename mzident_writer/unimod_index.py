@@ -0,0 +1,278 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+
+from .utils import _numpy
+
+
+def normalize_name(name):
+    '''
+    Case-fold and trim a modification name for lookup.
+
+    Parameters
+    ----------
+    name: str
+
+    Returns
+    -------
+    str
+    '''
+    return name.strip().lower()
+
+
+class LRUCache(object):
+    '''
+    A mapping which holds at most :attr:`maxsize` entries, discarding
+    the least recently used entry when full.
+
+    Attributes
+    ----------
+    maxsize: int
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._store = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._store.pop(key)
+        except KeyError:
+            return default
+        self._store[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._store.pop(key, None)
+        self._store[key] = value
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __len__(self):
+        return len(self._store)
+
+    def clear(self):
+        self._store.clear()
+
+
+class NameIndex(object):
+    '''
+    Map names to keys with exact, case-folded and substring lookups.
+
+    Each name is registered with a key and whether it is a primary name
+    or an alternative one. When several keys share a name, primary names
+    win over alternative names, and then the smallest key wins.
+
+    Substring searches are answered from an n-gram index over the case-folded
+    names, so only names sharing every n-gram of the query are compared.
+
+    Attributes
+    ----------
+    ngram_size: int
+    '''
+    def __init__(self, ngram_size=3):
+        self.ngram_size = ngram_size
+        self._exact = {}
+        self._folded = {}
+        self._names = []
+        self._ngrams = {}
+
+    def _ngrams_of(self, name):
+        n = self.ngram_size
+        return set(name[i:i + n] for i in range(len(name) - n + 1))
+
+    def add(self, name, key, primary=True):
+        '''
+        Register `name` for `key`.
+
+        Parameters
+        ----------
+        name: str
+        key: object
+        primary: bool
+            Whether `name` is a primary name for `key` rather than an alternative
+        '''
+        rank = (0 if primary else 1, key)
+        current = self._exact.get(name)
+        if current is None or rank < current:
+            self._exact[name] = rank
+        folded = normalize_name(name)
+        current = self._folded.get(folded)
+        if current is None:
+            position = len(self._names)
+            self._names.append(folded)
+            for ngram in self._ngrams_of(folded):
+                self._ngrams.setdefault(ngram, set()).add(position)
+        if current is None or rank < current:
+            self._folded[folded] = rank
+
+    def find(self, name):
+        '''
+        Find the key for `name`, trying an exact match before
+        a case-folded one.
+
+        Parameters
+        ----------
+        name: str
+
+        Returns
+        -------
+        object
+
+        Raises
+        ------
+        KeyError
+        '''
+        try:
+            return self._exact[name][1]
+        except KeyError:
+            try:
+                return self._folded[normalize_name(name)][1]
+            except KeyError:
+                raise KeyError(name)
+
+    def search(self, query):
+        '''
+        Find the key for the best name containing `query`, ignoring case.
+
+        Parameters
+        ----------
+        query: str
+
+        Returns
+        -------
+        object
+
+        Raises
+        ------
+        KeyError
+        '''
+        folded = normalize_name(query)
+        if len(folded) < self.ngram_size:
+            candidates = range(len(self._names))
+        else:
+            postings = sorted(
+                (self._ngrams.get(ngram, set()) for ngram in self._ngrams_of(folded)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        best = None
+        for position in candidates:
+            name = self._names[position]
+            if folded in name:
+                rank = self._folded[name]
+                if best is None or rank < best:
+                    best = rank
+        if best is None:
+            raise KeyError(query)
+        return best[1]
+
+    def __contains__(self, name):
+        try:
+            self.find(name)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return len(self._names)
+
+
+SpecificityRecord = namedtuple("SpecificityRecord", ("residue", "position", "classification", "hidden"))
+
+
+class MassIndex(object):
+    '''
+    Find keys whose mass lies within a tolerance of a query mass, by binary
+    search over a sorted array of masses.
+
+    Results may be filtered by the residue and position of each key's
+    specificities, given as a mapping from key to a sequence of
+    :class:`SpecificityRecord`.
+
+    Attributes
+    ----------
+    masses: list
+        The indexed masses in ascending order
+    keys: list
+        The key for each entry of :attr:`masses`
+    specificities: dict
+    '''
+    def __init__(self, entries, specificities=None):
+        pairs = sorted((mass, key) for key, mass in entries if mass is not None)
+        self.masses = [mass for mass, key in pairs]
+        self.keys = [key for mass, key in pairs]
+        self.specificities = specificities or {}
+        self._array = None
+
+    def _width(self, mass, tolerance, unit):
+        if unit == "Da":
+            return tolerance
+        elif unit == "ppm":
+            return abs(mass) * tolerance * 1e-6
+        raise ValueError("Unknown tolerance unit %r" % (unit,))
+
+    def _matches(self, key, residue, position):
+        for specificity in self.specificities.get(key, ()):
+            if residue is not None and specificity.residue != residue:
+                continue
+            if position is not None and specificity.position != position:
+                continue
+            return True
+        return False
+
+    def _select(self, lo, hi, residue, position):
+        keys = self.keys[lo:hi]
+        if residue is None and position is None:
+            return keys
+        return [key for key in keys if self._matches(key, residue, position)]
+
+    def search(self, mass, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        Find all keys whose mass is within `tolerance` of `mass`.
+
+        Parameters
+        ----------
+        mass: float
+        tolerance: float
+        unit: str
+            Either "Da" or "ppm", where ppm is relative to `mass`
+        residue: str, optional
+            Only keep keys with a specificity for this residue
+        position: str, optional
+            Only keep keys with a specificity at this position, e.g. "Anywhere"
+
+        Returns
+        -------
+        list
+            Matching keys in ascending order of mass
+        '''
+        width = self._width(mass, tolerance, unit)
+        lo = bisect_left(self.masses, mass - width)
+        hi = bisect_right(self.masses, mass + width)
+        return self._select(lo, hi, residue, position)
+
+    def search_many(self, masses, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        As :meth:`search`, for a whole array of query masses at once.
+        Requires NumPy.
+
+        Returns
+        -------
+        list of list
+        '''
+        np = _numpy("search_many")
+        if self._array is None:
+            self._array = np.array(self.masses, dtype=float)
+        masses = np.asarray(masses, dtype=float)
+        if unit == "Da":
+            width = tolerance
+        elif unit == "ppm":
+            width = np.abs(masses) * tolerance * 1e-6
+        else:
+            raise ValueError("Unknown tolerance unit %r" % (unit,))
+        lows = np.searchsorted(self._array, masses - width, side="left")
+        highs = np.searchsorted(self._array, masses + width, side="right")
+        return [self._select(lo, hi, residue, position) for lo, hi in zip(lows, highs)]
+
+    def __len__(self):
+        return len(self.masses)
@@ -0,0 +1,405 @@
+'''
+A compact, read-only copy of the Unimod modification tables which can be
+loaded without SQLAlchemy.
+
+A snapshot is written once from a :class:`~.unimod.Unimod` database with
+:meth:`~.unimod.Unimod.export_snapshot`, and stores each modification's
+scalar columns as parallel arrays, with alternative names and specificities
+flattened into arrays of their own. :class:`UnimodSnapshot` loads it with a
+single unpickling call and answers the same :meth:`~UnimodSnapshot.get`,
+:meth:`~UnimodSnapshot.get_many` and :meth:`~UnimodSnapshot.search_mass`
+queries as :class:`~.unimod.Unimod`, returning :class:`ModificationRecord`
+instances instead of ORM objects.
+'''
+import os
+import math
+import threading
+
+from array import array
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .unimod_index import NameIndex, MassIndex, SpecificityRecord, LRUCache
+
+
+SNAPSHOT_FORMAT = "mzident_writer.unimod_snapshot"
+SNAPSHOT_VERSION = 2
+
+
+class ModificationRecord(object):
+    '''
+    A plain, immutable description of a single Unimod modification.
+
+    Attributes
+    ----------
+    id: int
+    full_name: str
+    code_name: str
+    ex_code_name: str
+    monoisotopic_mass: float
+    average_mass: float
+    formula: str
+        The Unimod composition string, e.g. "H(2) C(2) O"
+    approved: bool
+    alternative_names: tuple of str
+    specificities: tuple of SpecificityRecord
+    '''
+    __slots__ = ("id", "full_name", "code_name", "ex_code_name", "monoisotopic_mass",
+                 "average_mass", "formula", "approved", "alternative_names", "specificities")
+
+    def __init__(self, id, full_name, code_name, ex_code_name, monoisotopic_mass,
+                 average_mass, formula, approved, alternative_names=(), specificities=()):
+        self.id = id
+        self.full_name = full_name
+        self.code_name = code_name
+        self.ex_code_name = ex_code_name
+        self.monoisotopic_mass = monoisotopic_mass
+        self.average_mass = average_mass
+        self.formula = formula
+        self.approved = approved
+        self.alternative_names = tuple(alternative_names)
+        self.specificities = tuple(specificities)
+
+    @property
+    def accession(self):
+        return "UNIMOD:%d" % self.id
+
+    @property
+    def name(self):
+        return self.ex_code_name or self.code_name
+
+    def __eq__(self, other):
+        try:
+            return self.id == other.id
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __getstate__(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "ModificationRecord(%d, %r, %r)" % (self.id, self.code_name, self.monoisotopic_mass)
+
+
+def _mass_value(value):
+    return float('nan') if value is None else value
+
+
+def _mass_or_none(value):
+    return None if math.isnan(value) else value
+
+
+def _snapshot_state(records, source=None):
+    ids = array('l')
+    monoisotopic_masses = array('d')
+    average_masses = array('d')
+    approved = array('b')
+    full_names = []
+    code_names = []
+    ex_code_names = []
+    formulae = []
+    alt_name_offsets = array('l', [0])
+    alt_names = []
+    specificity_offsets = array('l', [0])
+    residues = []
+    positions = []
+    classifications = []
+    hidden = array('b')
+    for record in records:
+        ids.append(record.id)
+        monoisotopic_masses.append(_mass_value(record.monoisotopic_mass))
+        average_masses.append(_mass_value(record.average_mass))
+        approved.append(bool(record.approved))
+        full_names.append(record.full_name)
+        code_names.append(record.code_name)
+        ex_code_names.append(record.ex_code_name)
+        formulae.append(record.formula)
+        alt_names.extend(record.alternative_names)
+        alt_name_offsets.append(len(alt_names))
+        for specificity in record.specificities:
+            residues.append(specificity.residue)
+            positions.append(specificity.position)
+            classifications.append(specificity.classification)
+            hidden.append(bool(specificity.hidden))
+        specificity_offsets.append(len(residues))
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "source": source,
+        "id": ids,
+        "monoisotopic_mass": monoisotopic_masses,
+        "average_mass": average_masses,
+        "approved": approved,
+        "full_name": full_names,
+        "code_name": code_names,
+        "ex_code_name": ex_code_names,
+        "formula": formulae,
+        "alt_name_offsets": alt_name_offsets,
+        "alt_names": alt_names,
+        "specificity_offsets": specificity_offsets,
+        "residue": residues,
+        "position": positions,
+        "classification": classifications,
+        "hidden": hidden,
+    }
+
+
+def write_snapshot(records, path, source=None):
+    '''
+    Write `records` to `path` in the snapshot format.
+
+    Parameters
+    ----------
+    records: iterable of ModificationRecord
+    path: str
+    source: object, optional
+        A picklable description of the database the records were read from,
+        kept as :attr:`UnimodSnapshot.source`
+    '''
+    state = _snapshot_state(records, source)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(state, handle, 2)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+class UnimodSnapshot(object):
+    '''
+    Look up Unimod modifications by id, name or mass from a snapshot
+    written by :func:`write_snapshot`.
+
+    :class:`ModificationRecord` instances are built on demand from the
+    snapshot's arrays and kept in a bounded :class:`~.LRUCache`.
+
+    Instances may be shared between threads. As with :class:`~.unimod.Unimod`,
+    each thread keeps its own cache of records, and the name, mass and
+    specificity indices are built once under a lock and then shared.
+
+    Attributes
+    ----------
+    path: str
+        The snapshot file, or :const:`None` if built with :meth:`from_records`
+    id: str
+        The identifier of the controlled vocabulary, set by its :class:`~.ProvidedCV`
+    source: object
+        The description of the source database given to :func:`write_snapshot`,
+        used to tell whether the snapshot is out of date
+    '''
+    def __init__(self, path, cache_size=1024, state=None):
+        self.path = path
+        self.id = None
+        if state is None:
+            with open(path, 'rb') as handle:
+                state = pickle.load(handle)
+        if state.get("format") != SNAPSHOT_FORMAT or state.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("%s is not a version %d Unimod snapshot" % (path, SNAPSHOT_VERSION))
+        self.source = state["source"]
+        self._state = state
+        self._positions = {mod_id: i for i, mod_id in enumerate(state['id'])}
+        self._name_index = None
+        self._mass_index = None
+        self._specificity_index = None
+        self._index_lock = threading.RLock()
+        self._cache_size = cache_size
+        self._local = threading.local()
+
+    @classmethod
+    def from_records(cls, records, cache_size=1024):
+        '''
+        Build a snapshot in memory, without writing it to a file.
+
+        Parameters
+        ----------
+        records: iterable of ModificationRecord
+        cache_size: int
+
+        Returns
+        -------
+        UnimodSnapshot
+        '''
+        return cls(None, cache_size, _snapshot_state(records))
+
+    @property
+    def _cache(self):
+        try:
+            return self._local.cache
+        except AttributeError:
+            cache = self._local.cache = LRUCache(self._cache_size)
+            return cache
+
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            with self._index_lock:
+                if self._name_index is None:
+                    self._name_index = self._build_name_index()
+        return self._name_index
+
+    def _build_name_index(self):
+        state = self._state
+        index = NameIndex()
+        for i, mod_id in enumerate(state['id']):
+            for name in (state['full_name'][i], state['code_name'][i], state['ex_code_name'][i]):
+                if name:
+                    index.add(name, mod_id)
+        offsets = state['alt_name_offsets']
+        for i, mod_id in enumerate(state['id']):
+            for name in state['alt_names'][offsets[i]:offsets[i + 1]]:
+                if name:
+                    index.add(name, mod_id, primary=False)
+        return index
+
+    def _specificities(self, i):
+        state = self._state
+        start = state['specificity_offsets'][i]
+        end = state['specificity_offsets'][i + 1]
+        return [
+            SpecificityRecord(
+                state['residue'][j], state['position'][j],
+                state['classification'][j], bool(state['hidden'][j]))
+            for j in range(start, end)
+        ]
+
+    @property
+    def specificity_index(self):
+        '''
+        A mapping from modification id to a list of :class:`~.SpecificityRecord`.
+        '''
+        if self._specificity_index is None:
+            with self._index_lock:
+                if self._specificity_index is None:
+                    self._specificity_index = {
+                        mod_id: self._specificities(i) for i, mod_id in enumerate(self._state['id'])
+                    }
+        return self._specificity_index
+
+    @property
+    def mass_index(self):
+        if self._mass_index is None:
+            with self._index_lock:
+                if self._mass_index is None:
+                    state = self._state
+                    self._mass_index = MassIndex(
+                        ((mod_id, _mass_or_none(mass))
+                         for mod_id, mass in zip(state['id'], state['monoisotopic_mass'])),
+                        self.specificity_index)
+        return self._mass_index
+
+    def _record(self, mod_id):
+        try:
+            i = self._positions[mod_id]
+        except KeyError:
+            raise KeyError(mod_id)
+        state = self._state
+        offsets = state['alt_name_offsets']
+        return ModificationRecord(
+            mod_id, state['full_name'][i], state['code_name'][i], state['ex_code_name'][i],
+            _mass_or_none(state['monoisotopic_mass'][i]), _mass_or_none(state['average_mass'][i]),
+            state['formula'][i], bool(state['approved'][i]),
+            state['alt_names'][offsets[i]:offsets[i + 1]], self._specificities(i))
+
+    def _resolve(self, identifier, strict=True):
+        if isinstance(identifier, int):
+            return identifier
+        elif strict:
+            return self.name_index.find(identifier)
+        else:
+            return self.name_index.search(identifier)
+
+    def get(self, identifier, strict=True):
+        '''
+        Find a :class:`ModificationRecord` by id or by name.
+
+        Parameters
+        ----------
+        identifier: int or str
+            A Unimod record id, or one of the modification's names
+        strict: bool
+            If :const:`True`, names must match fully, ignoring case. Otherwise
+            the first modification with a name containing `identifier` is returned
+
+        Returns
+        -------
+        ModificationRecord
+
+        Raises
+        ------
+        KeyError
+        '''
+        key = (identifier, strict)
+        record = self._cache.get(key)
+        if record is None:
+            try:
+                record = self._record(self._resolve(identifier, strict))
+            except KeyError:
+                raise KeyError(identifier)
+            self._cache[key] = record
+        return record
+
+    by_title = by_name = get
+
+    __getitem__ = get
+
+    def get_many(self, identifiers, strict=True):
+        '''
+        As :meth:`get`, for many identifiers at once.
+
+        Returns
+        -------
+        list of ModificationRecord
+        '''
+        return [self.get(identifier, strict) for identifier in identifiers]
+
+    def search_mass(self, mass, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        Find all modifications whose monoisotopic mass is within `tolerance`
+        of `mass`, with the same parameters as :meth:`.Unimod.search_mass`.
+
+        Returns
+        -------
+        list of ModificationRecord
+        '''
+        return self.get_many(self.mass_index.search(mass, tolerance, unit, residue, position))
+
+    def search_masses(self, masses, tolerance=0.01, unit="Da", residue=None, position=None):
+        '''
+        As :meth:`search_mass`, for an array of masses at once. Requires NumPy.
+
+        Returns
+        -------
+        list of list of ModificationRecord
+        '''
+        hits = self.mass_index.search_many(masses, tolerance, unit, residue, position)
+        return [self.get_many(ids) for ids in hits]
+
+    @property
+    def mods(self):
+        return list(self)
+
+    def __iter__(self):
+        return (self._record(mod_id) for mod_id in self._state['id'])
+
+    def __len__(self):
+        return len(self._state['id'])
+
+    def __repr__(self):
+        return "UnimodSnapshot(%r)" % (self.path,)
+
+
+def load(path, cache_size=1024):
+    return UnimodSnapshot(path, cache_size)
@@ -0,0 +1,13 @@
+'''
+Helpers shared by modules which have no other reason to depend on one another.
+'''
+
+
+def _numpy(feature):
+    # NumPy is only imported by the features which need it, so that
+    # importing the modules using it stays cheap
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("%s requires NumPy" % (feature,))
+    return numpy
@@ -1,8 +1,13 @@
+import time
+from array import array
+
 from collections import Iterable, Mapping
 from contextlib import contextmanager
 from .components import (
     ComponentDispatcher, etree, common_units, element, _element,
     id_maker, default_cv_list, CVParam, UserParam)
+from .protein_grouping import ANCHOR, SAME_SET, SUB_SET
+from .output_buffer import WriteCombiningBuffer
 
 try:
     basestring
@@ -19,7 +24,37 @@ def ensure_iterable(obj):
 _t = tuple()
 
 
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return tuple(sorted(((k, _freeze(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if hasattr(value, "element") and hasattr(value, "param"):
+        # A Modification component
+        return (_freeze(value.element.attrs), _freeze(value.param.attrs))
+    return value
+
+
+def _peptide_key(peptide):
+    modifications = peptide.get("modifications") or ()
+    return (peptide["peptide_sequence"], tuple(sorted((_freeze(mod) for mod in modifications), key=repr)))
+
+
+_protein_roles = {
+    ANCHOR: CVParam(accession="MS:1001591", name="anchor protein", ref="PSI-MS"),
+    SAME_SET: CVParam(accession="MS:1001594", name="sequence same-set protein", ref="PSI-MS"),
+    SUB_SET: CVParam(accession="MS:1001596", name="sequence sub-set protein", ref="PSI-MS"),
+}
+
+
+def _timed_load(cv):
+    start = time.time()
+    cv.vocabulary
+    return cv.id, time.time() - start
+
+
 class XMLWriterMixin(object):
+    encoding = "utf-8"
 
     @contextmanager
     def element(self, element_name, **kwargs):
@@ -53,12 +88,41 @@ class XMLWriterMixin(object):
             else:
                 raise
 
+    def write_fragment(self, data):
+        """
+        Write pre-rendered XML directly to the output, after everything
+        written through the incremental writer so far.
+
+        Parameters
+        ----------
+        data : bytes or unicode
+            Well-formed XML for the current position in the document. Text
+            is encoded in the document's :attr:`encoding`
+        """
+        if self.writer is None:
+            raise ValueError(
+                "This writer has not yet been created."
+                " Make sure to use this object as a context manager using the "
+                "`with` notation or by explicitly calling its __enter__ and "
+                "__exit__ methods.")
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode(self.encoding)
+        self.writer.flush()
+        self.output.write(data)
+
+    def _section_boundary(self):
+        if isinstance(self.output, WriteCombiningBuffer) and self.output.flush_on_section:
+            self.writer.flush()
+            self.output.section_boundary()
+
 
 class DocumentSection(ComponentDispatcher, XMLWriterMixin):
-    def __init__(self, section, writer, parent_context):
+    def __init__(self, section, writer, parent_context, output=None, encoding="utf-8"):
         super(DocumentSection, self).__init__(parent_context)
         self.section = section
         self.writer = writer
+        self.output = output
+        self.encoding = encoding
 
     def __enter__(self):
         self.toplevel = element(self.writer, self.section)
@@ -66,7 +130,10 @@ class DocumentSection(ComponentDispatcher, XMLWriterMixin):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.toplevel.__exit__(exc_type, exc_value, traceback)
-        self.writer.flush()
+        if self.output is None:
+            self.writer.flush()
+        else:
+            self._section_boundary()
 
 
 # ----------------------
@@ -88,12 +155,40 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
     attribute and access to all `Component` objects pre-bound to that context with attribute-access
     notation.
 
+    Parameters
+    ----------
+    outfile : file
+    vocabularies : list, optional
+    context : :class:`.DocumentContext`, optional
+    buffer_size : int
+        The size of the write-combining buffer in front of `outfile`, or 0 to
+        write to it directly
+    flush_interval : float, optional
+        Flush the buffer whenever this many seconds have passed since it was
+        last flushed
+    flush_on_section : bool
+        Flush the buffer after writing each section
+    track_evidence : bool
+        Record the PeptideEvidence and SpectrumIdentificationItems written in an
+        :class:`~.protein_grouping.EvidenceIndex`, see :meth:`.DocumentContext.track_evidence`.
+        Required to infer protein groups in :meth:`protein_detection_list` and to look up
+        the decoy status of identifications in :meth:`spectrum_identification_list`
+    **kwargs
+        Passed to :class:`lxml.etree.xmlfile`
+
     Attributes
     ----------
+    encoding : str
+        The encoding of the document, given to :class:`lxml.etree.xmlfile`, in which
+        :meth:`write_fragment` encodes text
     outfile : file
         The open, writable file descriptor which XML will be written to.
+    output : :class:`~.output_buffer.WriteCombiningBuffer` or file
+        What :attr:`xmlfile` writes to. Unless `buffer_size` is 0 this buffers :attr:`outfile`,
+        so that it receives a few large writes rather than many small ones. Its
+        :meth:`~.output_buffer.WriteCombiningBuffer.stats` report how many writes were made
     xmlfile : lxml.etree.xmlfile
-        The incremental XML file wrapper which organizes file writes onto :attr:`outfile`.
+        The incremental XML file wrapper which organizes file writes onto :attr:`output`.
         Kept to control context.
     writer : lxml.etree._IncrementalFileWriter
         The incremental XML writer produced by :attr:`xmlfile`. Kept to control context.
@@ -101,13 +196,68 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
         The top level incremental xml writer element which will be closed at the end
         of file generation. Kept to control context
     context : :class:`.DocumentContext`
+        Created for this writer unless one is passed in, such as a
+        :class:`~.spilling_context.SpillingDocumentContext` for very large documents
+    vocabulary_load_times : dict
+        The time in seconds taken to load each controlled vocabulary, keyed by
+        vocabulary id, populated by :meth:`prefetch_vocabularies`
+    mass_batch_size : int
+        The number of identifications whose missing `calculatedMassToCharge` is
+        calculated together by :attr:`mass_engine`. Results are read from the
+        stream given to :meth:`spectrum_identification_list` in chunks holding
+        about this many identifications
     """
-    def __init__(self, outfile, vocabularies=None, **kwargs):
-        super(MzIdentMLWriter, self).__init__(vocabularies)
+    mass_batch_size = 10000
+
+    def __init__(self, outfile, vocabularies=None, context=None, buffer_size=2 ** 20, flush_interval=None,
+                 flush_on_section=False, track_evidence=False, **kwargs):
+        super(MzIdentMLWriter, self).__init__(context=context, vocabularies=vocabularies)
+        if track_evidence:
+            self.context.track_evidence()
         self.outfile = outfile
-        self.xmlfile = etree.xmlfile(outfile, **kwargs)
+        if buffer_size:
+            self.output = WriteCombiningBuffer(
+                outfile, buffer_size, flush_interval=flush_interval, flush_on_section=flush_on_section)
+        else:
+            self.output = outfile
+        self.xmlfile = etree.xmlfile(self.output, **kwargs)
+        self.encoding = kwargs.get("encoding") or "utf-8"
         self.writer = None
         self.toplevel = None
+        self.vocabulary_load_times = {}
+        self._mass_engine = None
+
+    def prefetch_vocabularies(self, workers=None):
+        """
+        Load every controlled vocabulary in :attr:`vocabularies` concurrently
+        on a thread pool.
+
+        Vocabularies are otherwise loaded lazily on their first term lookup, which
+        stalls whichever section happens to trigger it. Call this before writing any
+        section to pay that cost up front.
+
+        Parameters
+        ----------
+        workers : int, optional
+            The number of threads to use. Defaults to one per vocabulary
+
+        Returns
+        -------
+        dict
+            The time in seconds taken to load each vocabulary, keyed by vocabulary id
+        """
+        from multiprocessing.pool import ThreadPool
+        vocabularies = list(self.vocabularies)
+        if not vocabularies:
+            return {}
+        pool = ThreadPool(workers or len(vocabularies))
+        try:
+            timings = pool.map(_timed_load, vocabularies)
+        finally:
+            pool.close()
+            pool.join()
+        self.vocabulary_load_times.update(timings)
+        return dict(timings)
 
     def _begin(self):
         self.writer = self.xmlfile.__enter__()
@@ -121,10 +271,15 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
         self.toplevel.__exit__(exc_type, exc_value, traceback)
         self.writer.flush()
         self.xmlfile.__exit__(exc_type, exc_value, traceback)
-        self.outfile.close()
+        self.close()
 
     def close(self):
-        self.outfile.close()
+        self.output.close()
+        # A context given to the writer may hold resources, such as the database
+        # of a SpillingDocumentContext
+        close_context = getattr(self.context, "close", None)
+        if close_context is not None:
+            close_context()
 
     def controlled_vocabularies(self, vocabularies=None):
         if vocabularies is None:
@@ -132,6 +287,7 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
         self.vocabularies.extend(vocabularies)
         cvlist = self.CVList(self.vocabularies)
         cvlist.write(self.writer)
+        self._section_boundary()
 
     def providence(self, software=tuple(), owner=None, organization=None):
         """
@@ -157,6 +313,7 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
         self.GenericCollection("AnalysisSoftwareList", software).write(self.writer)
         self.Provider(contact=owner.id).write(self.writer)
         self.AuditCollection([owner], [organization]).write(self.writer)
+        self._section_boundary()
 
     def inputs(self, source_files=tuple(), search_databases=tuple(), spectra_data=tuple()):
         source_files = [self.SourceFile(**(s or {})) for s in ensure_iterable(source_files)]
@@ -164,13 +321,123 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
         spectra_data = [self.SpectraData(**(s or {})) for s in ensure_iterable(spectra_data)]
 
         self.Inputs(source_files, search_databases, spectra_data).write(self.writer)
+        self._section_boundary()
+
+    def sequence_collection(self, db_sequences=tuple(), peptides=tuple(), peptide_evidence=tuple(), source=None,
+                            referenced_only=False, deduplicate=False):
+        """
+        Write the SequenceCollection section.
 
-    def sequence_collection(self, db_sequences=tuple(), peptides=tuple(), peptide_evidence=tuple()):
-        db_sequences = (self.DBSequence(**(s or {})) for s in ensure_iterable(db_sequences))
+        Parameters
+        ----------
+        db_sequences : dict or list of dict
+            Each specifying a :class:`DBSequence`
+        peptides : dict or list of dict
+            Each specifying a :class:`Peptide`
+        peptide_evidence : dict or list of dict
+            Each specifying a :class:`PeptideEvidence`
+        source : :class:`~.fasta.FastaFile`, optional
+            A FASTA file to read sequences from for any `db_sequences`
+            which do not give one
+        referenced_only : bool
+            Only write the DBSequences referenced by `peptide_evidence`. If
+            no `db_sequences` are given, they are drawn from `source` in file
+            order, where the id of each protein is its position in the file
+            counting from one, as in :meth:`~.fasta.FastaFile.select`
+        deduplicate : bool
+            Write each distinct Peptide, by sequence and modifications, and
+            each distinct PeptideEvidence, by peptide, protein and position,
+            only once. The ids of duplicates refer to the first entity written
+            with the same content. See :meth:`.DocumentContext.deduplication_stats`
+        """
+        if referenced_only:
+            peptide_evidence = list(ensure_iterable(peptide_evidence))
+            db_sequences = self._referenced_db_sequences(db_sequences, peptide_evidence, source)
+        if deduplicate:
+            peptides = self._deduplicated("Peptide", peptides, _peptide_key)
+            peptide_evidence = self._deduplicated(
+                "PeptideEvidence", peptide_evidence, self._peptide_evidence_key)
+        db_sequences = (self.DBSequence(**dict(s or {}, source=(s or {}).get("source", source)))
+                        for s in ensure_iterable(db_sequences))
         peptides = (self.Peptide(**(s or {})) for s in ensure_iterable(peptides))
         peptide_evidence = (self.PeptideEvidence(**(s or {})) for s in ensure_iterable(peptide_evidence))
 
         self.SequenceCollection(db_sequences, peptides, peptide_evidence).write(self.writer)
+        self._section_boundary()
+
+    def _referenced_db_sequences(self, db_sequences, peptide_evidence, source):
+        referenced = ((s or {})["db_sequence_id"] for s in peptide_evidence)
+        if db_sequences:
+            referenced = set(referenced)
+            return (s for s in ensure_iterable(db_sequences) if s["id"] in referenced)
+        if source is None:
+            raise ValueError("Either db_sequences or a source is required")
+        return source.select(referenced)
+
+    def _deduplicated(self, type_name, specs, key):
+        for spec in ensure_iterable(specs):
+            spec = spec or {}
+            if self.context.intern(type_name, key(spec), spec["id"]):
+                yield spec
+
+    def _peptide_evidence_key(self, evidence):
+        # Peptides are written before their evidence, so the peptide reference
+        # already resolves to the canonical Peptide
+        return (self.context["Peptide"][evidence["peptide_id"]],
+                self.context["DBSequence"][evidence["db_sequence_id"]],
+                evidence["start_position"], evidence["end_position"])
+
+    def protein_detection_list(self, id=1, protein_ambiguity_groups=None):
+        """
+        Write a ProteinDetectionList.
+
+        Parameters
+        ----------
+        id : int
+        protein_ambiguity_groups : dict or list of dict, optional
+            Each specifying a :class:`ProteinAmbiguityGroup`. If not given, the
+            proteins with identified PeptideEvidence written so far are grouped
+            with :func:`~.protein_grouping.group_proteins`. Each group holds a
+            :class:`ProteinDetectionHypothesis` per protein, annotated as an
+            anchor, sequence same-set or sequence sub-set protein. Requires NumPy,
+            and the writer to have been created with `track_evidence=True`
+        """
+        if protein_ambiguity_groups is None:
+            if self.context.evidence_index is None:
+                raise ValueError(
+                    "Protein groups can only be inferred by a writer created with track_evidence=True")
+            protein_ambiguity_groups = self._inferred_ambiguity_groups()
+        groups = (self.ProteinAmbiguityGroup(**(g or {})) for g in ensure_iterable(protein_ambiguity_groups))
+        self.ProteinDetectionList(groups, id=id).write(self.writer)
+        self._section_boundary()
+
+    def _inferred_ambiguity_groups(self):
+        index = self.context.evidence_index
+        if not len(index):
+            return
+        groups = index.group(identified_only=True)
+        order, starts = index.evidence_by_protein()
+        group_id = hypothesis_id = 0
+        for members in groups.members():
+            hypotheses = []
+            for protein in members:
+                peptide_hypotheses = []
+                for pair in order[starts[protein]:starts[protein + 1]]:
+                    evidence_id = index.evidence_ids[pair]
+                    items = index.identifications(evidence_id)
+                    if items:
+                        peptide_hypotheses.append({
+                            "peptide_evidence_id": evidence_id,
+                            "spectrum_identification_item_ids": items})
+                if peptide_hypotheses:
+                    hypothesis_id += 1
+                    hypotheses.append({
+                        "id": hypothesis_id, "db_sequence_id": index.protein_ids[protein],
+                        "peptide_hypotheses": peptide_hypotheses,
+                        "cv_params": [_protein_roles[groups.role[protein]]]})
+            if hypotheses:
+                group_id += 1
+                yield {"id": group_id, "protein_detection_hypotheses": hypotheses}
 
     def spectrum_identification_protocol(self, search_type='ms-ms search', analysis_software_id=1, id=1,
                                          additional_search_params=_t, enzymes=_t, modification_params=_t,
@@ -183,25 +450,164 @@ class MzIdentMLWriter(ComponentDispatcher, XMLWriterMixin):
             parent_tolerance = self.ParentTolerance(*parent_tolerance)
         threshold = self.Threshold(threshold)
         protocol = self.SpectrumIdentificationProtocol(
-            search_type, analysis_software_id, id, additional_search_params, enzymes, modification_params,
-            fragment_tolerance, parent_tolerance, threshold)
+            search_type, analysis_software_id, id, additional_search_params,
+            modification_params=modification_params, enzymes=enzymes,
+            fragment_tolerance=fragment_tolerance, parent_tolerance=parent_tolerance,
+            threshold=threshold)
         protocol.write(self.writer)
+        self._section_boundary()
 
-    def spectrum_identification_list(self, id, identification_results=_t):
-        converting = (self._spectrum_identification_result(**(s or {})) for s in identification_results)
+    def spectrum_identification_list(self, id, identification_results=_t, fdr_threshold=None,
+                                     higher_score_better=True):
+        """
+        Write a SpectrumIdentificationList.
+
+        Parameters
+        ----------
+        id : int
+        identification_results : iterable of dict
+            Each specifying a :class:`SpectrumIdentificationResult`
+        fdr_threshold : float, optional
+            If given, estimate the q-value of every rank 1 identification by
+            target-decoy competition and annotate it with a PSM-level q-value
+            and a distinct peptide-level q-value, setting `passThreshold` by
+            whether its PSM-level q-value is at most `fdr_threshold`.
+            Identifications are decoys if they give `is_decoy`, or otherwise
+            if their PeptideEvidence is a decoy, which requires the writer to
+            have been created with `track_evidence=True`. Peptides are distinguished by
+            their Peptide id, after deduplication. The results are read twice, so
+            a one-shot iterator is held in memory; pass a list or other re-iterable
+            collection to avoid that. Requires NumPy
+        higher_score_better : bool
+            The direction of the numerical `score` of each identification
+        """
+        if fdr_threshold is not None:
+            identification_results = self._annotate_q_values(
+                identification_results, fdr_threshold, higher_score_better)
+        converting = self._spectrum_identification_results(identification_results)
         self.SpectrumIdentificationList(id=id, identification_results=converting).write(self.writer)
+        self._section_boundary()
+
+    def _annotate_q_values(self, identification_results, fdr_threshold, higher_score_better):
+        from . import fdr
+        identification_results = ensure_iterable(identification_results)
+        if iter(identification_results) is identification_results:
+            # A one-shot stream has to be held to be read twice
+            identification_results = list(identification_results)
+        context = self.context
+        index = context.evidence_index
+        decoy_evidence_ids = index.decoy_evidence_ids if index is not None else frozenset()
+        # The first pass keeps only what the q-values are estimated from,
+        # numbering distinct peptides by their canonical Peptide id
+        scores = array('d')
+        is_decoy = array('b')
+        peptides = array('l')
+        peptide_numbers = {}
+        for result in identification_results:
+            for s in ensure_iterable((result or {}).get("identifications", _t)):
+                s = s or {}
+                if s.get("rank", 1) != 1:
+                    continue
+                score = s["score"]
+                scores.append(float(score.value if isinstance(score, CVParam) else score))
+                if "is_decoy" in s:
+                    is_decoy.append(bool(s["is_decoy"]))
+                elif index is None:
+                    raise ValueError(
+                        "Identifications must give is_decoy unless the writer was created with "
+                        "track_evidence=True")
+                else:
+                    is_decoy.append(
+                        context.canonical_id("PeptideEvidence", s["peptide_evidence_id"]) in decoy_evidence_ids)
+                peptide = context.canonical_id("Peptide", s["peptide_id"])
+                peptides.append(peptide_numbers.setdefault(peptide, len(peptide_numbers)))
+        psm_q = fdr.q_values(scores, is_decoy, higher_score_better)
+        peptide_q = fdr.peptide_q_values(scores, is_decoy, peptides, higher_score_better)
+        return self._q_value_annotated(identification_results, psm_q, peptide_q, fdr_threshold)
+
+    def _q_value_annotated(self, identification_results, psm_q, peptide_q, fdr_threshold):
+        from . import fdr
+        i = 0
+        for result in identification_results:
+            result = dict(result or {})
+            identifications = []
+            for s in ensure_iterable(result.get("identifications", _t)):
+                s = dict(s or {})
+                s.pop("is_decoy", None)
+                if s.get("rank", 1) == 1:
+                    q = float(psm_q[i])
+                    s["cv_params"] = list(ensure_iterable(s.get("cv_params", _t))) + [
+                        CVParam(accession=fdr.PSM_LEVEL_Q_VALUE[0], name=fdr.PSM_LEVEL_Q_VALUE[1],
+                                ref="PSI-MS", value=q),
+                        CVParam(accession=fdr.PEPTIDE_LEVEL_Q_VALUE[0], name=fdr.PEPTIDE_LEVEL_Q_VALUE[1],
+                                ref="PSI-MS", value=float(peptide_q[i]))]
+                    s["pass_threshold"] = q <= fdr_threshold
+                    i += 1
+                identifications.append(s)
+            result["identifications"] = identifications
+            yield result
+
+    def _spectrum_identification_results(self, identification_results):
+        batch = []
+        size = 0
+        for result in identification_results:
+            result = dict(result or {})
+            result["identifications"] = [dict(s or {}) for s in ensure_iterable(result.get("identifications", _t))]
+            batch.append(result)
+            size += len(result["identifications"])
+            if size >= self.mass_batch_size:
+                for converted in self._spectrum_identification_batch(batch):
+                    yield converted
+                batch = []
+                size = 0
+        for converted in self._spectrum_identification_batch(batch):
+            yield converted
+
+    def _spectrum_identification_batch(self, results):
+        self._fill_calculated_mass_to_charge([s for result in results for s in result["identifications"]])
+        return [self._spectrum_identification_result(**result) for result in results]
 
     def _spectrum_identification_result(self, spectrum_id, id, spectra_data_id=1, identifications=_t):
         return self.SpectrumIdentificationResult(
             spectra_data_id=spectra_data_id,
             spectrum_id=spectrum_id,
             id=id,
-            identifications=[self._spectrum_identification_item(**(s or {}))
-                             for s in ensure_iterable(identifications)])
-
-    def _spectrum_identification_item(self, calculated_mass_to_charge, experimental_mass_to_charge,
-                                      charge_state, peptide_id, peptide_evidence_id, score, id, cv_params=_t,
-                                      pass_threshold=True, rank=1):
+            identifications=[self._spectrum_identification_item(**s)
+                             for s in identifications])
+
+    def _fill_calculated_mass_to_charge(self, identifications):
+        missing = [s for s in identifications if s.get("calculated_mass_to_charge") is None]
+        if not missing:
+            return
+        for s in missing:
+            if s.get("peptide_sequence") is None:
+                raise ValueError(
+                    "SpectrumIdentificationItem %r needs a calculated_mass_to_charge or a "
+                    "peptide_sequence to calculate it from" % (s.get("id"),))
+        mass_to_charge = self.mass_engine.mass_to_charge(
+            [s["peptide_sequence"] for s in missing],
+            [s["charge_state"] for s in missing],
+            [s.get("modifications") for s in missing])
+        for s, value in zip(missing, mass_to_charge):
+            s["calculated_mass_to_charge"] = float(value)
+
+    @property
+    def mass_engine(self):
+        """
+        The :class:`~.mass.MassEngine` used to calculate the `calculatedMassToCharge`
+        of identifications which give a `peptide_sequence` instead. Modification
+        names are resolved through :meth:`.DocumentContext.modification`.
+        """
+        if self._mass_engine is None:
+            from .mass import MassEngine
+            self._mass_engine = MassEngine(
+                modification_mass=lambda name: self.context.modification(name).monoisotopic_mass)
+        return self._mass_engine
+
+    def _spectrum_identification_item(self, experimental_mass_to_charge, charge_state, peptide_id,
+                                      peptide_evidence_id, score, id, calculated_mass_to_charge=None,
+                                      cv_params=_t, pass_threshold=True, rank=1, peptide_sequence=None,
+                                      modifications=None):
             return self.SpectrumIdentificationItem(
                 calculated_mass_to_charge, experimental_mass_to_charge,
                 charge_state, peptide_id, peptide_evidence_id, score, id,
@@ -0,0 +1,37 @@
+import random
+import time
+
+from mzident_writer import mass
+
+
+def make_peptides(n, seed=1):
+    rng = random.Random(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    return ["".join(rng.choice(residues) for _ in range(rng.randint(7, 30))) for _ in range(n)]
+
+
+def loop_mass_to_charge(sequences, charges):
+    values = []
+    for sequence, charge in zip(sequences, charges):
+        total = mass.WATER
+        for residue in sequence:
+            total += mass.residue_masses[residue]
+        values.append((total + charge * mass.PROTON) / charge)
+    return values
+
+
+def bench(n=200000):
+    sequences = make_peptides(n)
+    charges = [2 + i % 3 for i in range(n)]
+    start = time.time()
+    loop_mass_to_charge(sequences, charges)
+    loop = time.time() - start
+    engine = mass.MassEngine()
+    start = time.time()
+    engine.mass_to_charge(sequences, charges)
+    batch = time.time() - start
+    print("Calculated m/z for %d peptides in %0.3fs with a loop and %0.3fs with MassEngine" % (n, loop, batch))
+
+
+if __name__ == '__main__':
+    bench()
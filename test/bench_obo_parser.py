@@ -0,0 +1,74 @@
+import re
+import sys
+import time
+
+from collections import defaultdict
+
+from mzident_writer import controlled_vocabulary
+from mzident_writer.components import CV
+
+
+def line_parse(handle):
+    # The original parser: every tag of every stanza is collected into a
+    # defaultdict(list), and each reference and relationship is parsed anew.
+    # The relationship comment is optional here, as psi-ms.obo has some
+    # relationships without one.
+    terms = {}
+
+    def pack(current):
+        entity = {k: v[0] if len(v) == 1 else v for k, v in current.items()}
+        if 'is_a' in entity:
+            is_as = entity['is_a']
+            if isinstance(is_as, list):
+                entity['is_a'] = map(controlled_vocabulary.Reference.fromstring, is_as)
+            else:
+                entity['is_a'] = controlled_vocabulary.Reference.fromstring(is_as)
+        if 'relationship' in entity:
+            relationships = entity['relationship']
+            if not isinstance(relationships, list):
+                relationships = [relationships]
+            for rel in relationships:
+                groups = re.search(
+                    r"(?P<predicate>\S+):?\s(?P<accession>\S+)\s?(?:!\s(?P<comment>.*))?", rel).groupdict()
+                rel = controlled_vocabulary.Relationship(**groups)
+                entity[rel.predicate] = rel
+        terms[entity['id']] = entity
+
+    current = None
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        elif line.startswith("["):
+            if current is not None:
+                pack(current)
+            current = defaultdict(list) if line == "[Term]" else None
+        elif current is not None:
+            key, sep, val = line.partition(":")
+            current[key].append(val.strip())
+    if current is not None:
+        pack(current)
+    return terms
+
+
+def bench(path, parse, repeats=10):
+    best = float('inf')
+    for i in range(repeats):
+        with open(path) as handle:
+            start = time.time()
+            terms = parse(handle)
+            best = min(best, time.time() - start)
+    return best, len(terms)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    with open(path) as handle:
+        size = len(handle.read()) / 1e6
+    baseline, n_terms = bench(path, line_parse)
+    print("line parser: %d terms in %0.3fs (%0.1f MB/s, %0.0f terms/s)" % (
+        n_terms, baseline, size / baseline, n_terms / baseline))
+    for tags in (None, CV.obo_tags):
+        elapsed, n_terms = bench(path, lambda handle: controlled_vocabulary.OBOParser(handle, tags).terms)
+        print("OBOParser tags=%r: %d terms in %0.3fs (%0.1f MB/s, %0.0f terms/s, %0.1fx)" % (
+            tags, n_terms, elapsed, size / elapsed, n_terms / elapsed, baseline / elapsed))
@@ -0,0 +1,50 @@
+import io
+import os
+import sys
+import tempfile
+import time
+
+from mzident_writer.writer import MzIdentMLWriter
+
+
+class SlowFile(io.FileIO):
+    # Every write pays a fixed latency, as on a network filesystem
+    latency = 0.0005
+
+    def write(self, data):
+        time.sleep(self.latency)
+        return io.FileIO.write(self, data)
+
+
+def write_syscalls():
+    with open("/proc/self/io") as handle:
+        for line in handle:
+            if line.startswith("syscw"):
+                return int(line.split()[1])
+
+
+def bench(buffer_size, n_peptides=200000, latency=0.0005):
+    path = tempfile.mktemp(suffix=".mzid")
+    SlowFile.latency = latency
+    before = write_syscalls()
+    start = time.time()
+    out = MzIdentMLWriter(SlowFile(path, 'wb'), buffer_size=buffer_size)
+    with out:
+        out.sequence_collection(
+            peptides=({"peptide_sequence": "PEPTIDEK", "id": i} for i in range(1, n_peptides + 1)))
+    elapsed = time.time() - start
+    syscalls = write_syscalls() - before
+    size = os.path.getsize(path)
+    os.remove(path)
+    print("buffer_size=%d: %0.1fMB in %0.2fs, %d write syscalls, %0.1fMB/s" % (
+        buffer_size, size / 2. ** 20, elapsed, syscalls, size / 2. ** 20 / elapsed))
+    if buffer_size:
+        stats = out.output.stats()
+        print("  %d writes combined into %d, %0.1fMB/s to storage" % (
+            stats["writes"], stats["raw_writes"], stats["throughput"] / 2. ** 20))
+
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0005
+    for buffer_size in (0, 2 ** 16, 2 ** 20, 2 ** 22):
+        bench(buffer_size, latency=latency)
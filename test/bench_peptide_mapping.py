@@ -0,0 +1,54 @@
+import random
+import time
+
+from mzident_writer.peptide_mapping import PeptideMapper
+
+
+def make_proteins(n, seed=1):
+    rng = random.Random(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    return [{"id": i + 1, "accession": "prot%d" % i,
+             "sequence": "".join(rng.choice(residues) for _ in range(rng.randint(100, 800)))}
+            for i in range(n)]
+
+
+def sample_peptides(proteins, n, seed=1):
+    rng = random.Random(seed)
+    peptides = {}
+    for i in range(n):
+        sequence = rng.choice(proteins)["sequence"]
+        start = rng.randint(0, len(sequence) - 30)
+        peptides[i] = sequence[start:start + rng.randint(7, 30)]
+    return peptides
+
+
+def find_all(peptides, proteins):
+    evidence = []
+    for peptide_id, peptide in peptides.items():
+        for protein in proteins:
+            start = protein["sequence"].find(peptide)
+            while start != -1:
+                evidence.append((peptide_id, protein["id"], start + 1))
+                start = protein["sequence"].find(peptide, start + 1)
+    return evidence
+
+
+def bench(n_proteins=20000, n_peptides=5000):
+    proteins = make_proteins(n_proteins)
+    peptides = sample_peptides(proteins, n_peptides)
+    start = time.time()
+    expected = find_all(peptides, proteins)
+    loop = time.time() - start
+    start = time.time()
+    mapper = PeptideMapper(peptides, leucine_isoleucine_equivalent=False)
+    build = time.time() - start
+    start = time.time()
+    evidence = list(mapper.map(proteins))
+    scan = time.time() - start
+    assert len(evidence) == len(expected)
+    print("Mapped %d peptides onto %d proteins in %0.3fs with str.find and %0.3fs + %0.3fs to build with"
+          " PeptideMapper" % (n_peptides, n_proteins, loop, scan, build))
+
+
+if __name__ == '__main__':
+    bench()
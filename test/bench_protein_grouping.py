@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+
+from mzident_writer.protein_grouping import group_proteins, ANCHOR, SAME_SET, SUB_SET
+
+
+def make_incidence(n_proteins, peptides_per_protein=3, seed=1):
+    # Each protein draws its peptides from a window of a shared peptide
+    # space, so neighbouring proteins overlap, repeat and contain one another
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, 2 * peptides_per_protein, size=n_proteins)
+    proteins = np.repeat(np.arange(n_proteins), counts)
+    peptides = proteins + rng.randint(0, 4, size=len(proteins))
+    return peptides, proteins
+
+
+def make_shared_family(n_proteins, pool=40, seed=1):
+    # Every protein holds peptide 0 and a few from a small pool, so every
+    # peptide is shared by a large part of the family
+    rng = np.random.RandomState(seed)
+    counts = rng.randint(1, 8, size=n_proteins)
+    proteins = np.repeat(np.arange(n_proteins), counts + 1)
+    peptides = np.zeros(len(proteins), dtype=np.int64)
+    extra = np.ones(len(proteins), dtype=bool)
+    extra[np.cumsum(counts + 1) - (counts + 1)] = False
+    peptides[extra] = rng.randint(1, pool, size=extra.sum())
+    return peptides, proteins
+
+
+def bench(n_proteins=1000000):
+    peptides, proteins = make_incidence(n_proteins)
+    start = time.time()
+    groups = group_proteins(peptides, proteins)
+    elapsed = time.time() - start
+    print("Grouped %d proteins with %d peptide matches in %0.3fs: %d groups, %d anchor, %d same-set and"
+          " %d sub-set proteins" % (
+              n_proteins, len(peptides), elapsed, len(groups), (groups.role == ANCHOR).sum(),
+              (groups.role == SAME_SET).sum(), (groups.role == SUB_SET).sum()))
+
+
+def bench_shared_family(n_proteins=20000):
+    peptides, proteins = make_shared_family(n_proteins)
+    start = time.time()
+    groups = group_proteins(peptides, proteins)
+    elapsed = time.time() - start
+    print("Grouped a family of %d proteins sharing one peptide in %0.3fs: %d anchor, %d same-set and"
+          " %d sub-set proteins" % (
+              n_proteins, elapsed, (groups.role == ANCHOR).sum(),
+              (groups.role == SAME_SET).sum(), (groups.role == SUB_SET).sum()))
+
+
+if __name__ == '__main__':
+    bench()
+    bench_shared_family()
@@ -0,0 +1,80 @@
+import os
+import random
+import resource
+import sys
+import time
+
+from mzident_writer.components import DocumentContext
+from mzident_writer.spilling_context import SpillingDocumentContext
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def bench(backend, n_refs=1000000, n_lookups=1000000, skew=False, seed=1):
+    if backend == "spilling":
+        context = SpillingDocumentContext(memory_budget=16 * 2 ** 20)
+    else:
+        context = DocumentContext()
+    cache = context["PeptideEvidence"]
+    start = time.time()
+    for i in range(n_refs):
+        cache[i] = "PEPTIDEEVIDENCE_%d" % i
+    registered = time.time() - start
+    rng = random.Random(seed)
+    if skew:
+        # Most lookups are for recently registered references, as when
+        # evidence is referenced shortly after it is written
+        keys = [max(n_refs - 1 - int(rng.expovariate(1. / 20000)), 0) for _ in range(n_lookups)]
+    else:
+        keys = [rng.randrange(n_refs) for _ in range(n_lookups)]
+    start = time.time()
+    for key in keys:
+        cache[key]
+    looked_up = time.time() - start
+    print("%s, %s lookups: registered %d in %0.2fs, %0.2fus per lookup, max RSS %0.0fMB" % (
+        backend, "skewed" if skew else "uniform", n_refs, registered,
+        looked_up / n_lookups * 1e6, max_rss_mb()))
+    if backend == "spilling":
+        print("  %r" % (context.spill_stats(),))
+        context.close()
+
+
+def bench_writer(backend, n_peptides=1000000, distinct=500000):
+    # Write a deduplicated SequenceCollection through the writer, as a search
+    # engine export would, with peptides and evidence generated lazily
+    from mzident_writer.writer import MzIdentMLWriter
+    if backend == "spilling":
+        context = SpillingDocumentContext(memory_budget=16 * 2 ** 20)
+    else:
+        context = DocumentContext()
+    out = MzIdentMLWriter(open(os.devnull, 'wb'), context=context)
+    out.context["DBSequence"][1] = "DBSEQUENCE_1"
+    start = time.time()
+    with out:
+        out.sequence_collection(
+            peptides=({"peptide_sequence": "PEPTIDE%dK" % (i % distinct), "id": i}
+                      for i in range(1, n_peptides + 1)),
+            peptide_evidence=({"peptide_id": i, "db_sequence_id": 1, "id": i, "start_position": 1,
+                               "end_position": 9} for i in range(1, n_peptides + 1)),
+            deduplicate=True)
+        stats = context.deduplication_stats()
+    print("%s, writer: %d peptides and evidence (%d distinct) in %0.1fs, max RSS %0.0fMB" % (
+        backend, n_peptides, stats["Peptide"]["unique"], time.time() - start, max_rss_mb()))
+
+
+if __name__ == '__main__':
+    # Run each configuration in its own process so peak RSS is comparable:
+    #   bench_spilling_context.py memory|spilling [uniform|skewed|writer]
+    backend = sys.argv[1] if len(sys.argv) > 1 else "spilling"
+    mode = sys.argv[2] if len(sys.argv) > 2 else "writer"
+    if mode == "writer":
+        bench_writer(backend)
+    else:
+        bench(backend, skew=mode == "skewed")
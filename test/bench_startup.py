@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+heavy_modules = ("sqlalchemy", "numpy", "multiprocessing", "urllib2", "urllib.request", "ssl")
+
+script = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(elapsed)
+print(",".join(name for name in %r if name in sys.modules))
+"""
+
+
+def bench_import(module="mzident_writer.writer", repeats=5):
+    times = []
+    for _ in range(repeats):
+        output = subprocess.check_output(
+            [sys.executable, "-c", script % (module, heavy_modules)]).decode("ascii").splitlines()
+        times.append(float(output[0]))
+        loaded = output[1]
+    times.sort()
+    print("Imported %s in %0.3fs (median of %d), loading: %s" % (
+        module, times[len(times) // 2], repeats, loaded or "no heavy modules"))
+
+
+if __name__ == '__main__':
+    bench_import(*sys.argv[1:2])
@@ -0,0 +1,72 @@
+import sys
+import time
+
+from sqlalchemy import event
+
+from mzident_writer import unimod
+
+
+def count_queries(engine):
+    counter = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count(*args):
+        counter[0] += 1
+
+    return counter
+
+
+def bench_iteration(db):
+    queries = count_queries(db.session.bind)
+    start = time.time()
+    n = 0
+    for mod in db:
+        mod.composition
+        n += 1
+    elapsed = time.time() - start
+    print("Iterated %d modifications in %0.3fs using %d queries" % (n, elapsed, queries[0]))
+
+
+def bench_load_all(db, strategy):
+    relationships = ("specificities.position", "specificities.classification", "_alt_names", "notes")
+    db.session.expunge_all()
+    queries = count_queries(db.session.bind)
+    start = time.time()
+    for mod in db:
+        for spec in mod.specificities:
+            spec.position, spec.classification
+        mod.alternative_names, mod.notes
+    lazy = time.time() - start
+    lazy_queries = queries[0]
+    db.session.expunge_all()
+    queries[0] = 0
+    start = time.time()
+    for mod in db.load_all(relationships, strategy):
+        for spec in mod.specificities:
+            spec.position, spec.classification
+        mod.alternative_names, mod.notes
+    eager = time.time() - start
+    print("Loaded relationships in %0.3fs using %d queries lazily and %0.3fs using %d queries with %s loading" % (
+        lazy, lazy_queries, eager, queries[0], strategy))
+
+
+def bench_mass_search(db):
+    masses = [mod.monoisotopic_mass for mod in db]
+    start = time.time()
+    for mass in masses:
+        [other for other in masses if abs(other - mass) < 0.01]
+    linear = time.time() - start
+    start = time.time()
+    for mass in masses:
+        db.mass_index.search(mass, 0.01)
+    indexed = time.time() - start
+    print("Searched %d masses in %0.3fs by linear scan and %0.3fs with the mass index" % (
+        len(masses), linear, indexed))
+
+
+if __name__ == '__main__':
+    db = unimod.Unimod(sys.argv[1])
+    bench_iteration(db)
+    for strategy in ("selectin", "subquery", "joined"):
+        bench_load_all(db, strategy)
+    bench_mass_search(db)
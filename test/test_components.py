@@ -0,0 +1,126 @@
+import os
+
+from StringIO import StringIO
+
+from lxml import etree
+
+from mzident_writer import components, unimod
+
+sample_path = os.path.join(os.path.dirname(__file__), "unimod_tables_sample.xml")
+
+
+def make_context():
+    cv = components.ProvidedCV(id="UNIMOD", uri="http://www.unimod.org/obo/unimod.obo", fullName="UNIMOD")
+    cv._provider = unimod.Unimod(source=sample_path)
+    return components.DocumentContext(vocabularies=[cv])
+
+
+def write(component):
+    buffer = StringIO()
+    with etree.xmlfile(buffer) as xml_file:
+        component.write(xml_file)
+    return etree.fromstring(buffer.getvalue())
+
+
+def test_modification_memo():
+    context = make_context()
+    resolved = context.modification("Carbamidomethyl")
+    assert resolved.accession == "UNIMOD:4"
+    assert context.modification("Carbamidomethyl") is resolved
+    assert [spec.residue for spec in resolved.specificities_for(position="Anywhere")] == ["C"]
+
+
+def test_search_modification():
+    context = make_context()
+    tag = write(components.SearchModification("Carbamidomethyl", residues="C", context=context))
+    assert tag.attrib["fixedMod"] == "true"
+    assert tag.attrib["residues"] == "C"
+    assert abs(float(tag.attrib["massDelta"]) - 57.021464) < 1e-6
+    assert tag[0].attrib["accession"] == "UNIMOD:4"
+    tag = write(components.SearchModification("Acetyl", fixed=False, position="Protein N-term", context=context))
+    assert tag.attrib["residues"] == "."
+    assert tag.find("SpecificityRules")[0].attrib["accession"] == "MS:1002057"
+
+
+def test_peptide_modifications():
+    context = make_context()
+    peptide = components.Peptide("PEPCTIDE", 1, modifications=[
+        {"name": "Carbamidomethyl", "location": 4, "residues": "C"},
+        {"name": "Acetyl", "location": 0}], context=context)
+    tag = write(peptide)
+    mods = tag.findall("Modification")
+    assert [mod.attrib["location"] for mod in mods] == ["4", "0"]
+    assert mods[0].attrib["residues"] == "C"
+    assert abs(float(mods[1].attrib["monoisotopicMassDelta"]) - 42.010565) < 1e-6
+    assert mods[0][0].attrib["accession"] == "UNIMOD:4"
+    assert context.modification("Carbamidomethyl").param is peptide.modifications[0].param
+
+    from mzident_writer.mass import MassEngine
+    engine = MassEngine()
+    assert engine.peptide_mass("PEPCTIDE", peptide.modifications) == engine.peptide_mass(
+        "PEPCTIDE", [context.modification("Carbamidomethyl").monoisotopic_mass, 42.010565])
+
+
+def test_writer_import_is_light():
+    import subprocess
+    import sys
+    script = "import sys, mzident_writer.writer; print(','.join(sorted(set(sys.modules) & set(%r))))" % (
+        ["sqlalchemy", "numpy", "mzident_writer.unimod"],)
+    output = subprocess.check_output([sys.executable, "-c", script]).decode("ascii").strip()
+    assert output == ""
+
+
+def test_db_sequence_from_fasta():
+    import tempfile
+    from mzident_writer import fasta
+    path = os.path.join(tempfile.mkdtemp(), "proteins.fa")
+    with open(path, 'w') as handle:
+        handle.write(">prot1 description\nPEPT\nIDEK\n>prot2\nGGG\n")
+    context = make_context()
+    context["SearchDatabase"][1] = "SEARCHDATABASE_1"
+    with fasta.FastaFile(path) as source:
+        db_sequence = components.DBSequence("prot1", id=1, source=source, context=context)
+        assert db_sequence.element.attrs["length"] == 8
+        tag = write(db_sequence)
+    assert tag.find("Seq").text == "PEPTIDEK"
+
+
+def test_intern():
+    context = components.DocumentContext()
+    context["Peptide"][1] = "PEPTIDE_1"
+    assert context.intern("Peptide", ("PEPTIDE", ()), 1)
+    assert not context.intern("Peptide", ("PEPTIDE", ()), 2)
+    assert not context.intern("Peptide", ("PEPTIDE", ()), 1)
+    assert context["Peptide"][2] == "PEPTIDE_1"
+    assert context.intern("Peptide", ("PEPTIDEK", ()), 3)
+    stats = context.deduplication_stats()["Peptide"]
+    assert (stats["seen"], stats["unique"]) == (4, 2)
+    assert stats["ratio"] == 2.0
+
+
+def test_deduplicated_sequence_collection():
+    import tempfile
+    from mzident_writer import writer
+    mods = [{"name": "Oxidation", "location": 3, "mass_delta": 15.99},
+            {"name": "Carbamidomethyl", "location": 5, "mass_delta": 57.02}]
+    assert writer._peptide_key({"peptide_sequence": "PEMTCDE", "modifications": mods}) == writer._peptide_key(
+        {"peptide_sequence": "PEMTCDE", "modifications": mods[::-1]})
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = writer.MzIdentMLWriter(open(path, 'wb'))
+    out.context["DBSequence"][1] = "DBSEQUENCE_1"
+    with out:
+        out.sequence_collection(
+            peptides=[{"peptide_sequence": "PEPTIDE", "id": i} for i in range(1, 4)] + [
+                {"peptide_sequence": "PEPTIDEK", "id": 4}],
+            peptide_evidence=[
+                {"peptide_id": i, "db_sequence_id": 1, "id": i, "start_position": 1, "end_position": 7}
+                for i in range(1, 5)],
+            deduplicate=True)
+    tree = etree.parse(path)
+    assert [p.attrib["id"] for p in tree.findall(".//{*}Peptide")] == ["PEPTIDE_1", "PEPTIDE_4"]
+    assert [e.attrib["id"] for e in tree.findall(".//{*}PeptideEvidence")] == [
+        "PEPTIDEEVIDENCE_1", "PEPTIDEEVIDENCE_4"]
+    assert out.context["PeptideEvidence"][3] == "PEPTIDEEVIDENCE_1"
+    stats = out.context.deduplication_stats()
+    assert stats["Peptide"]["ratio"] == 2.0
+    assert stats["PeptideEvidence"]["unique"] == 2
@@ -0,0 +1,55 @@
+from mzident_writer import composition
+from mzident_writer.composition import Composition
+
+
+def test_arithmetic():
+    water = Composition(H=2, O=1)
+    assert water["H"] == 2
+    assert water["C"] == 0
+    acetyl = Composition({"C": 2, "H": 2, "O": 1})
+    total = water * 2 + acetyl
+    assert total == {"C": 2, "H": 6, "O": 3}
+    total -= acetyl
+    assert total == water * 2
+    total.add(acetyl, -1)
+    assert total["C"] == -2
+
+
+def test_isotopes_and_mass():
+    heavy = Composition({composition._make_isotope_string("C", 13): 6})
+    assert heavy.keys() == ["C[13]"]
+    assert abs(Composition(H=2, O=1).mass() - 18.0105646837) < 1e-6
+    assert abs(heavy.mass() - 6 * 13.0033548378) < 1e-6
+
+
+def test_batch():
+    parts = [Composition(H=1), Composition(C=1, H=2)]
+    assert composition.sum_compositions(parts, [2, 3]) == {"H": 8, "C": 3}
+    assert composition.sum_compositions(parts) == {"H": 3, "C": 1}
+    masses = composition.masses(parts)
+    assert abs(masses[1] - 14.01565006414) < 1e-6
+
+
+def test_pickle():
+    import pickle
+    for value in (Composition(), Composition(C=2, H=4)):
+        assert pickle.loads(pickle.dumps(value, 2)) == value
+
+
+def test_concurrent_slots():
+    import threading
+    names = ["Xx%d" % i for i in range(200)]
+
+    def register(offset):
+        for i in range(len(names)):
+            composition._slot(names[(i + offset) % len(names)])
+
+    threads = [threading.Thread(target=register, args=(i * 7,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    slots = [composition._slot(name) for name in names]
+    assert len(set(slots)) == len(names)
+    assert [composition._slot_names[slot] for slot in slots] == names
+    assert len(composition._slot_names) == len(composition._monoisotopic_masses)
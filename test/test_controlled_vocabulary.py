@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+from StringIO import StringIO
+
+from mzident_writer import controlled_vocabulary
+
+
+obo_text = """format-version: 1.2
+default-namespace: MS
+
+[Term]
+id: MS:1000001
+name: sample number
+def: "A reference number relevant to the sample under study." [PSI:MS]
+is_a: MS:1000548 ! sample attribute
+
+[Term]
+id: MS:1001251
+name: Trypsin
+is_a: MS:1001045 ! cleavage agent name
+relationship: has_regexp MS:1001176 ! (?<=[KR])(?!P)
+
+[Typedef]
+id: has_regexp
+name: has regexp
+"""
+
+
+def make_vocabulary():
+    return controlled_vocabulary.ControlledVocabulary.from_obo(StringIO(obo_text))
+
+
+def test_mapped_vocabulary():
+    vocabulary = make_vocabulary()
+    path = os.path.join(tempfile.mkdtemp(), "test.cvmap")
+    mapped = controlled_vocabulary.MappedVocabulary.build(vocabulary, path)
+    assert len(mapped) == 2
+    assert mapped["MS:1000001"]["name"] == "sample number"
+    assert mapped["Trypsin"]["id"] == "MS:1001251"
+    assert mapped["trypsin"]["id"] == "MS:1001251"
+    assert mapped["Trypsin"]["has_regexp"] == "MS:1001176"
+    try:
+        mapped["not a term"]
+        assert False
+    except KeyError:
+        pass
+    attached = controlled_vocabulary.MappedVocabularyResolver(path)(controlled_vocabulary.obo_cache)
+    assert sorted(attached.keys()) == sorted(vocabulary.keys())
+    # The term count is read from the header without unpickling any term
+    attached._record = None
+    assert len(attached) == 2
+
+
+def test_iterparse_obo():
+    terms = list(controlled_vocabulary.iterparse_obo(StringIO(obo_text)))
+    assert [term["id"] for term in terms] == ["MS:1000001", "MS:1001251"]
+    assert terms[0]["is_a"] == "MS:1000548"
+    assert terms[0]["is_a"].comment == "sample attribute"
+    assert terms[1]["has_regexp"].accession == "MS:1001176"
+    assert terms[1]["has_regexp"].comment == "(?<=[KR])(?!P)"
+
+
+def test_iterparse_obo_tags():
+    terms = list(controlled_vocabulary.iterparse_obo(StringIO(obo_text), tags=("is_a",)))
+    assert sorted(terms[0]) == ["id", "is_a", "name"]
+
+
+def test_parser_pack():
+    parser = controlled_vocabulary.OBOParser(StringIO(obo_text))
+    parser.current_term = {"id": ["MS:0000001"], "name": ["packed"], "is_a": ["MS:1000001 ! a", "MS:1001251 ! b"]}
+    parser.pack()
+    assert parser.current_term is None
+    assert parser["MS:0000001"]["name"] == "packed"
+    assert [ref.accession for ref in parser["MS:0000001"]["is_a"]] == ["MS:1000001", "MS:1001251"]
+    assert parser["MS:1001251"]["has_regexp"] == "MS:1001176"
+
+
+def test_iterparse_obo_shares_references():
+    text = obo_text.replace("MS:1001045 ! cleavage agent name", "MS:1000548 ! sample attribute")
+    terms = list(controlled_vocabulary.iterparse_obo(StringIO(text)))
+    assert terms[0]["is_a"] is terms[1]["is_a"]
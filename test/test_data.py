@@ -46,7 +46,8 @@ peptides = [
     },
     {
         "id": 2,
-        "peptide_sequence": "ENGTISR"
+        "peptide_sequence": "ENGTISR",
+        "modifications": [{"name": "Deamidated", "location": 1, "residues": "N"}]
     }
 ]
 
@@ -71,6 +72,10 @@ peptide_evidence = [
 
 protocol = {
     "enzymes": [{"name": "trypsin", "missed_cleavages": 2}],
+    "modification_params": [
+        {"name": "Carbamidomethyl", "fixed": True, "residues": "C"},
+        {"name": "Oxidation", "fixed": False, "residues": "M"}
+    ],
     "fragment_tolerance": (10, None, "parts per million"),
     "id": 1
 }
@@ -0,0 +1,122 @@
+import os
+import tempfile
+
+from mzident_writer import fasta
+
+fasta_text = """>sp|P02763|A1AG1_HUMAN Alpha-1-acid glycoprotein 1
+MALSWVLTVLSLLPLLEAQIPLCANLVPVPITNATLDQITGKWFYIASAFRNEEYNKSVQ
+EIQATFFYFTPNKTEDTIFLREYQTRQDQCIYNTTYLNVQRENGTISRYVGGQEHFAHLL
+ILRDTKTYMLAFDVNDEKNWGLSVYADKPETTKEQLGEFYEALDCLRIPKSDVVYTDWKK
+DKCEPLEKQHEKERKQEEGES
+>short
+PEPTIDE
+>empty
+>exact
+ACDEFGHIKLMNPQRSTVWYACDEFGHIKLMNPQRSTVWYACDEFGHIKLMNPQRSTVWY
+"""
+
+
+def make_fasta(text=fasta_text):
+    path = os.path.join(tempfile.mkdtemp(), "proteins.fa")
+    with open(path, 'w') as handle:
+        handle.write(text)
+    return path
+
+
+def test_index_and_sequences():
+    path = make_fasta()
+    with fasta.FastaFile(path) as source:
+        assert list(source) == ["sp|P02763|A1AG1_HUMAN", "short", "empty", "exact"]
+        assert source.length("sp|P02763|A1AG1_HUMAN") == 201
+        assert source.sequence("sp|P02763|A1AG1_HUMAN").endswith("VVYTDWKKDKCEPLEKQHEKERKQEEGES")
+        assert source["short"] == "PEPTIDE"
+        assert source["empty"] == ""
+        assert source["exact"] == "ACDEFGHIKLMNPQRSTVWY" * 3
+    assert os.path.exists(path + ".fai")
+    with fasta.FastaFile(path) as source:
+        assert source.ordinal("exact") == 3
+        assert source["short"] == "PEPTIDE"
+
+
+def test_foreign_index():
+    path = make_fasta()
+    fasta.FastaFile(path).close()
+    assert os.path.exists(path + ".fai.lines")
+    # An index from another tool comes without a line table, which is written
+    # the first time it is opened
+    os.remove(path + ".fai.lines")
+    with fasta.FastaFile(path) as source:
+        assert len(source) == 4
+        assert source.index.accession(-1) == "exact"
+        assert source["short"] == "PEPTIDE"
+    assert os.path.exists(path + ".fai.lines")
+
+
+def test_ragged_lines():
+    path = make_fasta(">ragged\nPEP\nTIDEK\n")
+    try:
+        fasta.FastaFile(path)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_unterminated_last_line():
+    path = make_fasta(">a\nACGT\nACGT")
+    with fasta.FastaFile(path) as source:
+        assert source["a"] == "ACGTACGT"
+    path = make_fasta(">a\nACGT\nAC")
+    with fasta.FastaFile(path) as source:
+        assert source["a"] == "ACGTAC"
+
+
+def test_non_ascii_header():
+    path = os.path.join(tempfile.mkdtemp(), "proteins.fa")
+    with open(path, 'wb') as handle:
+        handle.write(b">prot\xe9in1 description\nPEPTIDE\n>other\nACGT\n")
+    with fasta.FastaFile(path) as source:
+        accessions = list(source)
+        assert len(accessions) == 2 and accessions[1] == "other"
+        assert source[accessions[0]] == "PEPTIDE"
+    with fasta.FastaFile(path) as source:
+        assert source.ordinal(accessions[0]) == 0
+
+
+def test_bitset():
+    members = fasta.Bitset(20)
+    members.update([17, 3, 9, 3])
+    assert list(members) == [3, 9, 17]
+    assert len(members) == 3
+    assert 9 in members and 10 not in members and 25 not in members
+    try:
+        members.add(20)
+        assert False
+    except IndexError:
+        pass
+
+
+def test_referenced_only():
+    from lxml import etree
+    from mzident_writer.writer import MzIdentMLWriter
+    path = make_fasta()
+    out_path = os.path.join(os.path.dirname(path), "out.mzid")
+    evidence = [
+        {"peptide_id": 1, "db_sequence_id": 4, "id": 1, "start_position": 1, "end_position": 7},
+        {"peptide_id": 1, "db_sequence_id": 2, "id": 2, "start_position": 1, "end_position": 7},
+        {"peptide_id": 1, "db_sequence_id": 4, "id": 3, "start_position": 21, "end_position": 27},
+    ]
+    with fasta.FastaFile(path) as source:
+        writer = MzIdentMLWriter(open(out_path, 'wb'))
+        with writer:
+            writer.sequence_collection(
+                peptides=[{"peptide_sequence": "PEPTIDE", "id": 1}],
+                peptide_evidence=iter(evidence), source=source, referenced_only=True)
+        # Only the referenced records were read from the index
+        assert source.index._hashes is None
+    tree = etree.parse(out_path)
+    db_sequences = tree.findall(".//{*}DBSequence")
+    assert [s.attrib["accession"] for s in db_sequences] == ["short", "exact"]
+    assert [s.attrib["id"] for s in db_sequences] == ["DBSEQUENCE_2", "DBSEQUENCE_4"]
+    assert db_sequences[0].find("{*}Seq").text == "PEPTIDE"
+    refs = [e.attrib["dBSequence_ref"] for e in tree.findall(".//{*}PeptideEvidence")]
+    assert refs == ["DBSEQUENCE_4", "DBSEQUENCE_2", "DBSEQUENCE_4"]
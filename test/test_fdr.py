@@ -0,0 +1,75 @@
+import os
+import tempfile
+import warnings
+
+from lxml import etree
+
+from mzident_writer import fdr
+
+
+def test_q_values():
+    scores = [10, 9, 8, 7, 6, 5, 4]
+    decoys = [False, False, True, False, True, True, False]
+    q = fdr.q_values(scores, decoys)
+    # FDR at each threshold: 0, 0, 1/2, 1/3, 2/3, 1, 3/4; q is the minimum from there down
+    expected = [0, 0, 1 / 3., 1 / 3., 2 / 3., 0.75, 0.75]
+    assert all(abs(a - b) < 1e-12 for a, b in zip(q, expected))
+    assert list(fdr.q_values([-s for s in scores], decoys, higher_score_better=False)) == list(q)
+
+
+def test_tied_scores():
+    q = fdr.q_values([5, 5, 4], [False, True, False])
+    assert q[0] == q[1] == 0.5
+    assert fdr.q_values([], []).shape == (0,)
+
+
+def test_peptide_q_values():
+    scores = [10, 9, 8, 7]
+    decoys = [False, False, True, False]
+    peptides = ["A", "A", "B", "C"]
+    # Distinct peptides A (10, target), B (8, decoy), C (7, target)
+    assert list(fdr.peptide_q_values(scores, decoys, peptides)) == [0.0, 0.0, 0.5, 0.5]
+
+
+def test_spectrum_identification_list():
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = MzIdentMLWriter(open(path, 'wb'))
+    results = []
+    for i, (score, decoy) in enumerate([(10, False), (9, True), (8, False)], 1):
+        results.append({"spectrum_id": "scan=%d" % i, "id": i, "identifications": [
+            {"calculated_mass_to_charge": 100., "experimental_mass_to_charge": 100., "charge_state": 2,
+             "peptide_id": i, "peptide_evidence_id": i, "score": score, "id": i, "is_decoy": decoy}]})
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with out:
+            out.spectrum_identification_list(1, results, fdr_threshold=0.01)
+    items = etree.parse(path).findall(".//{*}SpectrumIdentificationItem")
+    assert [item.attrib["passThreshold"] for item in items] == ["true", "false", "false"]
+    q = {param.attrib["accession"]: float(param.attrib["value"])
+         for param in items[2].findall("{*}cvParam")}
+    assert q == {"MS:1002354": 0.5, "MS:1001868": 0.5}
+
+
+def test_modified_forms_are_distinct_peptides():
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = MzIdentMLWriter(open(path, 'wb'))
+    # Peptides 1 and 3 are the same sequence, 3 carrying a modification
+    matches = [(10, False, "PEPTIDE", None), (9, True, "EDITPEP", None),
+               (8, False, "PEPTIDE", [{"location": 2, "name": "Oxidation"}])]
+
+    def results():
+        for i, (score, decoy, sequence, modifications) in enumerate(matches, 1):
+            yield {"spectrum_id": "scan=%d" % i, "id": i, "identifications": [
+                {"calculated_mass_to_charge": 100., "experimental_mass_to_charge": 100., "charge_state": 2,
+                 "peptide_id": i, "peptide_evidence_id": i, "score": score, "id": i, "is_decoy": decoy,
+                 "peptide_sequence": sequence, "modifications": modifications}]}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with out:
+            out.spectrum_identification_list(1, results(), fdr_threshold=0.01)
+    items = etree.parse(path).findall(".//{*}SpectrumIdentificationItem")
+    peptide_q = [float(item.find("{*}cvParam[@accession='MS:1001868']").attrib["value"]) for item in items]
+    assert peptide_q == [0.0, 0.5, 0.5]
@@ -0,0 +1,89 @@
+from collections import Mapping
+
+import numpy as np
+
+from mzident_writer import mass
+
+
+def test_neutral_masses():
+    engine = mass.MassEngine()
+    masses = engine.neutral_masses(["PEPTIDE", "", "GG"])
+    assert np.allclose(masses, [799.359964, mass.WATER, 2 * 57.021464 + mass.WATER])
+
+
+def test_modified_mass_to_charge():
+    engine = mass.MassEngine(modification_mass={"Carbamidomethyl": 57.021464}.__getitem__)
+    mz = engine.mass_to_charge(
+        ["PEPCTIDE", "PEPCTIDE", "PEPCTIDE"], [2, 2, 1],
+        [[{"name": "Carbamidomethyl", "location": 4}], [57.021464], None])
+    neutral = engine.peptide_mass("PEPCTIDE")
+    assert np.allclose(mz[:2], (neutral + 57.021464 + 2 * mass.PROTON) / 2)
+    assert np.isclose(mz[2], neutral + mass.PROTON)
+
+
+def test_unknown_residue():
+    try:
+        mass.MassEngine().neutral_masses(["PEPJIDE"])
+        assert False
+    except KeyError:
+        pass
+
+
+def test_writer_batches_across_results():
+    import os
+    import tempfile
+    import warnings
+    from mzident_writer.writer import MzIdentMLWriter
+
+    batches = []
+
+    class CountingEngine(mass.MassEngine):
+        def mass_to_charge(self, sequences, charges, modifications=None):
+            batches.append(len(sequences))
+            return super(CountingEngine, self).mass_to_charge(sequences, charges, modifications)
+
+    out = MzIdentMLWriter(open(os.path.join(tempfile.mkdtemp(), "out.mzid"), 'wb'))
+    out.mass_batch_size = 3
+    out._mass_engine = CountingEngine()
+    results = ({"spectrum_id": "scan=%d" % i, "id": i, "identifications": [
+        {"peptide_sequence": "PEPTIDE", "experimental_mass_to_charge": 400.7, "charge_state": 2,
+         "peptide_id": i, "peptide_evidence_id": i, "score": 1, "id": i}]} for i in range(1, 6))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with out:
+            out.spectrum_identification_list(1, results)
+    assert batches == [3, 2]
+
+
+def test_mapping_modifications():
+    class FrozenMapping(Mapping):
+        def __init__(self, **kwargs):
+            self._data = kwargs
+
+        def __getitem__(self, key):
+            return self._data[key]
+
+        def __iter__(self):
+            return iter(self._data)
+
+        def __len__(self):
+            return len(self._data)
+
+    engine = mass.MassEngine()
+    expected = engine.peptide_mass("PEPTIDE", [15.994915])
+    assert engine.peptide_mass("PEPTIDE", [FrozenMapping(mass_delta=15.994915)]) == expected
+
+
+def test_writer_requires_sequence_or_mass():
+    import os
+    import tempfile
+    from mzident_writer.writer import MzIdentMLWriter
+
+    out = MzIdentMLWriter(open(os.path.join(tempfile.mkdtemp(), "out.mzid"), 'wb'))
+    identification = {"experimental_mass_to_charge": 400.7, "charge_state": 2,
+                      "peptide_id": 1, "peptide_evidence_id": 1, "score": 1, "id": "SII_7"}
+    try:
+        out._fill_calculated_mass_to_charge([identification])
+        assert False
+    except ValueError as error:
+        assert "SII_7" in str(error)
@@ -0,0 +1,87 @@
+import os
+import tempfile
+
+from lxml import etree
+
+from mzident_writer.output_buffer import WriteCombiningBuffer
+
+
+class RecordingFile(object):
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+def test_fixed_size_chunks():
+    raw = RecordingFile()
+    buffered = WriteCombiningBuffer(raw, buffer_size=10)
+    for i in range(7):
+        buffered.write(b"abc")
+    assert [len(chunk) for chunk in raw.chunks] == [10, 10]
+    # Large writes into an empty buffer pass straight through
+    buffered.write(b"x")
+    buffered.flush()
+    buffered.write(b"y" * 25)
+    assert [len(chunk) for chunk in raw.chunks] == [10, 10, 2, 25]
+    buffered.close()
+    assert raw.closed
+    assert raw.getvalue() == b"abc" * 7 + b"x" + b"y" * 25
+    stats = buffered.stats()
+    assert stats["writes"] == 9
+    assert stats["raw_writes"] == 4
+    assert stats["bytes_written"] == 47
+    assert stats["flushes"] == {"size": 2, "time": 0, "section": 0, "explicit": 1}
+
+
+def test_flush_policies():
+    raw = RecordingFile()
+    buffered = WriteCombiningBuffer(raw, buffer_size=100)
+    buffered.write(b"abc")
+    buffered.section_boundary()
+    assert raw.chunks == []
+    buffered.flush_on_section = True
+    buffered.section_boundary()
+    assert raw.chunks == [b"abc"]
+    buffered.flush_interval = 0
+    buffered.write(b"def")
+    assert raw.chunks == [b"abc", b"def"]
+    assert buffered.stats()["flushes"]["time"] == 1
+
+
+def test_writer_fragments():
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = MzIdentMLWriter(open(path, 'wb'), buffer_size=4096, flush_on_section=True)
+    with out:
+        out.sequence_collection(peptides=[{"peptide_sequence": "PEPTIDE", "id": 1}])
+        flushes = out.output.stats()["flushes"]["section"]
+        assert flushes == 1
+        with out.element("AnalysisCollection"):
+            out.write_fragment(b'<SpectrumIdentification id="SI_1"/>')
+            out.write_fragment(u'<SpectrumIdentification id="SI_2"/>')
+    root = etree.parse(path).getroot()
+    assert [etree.QName(child).localname for child in root] == ["SequenceCollection", "AnalysisCollection"]
+    assert [child.attrib["id"] for child in root[1]] == ["SI_1", "SI_2"]
+
+
+def test_unbuffered_fragments_in_document_encoding():
+    from mzident_writer.writer import MzIdentMLWriter
+    raw = RecordingFile()
+    out = MzIdentMLWriter(raw, buffer_size=0, encoding="iso-8859-1")
+    with out:
+        out.sequence_collection(peptides=[{"peptide_sequence": "PEPTIDE", "id": 1}])
+        # Without a buffer, sections do not force the incremental writer to flush
+        assert raw.chunks == []
+        with out.element("AnalysisCollection"):
+            out.write_fragment(u'<SpectrumIdentification id="SI_\xe9"/>')
+    root = etree.fromstring(raw.getvalue(), etree.XMLParser(encoding="iso-8859-1"))
+    assert [child.attrib["id"] for child in root[1]] == [u"SI_\xe9"]
@@ -0,0 +1,65 @@
+import os
+import tempfile
+
+from mzident_writer import fasta
+from mzident_writer.peptide_mapping import PeptideMapper
+
+
+proteins = [
+    {"id": 1, "accession": "prot1", "sequence": "MPEPTIDEKPEPTLDER"},
+    {"id": 2, "accession": "DECOY_prot1", "sequence": "REDLTPEPKEDITPEPM"},
+    {"id": 3, "accession": "prot3", "sequence": "GGGG"},
+]
+
+
+def brute_force(peptides, proteins):
+    found = set()
+    for peptide_id, peptide in peptides.items():
+        for protein in proteins:
+            sequence = protein["sequence"].replace("I", "L")
+            start = sequence.find(peptide.replace("I", "L"))
+            while start != -1:
+                found.add((peptide_id, protein["id"], start + 1))
+                start = sequence.find(peptide.replace("I", "L"), start + 1)
+    return found
+
+
+def test_map():
+    peptides = {1: "PEPTIDE", 2: "PEPTLDE", 3: "EPT", 4: "GG", 5: "KPEPTIDER", 6: "NOTFOUND"}
+    mapper = PeptideMapper(peptides)
+    assert len(mapper) == 5
+    evidence = list(mapper.map(proteins))
+    assert [item["id"] for item in evidence] == list(range(1, len(evidence) + 1))
+    found = set((item["peptide_id"], item["db_sequence_id"], item["start_position"]) for item in evidence)
+    assert found == brute_force(peptides, proteins)
+
+    first = [item for item in evidence if item["peptide_id"] == 1 and item["start_position"] == 2][0]
+    assert first["end_position"] == 8
+    assert (first["pre"], first["post"]) == ("M", "K")
+    assert not first["is_decoy"]
+    last = [item for item in evidence if item["peptide_id"] == 5][0]
+    assert (last["start_position"], last["pre"], last["post"]) == (9, "E", "-")
+    grouped = [item for item in evidence if item["db_sequence_id"] == 3]
+    assert [(item["start_position"], item["pre"]) for item in grouped] == [(1, "-"), (2, "G"), (3, "G")]
+    assert all(item["is_decoy"] for item in evidence if item["db_sequence_id"] == 2)
+
+
+def test_exact_residues():
+    mapper = PeptideMapper([{"id": "a", "peptide_sequence": "PEPTIDE"}, {"id": "b", "peptide_sequence": "PEPTIDE"}],
+                           leucine_isoleucine_equivalent=False)
+    evidence = list(mapper.map(proteins))
+    assert [(item["peptide_id"], item["db_sequence_id"]) for item in evidence] == [("a", 1), ("b", 1)]
+
+
+def test_map_fasta():
+    path = os.path.join(tempfile.mkdtemp(), "proteins.fa")
+    with open(path, 'w') as handle:
+        for protein in proteins * 20:
+            handle.write(">%s\n%s\n" % (protein["accession"], protein["sequence"]))
+    mapper = PeptideMapper({1: "PEPTIDE", 2: "GG"})
+    with fasta.FastaFile(path) as source:
+        serial = list(mapper.map_fasta(source))
+        parallel = list(mapper.map_fasta(source, processes=2, chunk_size=7))
+    assert serial == parallel
+    assert len(serial) == 20 * 5
+    assert serial[-1]["db_sequence_id"] == 60
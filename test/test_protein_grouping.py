@@ -0,0 +1,155 @@
+import os
+import random
+import tempfile
+import warnings
+
+import numpy as np
+
+from lxml import etree
+
+from mzident_writer import protein_grouping
+from mzident_writer.protein_grouping import ANCHOR, SAME_SET, SUB_SET, group_proteins
+
+
+def brute_force(pairs, n_proteins):
+    sets = [frozenset(p for p, q in pairs if q == protein) for protein in range(n_proteins)]
+    roles = []
+    for protein, peptides in enumerate(sets):
+        same = [other for other in range(n_proteins) if sets[other] == peptides]
+        if any(peptides < other for other in sets):
+            roles.append(SUB_SET)
+        elif same[0] == protein:
+            roles.append(ANCHOR)
+        else:
+            roles.append(SAME_SET)
+    return roles
+
+
+def test_group_proteins():
+    # 0 and 1 share {0, 1}; 2 is a sub-set of them; 3 is connected through peptide 2
+    # to 0 and 1; 4 stands alone
+    pairs = [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1), (0, 2), (2, 3), (3, 3), (4, 4)]
+    groups = group_proteins([p for p, q in pairs], [q for p, q in pairs])
+    assert list(groups.role) == [ANCHOR, SAME_SET, SUB_SET, ANCHOR, ANCHOR]
+    assert list(groups.same_set) == [0, 0, 2, 3, 4]
+    assert list(groups.group) == [0, 0, 0, 0, 1]
+    assert [list(members) for members in groups.members()] == [[0, 1, 3, 2], [4]]
+
+
+def test_group_proteins_random():
+    rng = random.Random(7)
+    for trial in range(20):
+        n_proteins = 40
+        pairs = set()
+        for protein in range(n_proteins):
+            for _ in range(rng.randint(1, 4)):
+                pairs.add((rng.randint(0, 30), protein))
+        pairs = sorted(pairs)
+        groups = group_proteins(np.array([p for p, q in pairs]), np.array([q for p, q in pairs]))
+        assert list(groups.role) == brute_force(pairs, n_proteins)
+        for p, q in pairs:
+            assert all(groups.group[q] == groups.group[other] for p2, other in pairs if p2 == p)
+
+
+def test_group_proteins_shared_family():
+    # Every protein shares peptide 0 and draws the rest from a small pool, so
+    # each candidate sub-set is compared with much of the family. A small pair
+    # budget checks them in many chunks, dropping sub-sets found on the way
+    rng = random.Random(11)
+    pairs = set()
+    for protein in range(60):
+        pairs.add((0, protein))
+        for _ in range(rng.randint(0, 5)):
+            pairs.add((rng.randint(1, 8), protein))
+    pairs = sorted(pairs)
+    budget = protein_grouping._pair_budget
+    protein_grouping._pair_budget = 7
+    try:
+        groups = group_proteins(np.array([p for p, q in pairs]), np.array([q for p, q in pairs]))
+    finally:
+        protein_grouping._pair_budget = budget
+    assert list(groups.role) == brute_force(pairs, 60)
+    assert (groups.role == SUB_SET).sum() > 10
+
+
+def test_protein_detection_list():
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = MzIdentMLWriter(open(path, 'wb'), track_evidence=True)
+    for i in range(1, 4):
+        out.context["DBSequence"][i] = "DBSEQUENCE_%d" % i
+    evidence = [(1, 1), (2, 1), (1, 2), (2, 2), (1, 3), (3, 3)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with out:
+            out.sequence_collection(
+                peptides=[{"peptide_sequence": "PEPTIDE", "id": i} for i in range(1, 4)],
+                peptide_evidence=[
+                    {"peptide_id": peptide, "db_sequence_id": protein, "id": i,
+                     "start_position": 1, "end_position": 7}
+                    for i, (peptide, protein) in enumerate(evidence, 1)])
+            for i in range(1, 6):
+                out.SpectrumIdentificationItem(
+                    100., 100., 2, evidence[i - 1][0], i, 1., i, cv_params=())
+            out.protein_detection_list()
+    tree = etree.parse(path)
+    groups = tree.findall(".//{*}ProteinAmbiguityGroup")
+    assert len(groups) == 1
+    hypotheses = groups[0].findall("{*}ProteinDetectionHypothesis")
+    assert [h.attrib["dBSequence_ref"] for h in hypotheses] == ["DBSEQUENCE_1", "DBSEQUENCE_2", "DBSEQUENCE_3"]
+    roles = [h.find("{*}cvParam").attrib["accession"] for h in hypotheses]
+    assert roles == ["MS:1001591", "MS:1001594", "MS:1001596"]
+    # The evidence of peptide 3 is not referred to by any identification, so
+    # protein 3 is a sub-set of the others
+    assert len(hypotheses[2].findall("{*}PeptideHypothesis")) == 1
+    item_refs = hypotheses[0].findall("{*}PeptideHypothesis/{*}SpectrumIdentificationItemRef")
+    assert [ref.attrib["spectrumIdentificationItem_ref"] for ref in item_refs] == [
+        "SPECTRUMIDENTIFICATIONITEM_1", "SPECTRUMIDENTIFICATIONITEM_2"]
+
+
+def test_protein_detection_list_deduplicated_peptides():
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    out = MzIdentMLWriter(open(path, 'wb'), track_evidence=True)
+    for i in range(1, 3):
+        out.context["DBSequence"][i] = "DBSEQUENCE_%d" % i
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with out:
+            # Peptides 1 and 2 are the same, so both proteins have the same peptide set
+            out.sequence_collection(
+                peptides=[{"peptide_sequence": "PEPTIDE", "id": i} for i in range(1, 3)],
+                peptide_evidence=[
+                    {"peptide_id": i, "db_sequence_id": i, "id": i, "start_position": 1, "end_position": 7}
+                    for i in range(1, 3)],
+                deduplicate=True)
+            for i in range(1, 3):
+                out.SpectrumIdentificationItem(100., 100., 2, i, i, 1., i, cv_params=())
+            out.protein_detection_list()
+    tree = etree.parse(path)
+    evidence = tree.findall(".//{*}PeptideEvidence")
+    assert [e.attrib["peptide_ref"] for e in evidence] == ["PEPTIDE_1", "PEPTIDE_1"]
+    groups = tree.findall(".//{*}ProteinAmbiguityGroup")
+    assert len(groups) == 1
+    roles = [h.find("{*}cvParam").attrib["accession"]
+             for h in groups[0].findall("{*}ProteinDetectionHypothesis")]
+    assert roles == ["MS:1001591", "MS:1001594"]
+
+
+def test_evidence_not_tracked_by_default():
+    from mzident_writer.components import NullMap, PeptideEvidence
+    from mzident_writer.writer import MzIdentMLWriter
+    out = MzIdentMLWriter(open(os.devnull, 'wb'))
+    assert out.context.evidence_index is None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        PeptideEvidence(1, 1, 1, 1, 7)
+        out.PeptideEvidence(1, 1, 1, 1, 7)
+    assert NullMap.evidence_index is None
+    assert out.context.evidence_index is None
+    try:
+        out.protein_detection_list()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
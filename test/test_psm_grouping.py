@@ -0,0 +1,56 @@
+import os
+import random
+import tempfile
+
+from mzident_writer import psm_grouping
+
+
+def make_psms(n, n_spectra, seed=3):
+    rng = random.Random(seed)
+    return [{"spectrum_id": "scan=%d" % rng.randint(1, n_spectra), "spectra_data_id": rng.randint(1, 2),
+             "score": rng.randint(0, 20), "id": i, "peptide_id": i, "peptide_evidence_id": i}
+            for i in range(n)]
+
+
+def in_memory(psms, top_n=None):
+    spectra = {}
+    for psm in psms:
+        spectra.setdefault((psm["spectra_data_id"], psm["spectrum_id"]), []).append(psm)
+    grouped = []
+    for key in sorted(spectra):
+        ranked = sorted(spectra[key], key=lambda psm: -psm["score"])[:top_n]
+        grouped.append((key, [psm["id"] for psm in ranked]))
+    return grouped
+
+
+def test_group_psms():
+    psms = make_psms(1000, 50)
+    for top_n in (None, 3):
+        results = list(psm_grouping.group_psms(psms, run_size=64, top_n=top_n))
+        assert [((r["spectra_data_id"], r["spectrum_id"]), [psm["id"] for psm in r["identifications"]])
+                for r in results] == in_memory(psms, top_n)
+        assert [r["id"] for r in results] == list(range(1, len(results) + 1))
+        for result in results:
+            assert "spectrum_id" not in result["identifications"][0]
+    # Spilling and sorting in memory agree
+    assert list(psm_grouping.group_psms(psms, run_size=64)) == list(psm_grouping.group_psms(psms))
+
+
+def test_multi_pass_merge():
+    # 1000 PSMs in runs of 16 make 63 runs, merged two at a time over several passes
+    psms = make_psms(1000, 50)
+    tmp_dir = tempfile.mkdtemp()
+    for top_n in (None, 3):
+        results = list(psm_grouping.group_psms(psms, run_size=16, top_n=top_n, fan_in=2, tmp_dir=tmp_dir))
+        assert [((r["spectra_data_id"], r["spectrum_id"]), [psm["id"] for psm in r["identifications"]])
+                for r in results] == in_memory(psms, top_n)
+    assert os.listdir(tmp_dir) == []
+
+
+def test_rank():
+    psms = [{"score": 9}, {"score": 7}, {"score": 7}, {"score": 5}]
+    assert [psm["rank"] for psm in psm_grouping.rank(psms)] == [1, 2, 2, 4]
+    results = list(psm_grouping.group_psms(
+        [{"spectrum_id": "a", "score": 1.5, "id": 1}, {"spectrum_id": "a", "score": 0.5, "id": 2}],
+        higher_score_better=False))
+    assert [(psm["id"], psm["rank"]) for psm in results[0]["identifications"]] == [(2, 1), (1, 2)]
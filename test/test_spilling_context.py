@@ -0,0 +1,90 @@
+import os
+import tempfile
+import warnings
+
+from mzident_writer.spilling_context import SpillingDocumentContext
+
+
+def test_spill_and_reload():
+    context = SpillingDocumentContext(memory_budget=20000, batch_size=50)
+    for i in range(1000):
+        context["Peptide"][i] = "PEPTIDE_%d" % i
+        context["DBSequence"]["acc%d" % i] = "DBSEQUENCE_%d" % i
+    stats = context.spill_stats()
+    assert stats["memory_bytes"] <= 20000
+    assert stats["spilled_entries"] > 0
+    assert context["Peptide"][3] == "PEPTIDE_3"
+    assert context["DBSequence"]["acc999"] == "DBSEQUENCE_999"
+    assert context.disk_reads >= 1
+    # A newer registration wins over a spilled one
+    context["Peptide"][5] = "PEPTIDE_FIVE"
+    assert context["Peptide"][5] == "PEPTIDE_FIVE"
+    for i in range(1000):
+        assert context["Peptide"][i] == ("PEPTIDE_%d" % i if i != 5 else "PEPTIDE_FIVE")
+    assert 7 in context["Peptide"] and "7" not in context["Peptide"]
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert context["Peptide"][5000] == "PEPTIDE_5000"
+    assert len(caught) == 1
+    path = context.store.path
+    context.close()
+    assert not os.path.exists(path)
+
+
+def test_writer_with_spilling_context():
+    from lxml import etree
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    context = SpillingDocumentContext(memory_budget=5000, batch_size=10)
+    out = MzIdentMLWriter(open(path, 'wb'), context=context)
+    assert out.context is context
+    out.register("DBSequence", 1)
+    with out:
+        out.sequence_collection(
+            peptides=[{"peptide_sequence": "PEPTIDE", "id": i} for i in range(1, 101)],
+            peptide_evidence=[{"peptide_id": i, "db_sequence_id": 1, "id": i, "start_position": 1,
+                               "end_position": 7} for i in range(1, 101)])
+    refs = [e.attrib["peptide_ref"] for e in etree.parse(path).findall(".//{*}PeptideEvidence")]
+    assert refs == ["PEPTIDE_%d" % i for i in range(1, 101)]
+    assert context.disk_reads > 0
+    # The writer closes the context, removing its temporary database
+    assert context.store.closed
+    assert not os.path.exists(context.store.path)
+    assert context.spill_stats()["disk_reads"] == context.disk_reads
+
+
+def test_deduplication_spills():
+    from lxml import etree
+    from mzident_writer.writer import MzIdentMLWriter
+    path = os.path.join(tempfile.mkdtemp(), "out.mzid")
+    context = SpillingDocumentContext(memory_budget=5000, batch_size=10)
+    out = MzIdentMLWriter(open(path, 'wb'), context=context)
+    out.register("DBSequence", 1)
+    with out:
+        out.sequence_collection(
+            peptides=[{"peptide_sequence": "PEPTIDE%d" % (i % 10), "id": i} for i in range(1, 101)],
+            peptide_evidence=[{"peptide_id": i, "db_sequence_id": 1, "id": i, "start_position": 1,
+                               "end_position": 7} for i in range(1, 101)],
+            deduplicate=True)
+        assert context.canonical_id("Peptide", 11) == 1
+        assert context.canonical_id("Peptide", 1) == 1
+        assert context.deduplication_stats() == {
+            "Peptide": {"seen": 100, "unique": 10, "ratio": 10.0},
+            "PeptideEvidence": {"seen": 100, "unique": 10, "ratio": 10.0}}
+        assert not context._interned and not context._aliases
+    tree = etree.parse(path)
+    assert len(tree.findall(".//{*}Peptide")) == 10
+    assert [e.attrib["peptide_ref"] for e in tree.findall(".//{*}PeptideEvidence")] == [
+        "PEPTIDE_%d" % i for i in range(1, 11)]
+
+
+def test_evidence_index_refused():
+    context = SpillingDocumentContext()
+    try:
+        context.track_evidence()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+    finally:
+        context.close()
@@ -0,0 +1,141 @@
+import os
+import tempfile
+import threading
+
+from mzident_writer import unimod, unimod_snapshot, controlled_vocabulary
+
+sample_path = os.path.join(os.path.dirname(__file__), "unimod_tables_sample.xml")
+
+
+def make_unimod():
+    return unimod.Unimod(source=sample_path)
+
+
+def test_create():
+    session = unimod.create(sample_path)
+    assert session.query(unimod.Modification).count() == 8
+    assert session.query(unimod.AlternativeName).count() == 9
+    mod = session.query(unimod.Modification).get(1)
+    assert mod.code_name == "Acetyl"
+    assert len(mod.specificities) > 0
+
+
+def test_get():
+    db = make_unimod()
+    assert db.get("Acetyl").id == 1
+    assert db["carbamidomethyl"].id == 4
+    assert db.get("Carboxyamidomethylation").id == 4
+    assert db.get("hospho", strict=False).id == 21
+    assert [mod.id for mod in db.get_many(["Oxidation", "Phospho", 1])] == [35, 21, 1]
+
+
+def test_composition():
+    db = make_unimod()
+    composition = db.get("Acetyl").composition
+    assert composition["C"] == 2
+    assert composition["H"] == 2
+    assert composition["O"] == 1
+
+
+def test_search_mass():
+    db = make_unimod()
+    assert [mod.id for mod in db.search_mass(79.9663, 0.001)] == [21]
+    assert [mod.id for mod in db.search_mass(15.9949, 10, "ppm", residue="M")] == [35]
+    assert db.search_mass(15.9949, 0.01, residue="A") == []
+
+
+def test_snapshot():
+    db = make_unimod()
+    path = os.path.join(tempfile.mkdtemp(), "unimod.snapshot")
+    db.export_snapshot(path)
+    snapshot = unimod_snapshot.UnimodSnapshot(path)
+    assert len(snapshot) == 8
+    record = snapshot.get("Carboxyamidomethylation")
+    assert record.id == 4
+    assert record.accession == "UNIMOD:4"
+    assert record.formula == db[4]._composition
+    assert abs(record.monoisotopic_mass - db[4].monoisotopic_mass) < 1e-6
+    assert record.alternative_names == tuple(db[4].alternative_names)
+    assert snapshot.get("hospho", strict=False).id == 21
+    assert [mod.id for mod in snapshot.search_mass(15.9949, 10, "ppm", residue="M")] == [35]
+    assert snapshot.specificity_index == db.specificity_index
+    in_memory = unimod_snapshot.UnimodSnapshot.from_records(db.records())
+    assert in_memory.path is None
+    assert in_memory.get("Carboxyamidomethylation").formula == record.formula
+
+
+def test_load_all():
+    db = make_unimod()
+    for strategy in ("selectin", "subquery", "joined"):
+        db.session.expunge_all()
+        mods = db.load_all(("specificities.position", "_alt_names"), strategy=strategy)
+        assert [mod.id for mod in mods] == [1, 4, 7, 12, 21, 35, 214, 737]
+        for mod in mods:
+            assert "specificities" in mod.__dict__
+            assert "_alt_names" in mod.__dict__
+            assert all("position" in spec.__dict__ for spec in mod.specificities)
+    records = list(db.records())
+    assert records[1].alternative_names == tuple(db[4].alternative_names)
+
+
+def test_threaded_get():
+    path = "sqlite:///%s" % os.path.join(tempfile.mkdtemp(), "unimod.db")
+    unimod.Unimod(path, source=sample_path)
+    db = unimod.Unimod(path)
+    results = []
+
+    def lookup():
+        results.append([len(mod.specificities) for mod in db.get_many(["Acetyl", "Phospho", "Oxidation"])])
+
+    threads = [threading.Thread(target=lookup) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4
+    assert all(result == results[0] for result in results)
+
+
+def test_lazy_composition():
+    db = make_unimod()
+    mod = db.get("Acetyl")
+    assert "_memoized_composition" not in mod.__dict__
+    composition = mod.composition
+    assert mod.composition is composition
+    mod._composition = "H(2) C(2) O(2)"
+    assert mod.composition["O"] == 2
+
+
+def test_resolve_unimod_rebuilds_stale_snapshot():
+    cache = controlled_vocabulary.OBOCache(tempfile.mkdtemp())
+    db_path = cache.path_for("unimod.db", False)
+    unimod.Unimod("sqlite:///%s" % db_path, source=sample_path)
+    snapshot = controlled_vocabulary.resolve_unimod(cache)
+    assert len(snapshot) == 8
+    assert controlled_vocabulary.resolve_unimod(cache).source == snapshot.source
+    modified = os.stat(db_path).st_mtime + 10
+    os.utime(db_path, (modified, modified))
+    rebuilt = controlled_vocabulary.resolve_unimod(cache)
+    assert rebuilt.source != snapshot.source
+    assert rebuilt.source[0] == os.stat(db_path).st_mtime
+
+
+def test_threaded_snapshot_get():
+    snapshot = unimod_snapshot.UnimodSnapshot.from_records(make_unimod().records(), cache_size=2)
+    names = ["Acetyl", "Phospho", "Oxidation", "Carbamidomethyl", 1, 21]
+    expected = [snapshot.get(name).id for name in names]
+    failures = []
+
+    def lookup():
+        try:
+            for i in range(2000):
+                assert [snapshot.get(name).id for name in names] == expected
+        except Exception as error:
+            failures.append(error)
+
+    threads = [threading.Thread(target=lookup) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
@@ -0,0 +1,58 @@
+from mzident_writer.unimod_index import NameIndex, MassIndex, SpecificityRecord, LRUCache
+
+
+def make_index():
+    index = NameIndex()
+    index.add("Acetylation", 1)
+    index.add("Acetyl", 1)
+    index.add("Phosphorylation", 21)
+    index.add("Phospho", 21)
+    index.add("Acetyl", 500, primary=False)
+    index.add("phosphorylation site", 300, primary=False)
+    return index
+
+
+def test_name_index_find():
+    index = make_index()
+    assert index.find("Acetyl") == 1
+    assert index.find("ACETYLATION") == 1
+    assert index.find(" phospho ") == 21
+    assert "Methyl" not in index
+
+
+def test_name_index_search():
+    index = make_index()
+    assert index.search("cetyl") == 1
+    assert index.search("SITE") == 300
+    assert index.search("ph") == 21
+    try:
+        index.search("methyl")
+        assert False
+    except KeyError:
+        pass
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache.get("a")
+    cache["c"] = 3
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+def test_mass_index():
+    specificities = {
+        1: [SpecificityRecord("K", "Anywhere", "Post-translational", False),
+            SpecificityRecord("N-term", "Protein N-term", "Post-translational", False)],
+        21: [SpecificityRecord("S", "Anywhere", "Post-translational", False)],
+        40: [SpecificityRecord("Y", "Anywhere", "Post-translational", False)],
+    }
+    index = MassIndex([(1, 42.010565), (21, 79.966331), (40, 79.956815), (35, 15.994915)], specificities)
+    assert index.search(79.96, 0.01) == [40, 21]
+    assert index.search(79.966331, 5, "ppm") == [21]
+    assert index.search(79.96, 0.01, residue="S") == [21]
+    assert index.search(42.01, 0.01, position="Protein N-term") == [1]
+    assert index.search(42.01, 0.01, residue="S") == []